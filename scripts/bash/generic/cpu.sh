@@ -25,5 +25,5 @@ conda activate diag
 
 base_path=$code_folder/config/experiments/$folder/
 config_path="${base_path}${SLURM_ARRAY_TASK_ID}.json"
-python3 scripts/run.py --config ${config_path}
+python3 scripts/run.py --config ${config_path} ${run_flags}
 
@@ -26,5 +26,9 @@ conda activate diag
 
 base_path=$code_folder/config/experiments/$folder/
 config_path="${base_path}${SLURM_ARRAY_TASK_ID}.json"
-python3 scripts/run.py --config ${config_path}
+# With ids="18 19 20 21", the experiments run in one job, sharing their models
+if [ -n "$ids" ]; then
+    config_path=$(for i in $ids; do echo -n "${base_path}${i}.json "; done)
+fi
+python3 scripts/run.py --config ${config_path} ${run_flags}
 
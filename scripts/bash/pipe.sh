@@ -1,5 +1,9 @@
 #!/bin/bash
 
+## The sbatch steps below run one after the other. Once the configs are
+## generated, `python3 scripts/pipeline.py --config "$config_dir/*.json" --executor slurm`
+## runs the independent ones concurrently.
+
 ## Important variables
 code_folder=""
 name="diagnostic_feedback"
@@ -94,6 +98,8 @@ python3 scripts/generate_config.py --name $name --model $config_dir/4.json --dat
 python3 scripts/generate_config.py --name $name --model $config_dir/4.json --dataset $config_dir/16.json --task $feedback
 python3 scripts/generate_config.py --name $name --model $config_dir/4.json --dataset $config_dir/17.json --task $feedback
 # sbatch --wait --export=folder=$name --array=18-21 $log_folder $gpu
+# Or in a single job loading the SFT model once:
+# sbatch --wait --export=folder=$name,ids="18 19 20 21" $log_folder $gpu_script
 
 # DPO generations
 python3 scripts/generate_config.py --name $name --model $config_dir/13.json --dataset $config_dir/14.json --task $feedback
@@ -0,0 +1,269 @@
+"""
+Run a pipeline of experiments, with independent experiments running concurrently.
+
+The stages are experiment configs created with scripts/generate_config.py.
+A stage depends on the stages whose results it reads: the previous
+experiments used as datasets, and the training experiment of its model.
+Every stage is run with scripts/run.py, either as a local process or as a
+SLURM job with the scripts of scripts/bash/generic. Up to date stages are
+skipped by run.py (see `--force`).
+
+Example, replacing the sequential sbatch calls of scripts/bash/pipe.sh:
+
+    python3 scripts/pipeline.py --config "config/experiments/diagnostic_feedback/*.json" --executor slurm
+"""
+
+import os
+import glob
+import time
+import threading
+import subprocess
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from src.utils.files import read_config, save_json
+from src.utils.experiments import experiment_dir, is_training, upstream_dirs
+
+
+def parse_args():
+    parser = ArgumentParser(description="Running a pipeline of experiments")
+    parser.add_argument("--config", required=True, nargs="+",
+                        help="Experiment configuration files (or glob patterns)")
+    parser.add_argument("--executor", choices=["local", "slurm"], default="local")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Maximum number of stages running at the same time")
+    parser.add_argument("--gpu_workers", type=int, default=1,
+                        help="Maximum number of local GPU stages running at the same time")
+    parser.add_argument("--cpu_script", default="scripts/bash/generic/cpu.sh")
+    parser.add_argument("--gpu_script", default="scripts/bash/generic/gpu.sh")
+    parser.add_argument("--train_script", default="scripts/bash/generic/gpu.sh")
+    parser.add_argument("--log_dir", default="logs",
+                        help="Directory of the logs of every stage")
+    parser.add_argument("--report", help="Path where the timings report is saved (JSON)")
+    parser.add_argument("--force", action="store_true",
+                        help="Run the stages even if they are up to date")
+    parser.add_argument("--test_run", action="store_true")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only print the stages and their dependencies")
+
+    return parser.parse_args()
+
+
+class Stage():
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.name = config.name
+        self.dir = experiment_dir(config)
+        self.kind = stage_kind(config)
+        self.depends = []
+        self.status = "pending"
+        self.start, self.end = None, None
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.start is not None and self.end is not None else 0.0
+
+
+def stage_kind(config):
+    """ Resources of a stage: "train", "gpu" or "cpu". """
+    if is_training(config):
+        return "train"
+    if "model" in config.model or config.model.source == "local" or config.task.cascade:
+        return "gpu"
+    return "cpu"
+
+
+def build_stages(patterns):
+    """
+    Read the configs and link every stage to the stages it depends on.
+
+    Returns:
+        list of Stage: The stages, in the order of the config files.
+    """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern), key=config_order) or [pattern]
+        paths.extend(p for p in matches if p not in paths)
+
+    stages = [Stage(path, read_config(path)) for path in paths]
+    by_dir = {s.dir: s for s in stages}
+    for stage in stages:
+        stage.depends = [by_dir[d] for d in upstream_dirs(stage.config)
+                         if d in by_dir and by_dir[d] is not stage]
+
+    check_acyclic(stages)
+    return stages
+
+
+def config_order(path):
+    # Generated configs are numbered 0.json, 1.json, ...
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(name), path) if name.isdigit() else (1, 0, path)
+
+
+def check_acyclic(stages):
+    visiting, visited = set(), set()
+
+    def visit(stage):
+        if stage.path in visited:
+            return
+        if stage.path in visiting:
+            raise ValueError(f"Dependency cycle through {stage.path}")
+        visiting.add(stage.path)
+        for upstream in stage.depends:
+            visit(upstream)
+        visiting.remove(stage.path)
+        visited.add(stage.path)
+
+    for stage in stages:
+        visit(stage)
+
+
+class Runner():
+    """ Runs the stages as soon as their dependencies succeeded. """
+
+    def __init__(self, args):
+        self.args = args
+        self.gpu_slots = threading.Semaphore(args.gpu_workers)
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    def run(self, stages):
+        executor = ThreadPoolExecutor(max_workers=self.args.workers)
+        running = {}
+
+        while True:
+            for stage in stages:
+                if stage.status != "pending":
+                    continue
+                if any(s.status in ["failed", "blocked"] for s in stage.depends):
+                    stage.status = "blocked"
+                    print(f"[blocked] {stage.name}")
+                elif all(s.status == "done" for s in stage.depends):
+                    stage.status = "running"
+                    running[executor.submit(self.run_stage, stage)] = stage
+
+            if not running:
+                # Stages after a blocked one are blocked as well
+                for stage in stages:
+                    if stage.status == "pending":
+                        stage.status = "blocked"
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"[error] {stage.name}: {e}")
+                    ok = False
+                stage.status = "done" if ok else "failed"
+                print(f"[{stage.status}] {stage.name} in {stage.duration:.0f}s")
+
+        executor.shutdown()
+
+    def run_stage(self, stage):
+        print(f"[start] {stage.name}")
+        if self.args.executor == "slurm":
+            return self.run_slurm(stage)
+        if stage.kind == "cpu":
+            return self.run_local(stage)
+        with self.gpu_slots:
+            return self.run_local(stage)
+
+    def run_local(self, stage):
+        command = ["python3", "scripts/run.py", "--config", stage.path, *self.run_flags()]
+        log_path = os.path.join(self.args.log_dir, f"{os.path.basename(stage.dir)}.log")
+        stage.start = time.time()
+        with open(log_path, "w") as log:
+            code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT,
+                                   env={**os.environ, "PYTHONPATH": os.getcwd()})
+        stage.end = time.time()
+        return code == 0
+
+    def run_slurm(self, stage):
+        # The generic scripts run config/experiments/<folder>/<SLURM_ARRAY_TASK_ID>.json
+        folder = os.path.basename(os.path.dirname(stage.path))
+        index = os.path.splitext(os.path.basename(stage.path))[0]
+        if not index.isdigit():
+            raise ValueError(f"SLURM stages must be generated configs, got {stage.path}")
+
+        script = {"cpu": self.args.cpu_script, "gpu": self.args.gpu_script,
+                  "train": self.args.train_script}[stage.kind]
+        log_path = os.path.join(self.args.log_dir, f"%A_{index}.log")
+        export = f"--export=ALL,folder={folder},run_flags={' '.join(self.run_flags())}"
+        command = ["sbatch", "--wait", export, f"--array={index}",
+                   f"--output={log_path}", script]
+        stage.start = time.time()
+        code = subprocess.call(command)
+        stage.end = time.time()
+        return code == 0
+
+    def run_flags(self):
+        return [flag for flag, on in [("--force", self.args.force),
+                                      ("--test_run", self.args.test_run)] if on]
+
+
+def critical_path(stages):
+    """
+    The chain of dependent stages with the longest total duration,
+    which bounds the duration of the pipeline whatever the parallelism.
+
+    Returns:
+        tuple: The stages of the path and its total duration.
+    """
+    best = {}
+
+    def finish(stage):
+        if stage.path not in best:
+            previous = max((finish(s) for s in stage.depends), key=lambda b: b[1], default=([], 0.0))
+            best[stage.path] = (previous[0] + [stage], previous[1] + stage.duration)
+        return best[stage.path]
+
+    return max((finish(s) for s in stages), key=lambda b: b[1], default=([], 0.0))
+
+
+def report(stages, wall_time, path=None):
+    print("-----")
+    print(f"{'stage':<60} {'kind':<6} {'status':<8} {'duration':>10}")
+    for stage in stages:
+        print(f"{stage.name[:60]:<60} {stage.kind:<6} {stage.status:<8} {stage.duration:>9.0f}s")
+
+    path_stages, length = critical_path(stages)
+    total = sum(s.duration for s in stages)
+    print("Wall time", f"{wall_time:.0f}s", "| sum of stage durations", f"{total:.0f}s")
+    print("Critical path", f"{length:.0f}s:", " -> ".join(s.name for s in path_stages))
+    print("-----")
+
+    if path:
+        save_json({
+            "wall_time": wall_time,
+            "total_stage_time": total,
+            "critical_path": {"duration": length, "stages": [s.name for s in path_stages]},
+            "stages": [{"name": s.name, "config": s.path, "kind": s.kind, "status": s.status,
+                        "start": s.start, "end": s.end, "duration": s.duration,
+                        "depends": [d.name for d in s.depends]} for s in stages],
+        }, path)
+
+
+def main():
+    args = parse_args()
+    stages = build_stages(args.config)
+
+    for stage in stages:
+        print(f"{stage.path} [{stage.kind}] {stage.name}",
+              "<-", [os.path.basename(s.path) for s in stage.depends])
+    if args.dry_run:
+        return
+
+    start = time.time()
+    Runner(args).run(stages)
+    report(stages, time.time() - start, args.report)
+
+    if any(s.status != "done" for s in stages):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,40 @@
 """
-Run an experiment from a config file.
+Run one or several experiments from config files.
+
+Experiments loading the same local model are run one after the other
+in this process, with the model loaded once (see `group_by_model`).
+
+Completed experiments save a fingerprint of their config, the code and
+their inputs. Experiments whose fingerprint did not change since they
+completed are skipped, unless `--force` is given.
 """
 
+import dspy
 from argparse import ArgumentParser
 from src.judging.Judging import Judging
 from src.feedback.Feedback import Feedback
 from src.utils.files import read_config
-from src.utils.core import set_seed
+from src.utils.core import set_seed, claim_memory
+from src.utils.experiments import group_by_model
+from src.Generate import Generate
 from src.trl.SFT import SFT
 from src.trl.DPO import DPO
+from src.Fused import Fused
 
 def parse_args():
     parser = ArgumentParser(description="Running experiments")
-    parser.add_argument("--config", required=True,
-                        help="Path towards the configuration file")
+    parser.add_argument("--config", required=True, nargs="+",
+                        help="Path towards the configuration file(s)")
     parser.add_argument('--test_run',
                         help="Whether to do a test run to ensure the pipeline works without issues",
                         action="store_true")
+    parser.add_argument("--force", action="store_true",
+                        help="Run the experiments even if they are up to date")
+    parser.add_argument("--fuse_with",
+                        help="Path towards the configuration of a judging experiment to run "
+                             "concurrently on the outputs of this experiment, as they are generated")
+    parser.add_argument("--queue_size", type=int, default=4,
+                        help="Maximum number of generated chunks waiting to be judged with --fuse_with")
 
     return parser.parse_args()
 
@@ -37,12 +55,66 @@ def load_experiment(name):
 
 def main():
     args = parse_args()
-    config = read_config(args.config)
-    set_seed(config.seed)
+    configs = [read_config(path) for path in args.config]
+
+    if args.fuse_with:
+        if len(configs) > 1:
+            raise ValueError("--fuse_with only supports a single --config")
+        config = configs[0]
+        set_seed(config.seed)
+        experiment = load_experiment(config.name)(config, test_run=args.test_run)
+        judge_config = read_config(args.fuse_with)
+        JUDGE_CLASS = load_experiment(judge_config.name)
+        judging = JUDGE_CLASS(judge_config, test_run=args.test_run)
+        if not args.force and not args.test_run and experiment.is_up_to_date() and judging.is_up_to_date():
+            print("Skipping up to date experiments", config.name, judge_config.name)
+            return
+        experiment.invalidate()
+        judging.invalidate()
+        Fused(experiment, judging, queue_size=args.queue_size).run()
+        if not args.test_run:
+            experiment.mark_complete()
+            # Judging depends on the fingerprint the generation just saved
+            judging.mark_complete(refresh=True)
+        return
+
+    for identity, group in group_by_model(configs):
+        run_group(group, shared=identity is not None, test_run=args.test_run, force=args.force)
+
+
+def run_group(configs, shared, test_run=False, force=False):
+    """
+    Run experiments one after the other. With `shared`, they all use the 
+    local model loaded by the first one, which is released at the end.
+    Experiments which are up to date are skipped unless `force` is set.
+    """
+    local_instance = None
+    for config in configs:
+        set_seed(config.seed)
+        experiment = load_experiment(config.name)(config, test_run=test_run)
+        # Test runs are never considered complete
+        if not force and not test_run and experiment.is_up_to_date():
+            print("Skipping up to date experiment", config.name)
+            continue
+
+        print("Running experiment", config.name)
+        experiment.invalidate()
+        if shared and isinstance(experiment, Generate):
+            if local_instance is not None:
+                local_instance.reset_metrics()
+            experiment.local_instance = local_instance
+            experiment.run()
+            local_instance = experiment.local_instance
+        else:
+            experiment.run()
+        if not test_run:
+            experiment.mark_complete()
+        del experiment
 
-    EXP_CLASS = load_experiment(config.name)
-    experiment = EXP_CLASS(config, test_run=args.test_run)
-    experiment.run()
+    # The global LM keeps a reference to the model
+    local_instance = None
+    dspy.configure(lm=None)
+    claim_memory()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""
+Serve a local model with an OpenAI compatible chat completions API,
+so that several experiments share one resident copy of the model.
+
+Requests are collected by a batching thread: requests arriving within
+`--max_wait` seconds of each other, with the same generation arguments,
+are generated together in one batch.
+
+Point an experiment at the server with a model config such as
+config/model/local/qwen-2.5-coder-server.yaml (`source: server`).
+
+When the model config loads several LoRA adapters (see `adapters` in
+config/model/local/qwen-2.5-coder-adapters.yaml), the `model` of a request
+selects its adapter, and requests for different adapters share batches.
+"""
+
+import json
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from dotmap import DotMap
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.Generate import load_model_agent
+from src.model.HugLM import chat_completion
+from src.utils.files import read_config
+
+# Generation arguments of the request body forwarded to the model
+GEN_KWARGS = ["temperature", "top_p", "max_tokens", "n", "stop"]
+
+
+def parse_args():
+    parser = ArgumentParser(description="Serving a local model")
+    parser.add_argument("--config", required=True,
+                        help="Path towards the model (or experiment) configuration file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=8,
+                        help="Maximum number of requests generated together")
+    parser.add_argument("--max_wait", type=float, default=0.05,
+                        help="Seconds to wait for other requests before generating a batch")
+
+    return parser.parse_args()
+
+
+class Batcher():
+    """ Collects the incoming requests and generates them in batches on a single thread. """
+
+    def __init__(self, local_instance, max_batch_size=8, max_wait=0.05):
+        self.local_instance = local_instance
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, messages, gen_kwargs, adapter=None):
+        """ Queue a request, returning a future of its choices. """
+        future = Future()
+        self.requests.put((messages, gen_kwargs, adapter, future))
+        return future
+
+    def loop(self):
+        pending = []
+        while True:
+            if not pending:
+                pending.append(self.requests.get())
+
+            # Wait a little for other requests to batch with
+            deadline = time.time() + self.max_wait
+            while len(pending) < self.max_batch_size * 4:
+                try:
+                    pending.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            batch = self.next_batch(pending)
+            generated = {id(r) for r in batch}
+            pending = [r for r in pending if id(r) not in generated]
+            self.generate(batch)
+
+    def next_batch(self, pending):
+        """ The oldest request, with the following ones it can be generated with. """
+        key = batch_key(*pending[0][:2])
+        return [r for r in pending if batch_key(*r[:2]) == key][:self.max_batch_size]
+
+    def generate(self, batch):
+        messages = [r[0] for r in batch]
+        gen_kwargs = dict(batch[0][1])
+        adapters = [r[2] for r in batch]
+        try:
+            choices = self.local_instance.batch_generate(messages, gen_kwargs, adapters=adapters)
+        except Exception as e:
+            for r in batch:
+                r[3].set_exception(e)
+            return
+
+        self.stats["requests"] += len(batch)
+        self.stats["batches"] += 1
+        for r, c in zip(batch, choices):
+            self.stats["prompt_tokens"] += c[0]["prompt_tokens"] if c else 0
+            self.stats["completion_tokens"] += sum(x["completion_tokens"] for x in c)
+            r[3].set_result(c)
+
+
+def batch_key(messages, gen_kwargs):
+    # Conversations are only generated together with the same arguments,
+    # and when all of them end with a user turn (or all continue the assistant)
+    return json.dumps(gen_kwargs, sort_keys=True), messages[-1]["role"] == "user"
+
+
+def make_handler(batcher, model_name, adapters=()):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.rstrip("/") in ["/v1/models", "/models"]:
+                models = [{"id": name, "object": "model"} for name in [model_name, *adapters]]
+                self.send_json(200, {"object": "list", "data": models})
+            elif self.path.rstrip("/") == "/health":
+                self.send_json(200, {"status": "ok", **batcher.stats})
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            if self.path.rstrip("/") not in ["/v1/chat/completions", "/chat/completions"]:
+                return self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                messages = body["messages"]
+            except (ValueError, KeyError) as e:
+                return self.send_json(400, {"error": {"message": f"Invalid request: {e}"}})
+
+            gen_kwargs = {k: body[k] for k in GEN_KWARGS if body.get(k) is not None}
+            gen_kwargs.setdefault("temperature", 1.0)
+            gen_kwargs.setdefault("top_p", 1.0)
+            # Stop sequences are not supported, generation stops with the ChatAdapter format
+            gen_kwargs.pop("stop", None)
+
+            # The adapter is picked by its name as the model of the request
+            adapter = body.get("model") if body.get("model") in adapters else None
+
+            try:
+                choices = batcher.submit(messages, gen_kwargs, adapter).result()
+            except Exception as e:
+                return self.send_json(500, {"error": {"message": str(e)}})
+            self.send_json(200, chat_completion(choices, adapter or model_name))
+
+        def send_json(self, status, data):
+            payload = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    args = parse_args()
+    config = read_config(args.config)
+    if "model" not in config:
+        # A model config rather than an experiment config
+        config = DotMap({"model": config})
+
+    local_instance = load_model_agent(config)
+    batcher = Batcher(local_instance, args.max_batch_size, args.max_wait)
+
+    handler = make_handler(batcher, local_instance.config.name, list(local_instance.adapters))
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Serving {local_instance.config.name} on http://{args.host}:{args.port}/v1")
+    if local_instance.adapters:
+        print("Adapters", list(local_instance.adapters))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 import os
+import time
 import pandas as pd 
 from src.data.CIP import CIPDataset
 from src.data.Annotated import AnnotatedDataset
 from src.utils.files import create_dir, save_json
+from src.utils.experiments import FINGERPRINT_FILE, fingerprint, read_fingerprint
 
 class Experiment():
 
@@ -19,9 +21,41 @@ class Experiment():
         save_path = os.path.join(self.save_dir, "experiment_configuration.json")
         save_json(self.config, save_path)
         self.results_save_path = os.path.join(self.save_dir, "generations.csv")
+        self.metrics_save_path = os.path.join(self.save_dir, "metrics.json")
 
     def run(self):
         raise NotImplementedError()
+
+    def fingerprint(self):
+        """ Fingerprint of the config, code and inputs of the experiment, computed once. """
+        if getattr(self, "_fingerprint", None) is None:
+            self._fingerprint = fingerprint(self.config)
+        return self._fingerprint
+
+    def is_up_to_date(self):
+        """ Whether the experiment already completed with the same fingerprint. """
+        saved = read_fingerprint(self.save_dir)
+        return saved is not None and saved.get("fingerprint") == self.fingerprint()["fingerprint"]
+
+    def invalidate(self):
+        """ Remove the completion marker before (re)running the experiment. """
+        self.fingerprint()
+        path = os.path.join(self.save_dir, FINGERPRINT_FILE)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def mark_complete(self, refresh=False):
+        """
+        Save the fingerprint, marking the results as complete.
+
+        Args:
+            refresh (bool): Compute the fingerprint again, for experiments run
+                concurrently with the ones they depend on.
+        """
+        if refresh:
+            self._fingerprint = None
+        save_json({**self.fingerprint(), "completed_at": time.time()},
+                  os.path.join(self.save_dir, FINGERPRINT_FILE))
     
     def load_dataframe(self):
         """ 
@@ -44,4 +78,34 @@ class Experiment():
         
         return pd.concat(dataframe, axis=0, ignore_index=True)
 
+    def iter_dataframe(self, chunk_size):
+        """
+        Read the configured datasets in chunks of at most `chunk_size` rows,
+        in the same order as `load_dataframe`.
+
+        Args:
+            chunk_size (int): Number of rows per chunk.
+
+        Yields:
+            pd.DataFrame: The next chunk.
+        """
+        for ds in self.config.dataset:
+            if ds.name.startswith("cip"):
+                chunks = CIPDataset(ds).iter_data(chunk_size)
+            elif ds.name.startswith("annotated"):
+                chunks = split_dataframe(AnnotatedDataset(ds).get_data(), chunk_size)
+            else:
+                exp = Experiment(ds, test_run=False)
+                chunks = pd.read_csv(exp.results_save_path, chunksize=chunk_size)
+
+            for df in chunks:
+                if self.test_run: 
+                    yield df.iloc[:1]
+                    break
+                yield df
+
+
+def split_dataframe(dataframe, chunk_size):
+    for start in range(0, len(dataframe), chunk_size):
+        yield dataframe.iloc[start: start + chunk_size]
 
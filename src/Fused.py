@@ -0,0 +1,94 @@
+import queue
+import threading
+import dspy
+
+# Seconds between two checks that the consumer is still running, while the queue is full
+PUT_TIMEOUT = 1.0
+
+
+class ConsumerStopped(Exception):
+    """ Raised in the producer when the consumer stopped before the end. """
+
+
+class Fused():
+    """
+    Runs feedback generation and judging as a producer/consumer pipeline.
+
+    The feedback stage generates its datasets chunk by chunk (see `Generate.stream`)
+    and hands every generated chunk to the judging stage through a bounded queue.
+    The judging stage runs concurrently in the main thread, so a remote judge
+    can evaluate the first chunks while the local model is still generating
+    the next ones. Both stages save their results as if they had been run
+    separately, and the datasets of the judging config are not read.
+    """
+
+    def __init__(self, producer, consumer, chunk_size=32, queue_size=4):
+        """
+        Args:
+            producer (Generate): The generation stage (e.g. `Feedback`).
+            consumer (Generate): The stage evaluating its outputs (e.g. `Judging`).
+            chunk_size (int): Number of rows generated before they are passed on.
+            queue_size (int): Maximum number of chunks waiting to be judged,
+                blocking the producer when the consumer falls behind.
+        """
+        self.producer = producer
+        self.consumer = consumer
+        self.chunk_size = producer.config.task.chunk_size or chunk_size
+        self.queue_size = queue_size
+
+    def run(self):
+        # Each stage uses its own LM through dspy.context, the global
+        # DSPy settings can only be changed by the main thread
+        producer_module, producer_generate = self.producer.setup(configure=False)
+        consumer_module, consumer_generate = self.consumer.setup(configure=False)
+
+        chunks = queue.Queue(maxsize=self.queue_size)
+        # Set when the consumer ends, so that the producer never waits for it
+        stopped = threading.Event()
+        errors = []
+
+        def put(chunk):
+            while not stopped.is_set():
+                try:
+                    return chunks.put(chunk, timeout=PUT_TIMEOUT)
+                except queue.Full:
+                    continue
+            raise ConsumerStopped()
+
+        def produce():
+            try:
+                with dspy.context(lm=self.producer.lm, adapter=self.producer.adapter):
+                    self.producer.stream(producer_module, producer_generate,
+                                         self.producer.iter_dataframe(self.chunk_size),
+                                         on_chunk=put)
+            except ConsumerStopped:
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Always wake up the consumer
+                try:
+                    put(None)
+                except ConsumerStopped:
+                    pass
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        def consume():
+            while (chunk := chunks.get()) is not None:
+                yield chunk
+
+        try:
+            with dspy.context(lm=self.consumer.lm, adapter=self.consumer.adapter):
+                self.consumer.stream(consumer_module, consumer_generate, consume())
+        finally:
+            # The producer stops at its next chunk if the consumer failed
+            stopped.set()
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        self.producer.report()
+        self.consumer.report()
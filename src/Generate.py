@@ -4,14 +4,22 @@ from warnings import warn
 import dspy
 import pandas as pd 
 from src.Experiment import Experiment
+from src.utils.files import save_json
 from src.model.HuggingFaceLocalModel import HuggingFaceLocalModel
 from src.model.HugLM import HugLM
+from src.model.history import HistoryStore
+from src.model.batch import BatchRunner, remove_stale_batches
+from src.adapters.Adapter import PrefixCachingAdapter
 
 from tqdm import tqdm
 from src.trl.TRL import TRL
 from rapidfuzz import fuzz
 
 
+# Rows written at once with their LM history entries
+HISTORY_BLOCK_SIZE = 256
+
+
 class Generate(Experiment):
     """
     A generic experiment runner for generating outputs using any DSPy module.
@@ -32,6 +40,20 @@ class Generate(Experiment):
         super().__init__(config, test_run)
         self.module_cls = module_cls
         self.can_batch = can_batch
+        self.batch_runner = None
+        self.adapter = None
+        # Local model shared with other experiments of the same process
+        self.local_instance = None
+        # Position of the first LM call of the current run in the history
+        self.history_start = 0
+
+
+    def invalidate(self):
+        """ Also remove the provider batches submitted for other inputs or configs. """
+        super().invalidate()
+        removed = remove_stale_batches(self.save_dir, self.fingerprint()["fingerprint"])
+        if removed:
+            print("Removed stale batches", removed)
 
 
     def run(self):
@@ -43,27 +65,210 @@ class Generate(Experiment):
         - Runs generation (batch or single depending on model type).
         - Aligns and merges results into a final dataframe.
         - Saves to disk and prints summary stats.
+
+        With `chunk_size` set in the task config, the datasets are read and 
+        generated chunk by chunk (see `stream`).
+
+        When the local model loads several adapters (e.g. a `checkpoint_sweep`)
+        and no `adapter` is set in the task config, the datasets are generated
+        with every adapter in turn, on the same base model, and saved in 
+        `generations_<adapter>.csv`.
+        """
+        module, generate = self.setup()
+
+        for adapter in self.sweep_adapters():
+            if adapter is not None:
+                self.use_adapter(adapter)
+
+            if self.config.task.chunk_size:
+                self.stream(module, generate, self.iter_dataframe(self.config.task.chunk_size))
+            else:
+                dataframe = self.load_dataframe()
+                dataframe = self.generate_dataframe(dataframe, module, generate)
+                dataframe = dataframe.dropna(axis=1, how="all")
+                self.write_results(dataframe)
+                print("Created dataframe", dataframe, dataframe.columns)
+
+            self.report()
+
+
+    def sweep_adapters(self):
+        """ Adapters to generate with one after the other, `[None]` for a single run. """
+        if not isinstance(self.lm, HugLM) or self.lm.adapter is not None:
+            return [None]
+        adapters = list(self.lm.local_instance.adapters)
+        return adapters if len(adapters) > 1 else [None]
+
+
+    def use_adapter(self, adapter):
+        """ 
+        Generate with the given adapter, saving the results under its name.
+        The metrics of the previous adapters are reset, and their LM calls are
+        left out of the usage of this one.
+        """
+        print("Generating with adapter", adapter)
+        self.lm.adapter = adapter
+        self.lm.local_instance.reset_metrics()
+        self.history_start = len(self.lm.history)
+        self.results_save_path = os.path.join(self.save_dir, f"generations_{adapter}.csv")
+        self.metrics_save_path = os.path.join(self.save_dir, f"metrics_{adapter}.json")
+
+
+    def setup(self, configure=True):
+        """
+        Load the LM and DSPy module, and pick the generation method.
+
+        Args:
+            configure (bool): Whether to set the LM as the global DSPy LM. 
+                Stages running in their own thread use `dspy.context` instead.
+
+        Returns:
+            tuple: The DSPy module and the generation method.
         """
-        dataframe = self.load_dataframe()
         module = self.module_cls()
-        self.lm = self.load_model()
+        self.lm = self.load_model(configure=configure)
+        if isinstance(self.lm, HugLM):
+            self.lm.signature = module.predictors()[0].signature
+            self.lm.adapter = self.config.task.adapter or None
 
         generate = self._generate
-        if self.config.model.source == "openai" and self.can_batch:
+        if self.config.model.source in ["openai", "server"] and self.can_batch:
             # Currently, this can cause issue and fallback is hard, so better use it only for judging 
             generate = self._batch_generate
-        
-        dspy_dataset = self.module_cls.build_dspy_dataset(dataframe)
+        if self.config.task.batch_api:
+            generate = self._batch_api_generate
+
+        return module, generate
+
+
+    def report(self):
+        """ Print the cost of the generations and save the run metrics. """
+        if len(self.lm.history) > self.history_start and "cost" in self.lm.history[-1]:
+            costs = self.lm.history.dataframe(columns=["cost"], start=self.history_start)["cost"]
+            print("Total cost of generations", sum(c for c in costs if c))
+
+        metrics = self.get_metrics()
+        if metrics:
+            print("Run metrics", metrics)
+            save_json(metrics, self.metrics_save_path)
+
+
+    def generate_dataframe(self, dataframe, module, generate):
+        """ Run generation on a dataframe and join the outputs to its rows. """
+        dspy_dataset = self.build_dspy_dataset(dataframe)
         df = generate(dspy_dataset, module)
-        columns = [c for c in dataframe.columns if c not in df.columns]
-        dataframe = dataframe[columns]
-        dataframe = dataframe.join(df, how="left").dropna(axis=1, how="all")
-        dataframe.to_csv(self.results_save_path)
-    
-        print("Created dataframe", dataframe, dataframe.columns)
+        # A `history_index` of the input rows refers to the history of another stage
+        columns = [c for c in dataframe.columns if c not in df.columns and c != "history_index"]
+        return dataframe[columns].join(df, how="left")
+
+
+    def build_dspy_dataset(self, dataframe):
+        return self.module_cls.build_dspy_dataset(dataframe)
 
-        if "cost" in self.lm.history[-1]:
-            print("Total cost of generations", sum(h["cost"] for h in self.lm.history if h["cost"]))
+
+    def stream(self, module, generate, chunks, on_chunk=None):
+        """
+        Generate chunk by chunk: each chunk of the datasets is read, generated
+        and appended to the results file before the next one is read, so that
+        memory is bounded by the chunk size rather than the size of the datasets.
+
+        Rows keep their index in the concatenation of all datasets, so the 
+        results file is the same as without chunking, except that columns 
+        empty in every row are kept.
+
+        Args:
+            module (dspy.Module): DSPy module used to generate predictions.
+            generate (callable): `_generate` or `_batch_generate`.
+            chunks (iterable of pd.DataFrame): The input chunks, e.g. from `iter_dataframe`.
+            on_chunk (callable, optional): Called with every generated chunk,
+                e.g. to pass it on to a following stage.
+        """
+        offset, columns = 0, None
+        for chunk in chunks:
+            n = len(chunk)
+            dataframe = self.generate_dataframe(chunk.reset_index(drop=True), module, generate)
+            dataframe.index = dataframe.index + offset
+
+            # Every chunk is written with the columns of the first one
+            columns = self.write_results(dataframe, columns)
+            offset += n
+            print(f"Generated {offset} rows")
+
+            if on_chunk is not None:
+                on_chunk(dataframe)
+
+        print("Created dataframe with", offset, "rows and columns", columns)
+
+
+    def write_results(self, dataframe, columns=None):
+        """
+        Write generated rows to the results file, or append them to it.
+
+        Rows generated by `_generate` only hold the position of their LM 
+        history entry (`history_index`). The entries (messages, outputs, 
+        usage, ...) are read back from the history and written with the rows
+        block by block, so that they are never all in memory.
+
+        Args:
+            dataframe (pd.DataFrame): The generated rows.
+            columns (list of str, optional): Columns of the rows already in the
+                results file. The rows are appended with these columns when given.
+
+        Returns:
+            list of str: The columns of the results file.
+        """
+        for start in range(0, max(len(dataframe), 1), HISTORY_BLOCK_SIZE):
+            block = self.join_history(dataframe.iloc[start: start + HISTORY_BLOCK_SIZE])
+            if columns is None:
+                columns = list(block.columns)
+                block.to_csv(self.results_save_path)
+            else:
+                block.reindex(columns=columns).to_csv(self.results_save_path, 
+                                                      mode="a", header=False)
+        return columns
+
+
+    def join_history(self, dataframe):
+        """ Replace the `history_index` of the rows by the fields of their LM history entry. """
+        if "history_index" not in dataframe:
+            return dataframe
+
+        entries = pd.DataFrame([self.lm.history[int(i)] if pd.notna(i) else {}
+                                for i in dataframe["history_index"]], index=dataframe.index)
+        # The history entry wins over output columns of the same name
+        dataframe = dataframe.drop(columns=["history_index", *[c for c in entries.columns 
+                                                               if c in dataframe.columns]])
+        return dataframe.join(entries)
+
+
+    def get_metrics(self):
+        """
+        Collect the run metrics reported by the language model backend
+        (e.g. assisted generation acceptance rate and speedup).
+
+        Returns:
+            dict: metrics to save next to the generations, including the
+                token usage recorded in the history for the current adapter.
+        """
+        metrics = {}
+        if isinstance(self.lm, HugLM):
+            metrics.update(self.lm.local_instance.get_metrics())
+        if self.batch_runner is not None:
+            metrics["batch_api"] = self.batch_runner.get_metrics()
+
+        usage = self.lm.history.dataframe(columns=["usage"], start=self.history_start)["usage"]
+        usage = [u for u in usage if u]
+        if usage:
+            prompt_tokens = sum(u.get("prompt_tokens") or 0 for u in usage)
+            cached_tokens = sum(cached_prompt_tokens(u) for u in usage)
+            metrics["usage"] = {
+                "calls": len(usage),
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "completion_tokens": sum(u.get("completion_tokens") or 0 for u in usage),
+                "cache_hit_rate": cached_tokens / prompt_tokens if prompt_tokens else None,
+            }
+        return metrics
 
 
     def _batch_generate(self, dataset, module):
@@ -74,6 +279,7 @@ class Generate(Experiment):
         - Runs batch generation using the given DSPy module.
         - Matches each prediction to its corresponding entry in `self.lm.history` 
           using fuzzy matching on prediction fields (e.g., reasoning, feedback).
+          Only the entries added by this batch are candidates.
         - Collects both model outputs and LM metadata.
         - Returns a DataFrame aligned with the original input dataset.
 
@@ -86,26 +292,54 @@ class Generate(Experiment):
                 - Prediction outputs (e.g., reasoning, feedback, grading)
                 - LM metadata (e.g., messages, model type, cost)
         """
+        start = len(self.lm.history)
         predictions = module.batch(dataset, num_threads=4, max_errors=1)
 
-        if len(predictions) != len(dataset):
+        if len(predictions) != len(dataset) or any(pred is None for pred in predictions):
             warn("Processing dataset failed for one or more examples")
+        predictions = [(i, pred) for i, pred in enumerate(predictions) if pred is not None]
 
-        lm_history_df = pd.DataFrame(self.lm.history)
+        lm_history_df = self.lm.history.dataframe(columns=["outputs"], start=start)
         mapping = self.config.task.outputs.toDict()
-        matched_indices = match_predictions_to_history(predictions, lm_history_df, threshold=50)
+        matched_indices = match_predictions_to_history([pred for _, pred in predictions], 
+                                                       lm_history_df, threshold=50)
 
         matched_data = []
-        for i, (pred, idx) in enumerate(zip(predictions, matched_indices)):
+        for (i, pred), idx in zip(predictions, matched_indices):
             outputs = {v: getattr(pred, k) for k, v in mapping.items()}
+            outputs.update(self.sample_outputs(pred, mapping))
             matched_data.append({
                 "index": i,
                 "hist_index": idx,
                 **outputs
             })
 
-        df = pd.DataFrame(matched_data)
-        return df.set_index("index")
+        return index_outputs(matched_data)
+
+
+    def _batch_api_generate(self, dataset, module):
+        """
+        Generate predictions with the provider batch API (see `src.model.batch`):
+        all the requests are submitted at once and their results are parsed
+        back when the batch completes. Interrupted runs resume the submitted batch.
+
+        Args:
+            dataset (List[dspy.Example]): Input examples.
+            module (dspy.Module): DSPy module whose predictor signature formats the requests.
+
+        Returns:
+            pd.DataFrame: A DataFrame indexed by example index, with the outputs,
+                the raw completions and their usage.
+        """
+        batch_api = self.config.task.batch_api
+        if self.batch_runner is None:
+            # One batch per call (i.e. per chunk), each with its own files
+            self.batch_runner = BatchRunner(self.config.model, self.save_dir, adapter=self.adapter,
+                                            gen_kwargs=batch_api.gen_kwargs.toDict() or None,
+                                            poll_interval=batch_api.poll_interval or 60,
+                                            fingerprint=self.fingerprint()["fingerprint"])
+        signature = module.predictors()[0].signature
+        return self.batch_runner.run(dataset, signature, self.config.task.outputs.toDict())
 
 
     def _generate(self, dataset, module):
@@ -115,7 +349,8 @@ class Generate(Experiment):
         This function:
         - Runs generation one example at a time using the given DSPy module.
         - Relies on the fact that `self.lm.history[-1]` contains the metadata 
-          for the most recent generation.
+          for the most recent generation, and keeps its position in the history
+          (`history_index`) rather than a copy (see `write_results`).
         - Collects prediction outputs and LM metadata in order.
         - Returns a DataFrame aligned with the input dataset.
 
@@ -126,7 +361,7 @@ class Generate(Experiment):
         Returns:
             pd.DataFrame: A DataFrame indexed by example index, containing:
                 - Prediction outputs (e.g., reasoning, feedback, grading)
-                - LM metadata (e.g., messages, model type, cost)
+                - The position of the LM history entry (messages, model type, cost)
         """
         output_dataframe = []
         mapping = self.config.task.outputs.toDict()
@@ -135,35 +370,90 @@ class Generate(Experiment):
             try:
                 pred = module(**x.inputs())
                 outputs = {v: getattr(pred, k) for k, v in mapping.items()}
-                outputs.update({"index": i, **self.lm.history[-1]})
+                outputs.update(self.sample_outputs(pred, mapping))
+                outputs.update({"index": i, "history_index": len(self.lm.history) - 1})
                 output_dataframe.append(outputs)
             except Exception:
                 warn(f"Generation failed for example {x}")
                 continue
 
-        return pd.DataFrame(output_dataframe).set_index("index")
+        return index_outputs(output_dataframe)
+
 
+    def sample_outputs(self, pred, mapping):
+        """
+        With `samples` set in the task config, every prediction holds several
+        completions. They are kept in `<column>_samples` columns, in the same 
+        order as the raw completions of the LM history `outputs`.
+
+        Args:
+            pred (dspy.Prediction): The prediction of the module.
+            mapping (dict): Mapping from output field to column name.
 
-    def load_model(self):
+        Returns:
+            dict: The list of sampled values for each output column.
         """
-        Load the LM backend for DSPy, either OpenAI or HuggingFace local.
+        if (self.config.task.samples.n or 1) <= 1:
+            return {}
+        return {f"{v}_samples": getattr(pred.completions, k, None) for k, v in mapping.items()}
+
+
+    def load_model(self, local_instance=None, configure=True):
+        """
+        Load the LM backend for DSPy: OpenAI, Anthropic, a local model server
+        or a local HuggingFace model.
+
+        Args:
+            local_instance (HuggingFaceLocalModel, optional): An already loaded
+                local model to use instead of loading it again.
+            configure (bool): Whether to set the LM as the global DSPy LM.
 
         Returns:
             dspy.LM: a DSPy-compatible language model interface
         """
+        lm_kwargs = dict(temperature=0.0, top_p=1.0, max_tokens=4096, stop=None, cache=False)
+
+        # Several samples per prompt, generated in a single call
+        samples = self.config.task.samples
+        if (samples.n or 1) > 1:
+            lm_kwargs.update(n=samples.n, 
+                             temperature=samples.temperature or 1.0, 
+                             top_p=samples.top_p or 1.0)
+
         if self.config.model.source == "openai":
             lm = dspy.LM(f'{self.config.model.source}/{self.config.model.name}', 
                         api_key=os.environ["OPENAI_API_KEY"], 
-                        temperature=0.0, top_p=1.0, max_tokens=4096, stop=None, cache=False)
+                        api_base=self.config.model.base_url or None, **lm_kwargs)
+        elif self.config.model.source == "anthropic":
+            lm = dspy.LM(f'anthropic/{self.config.model.name}', 
+                        api_key=os.environ["ANTHROPIC_API_KEY"], **lm_kwargs)
+        elif self.config.model.source == "server":
+            # Local model shared between experiments by scripts/serve.py
+            lm = dspy.LM(f'openai/{self.config.model.name}', 
+                        api_key="local", api_base=self.config.model.base_url, **lm_kwargs)
         else:
-            local_instance = load_model_agent(self.config)
-            lm = HugLM(local_instance,
-                       temperature=0.0, top_p=1.0, max_tokens=4096, stop=None, cache=False)
+            lm = HugLM(local_instance or self.load_local_instance(), **lm_kwargs)
 
-        dspy.configure(lm=lm)
+        # Keep only the recent calls in memory, older ones are streamed to disk
+        lm.history = HistoryStore(os.path.join(self.save_dir, "lm_history.jsonl"),
+                                  window=self.config.task.history_window or 100)
+
+        # Static prompt prefix first, so that providers can cache it
+        if self.config.model.prefix_caching:
+            self.adapter = PrefixCachingAdapter(cache_control=self.config.model.source == "anthropic")
+
+        if configure:
+            dspy.configure(lm=lm, adapter=self.adapter)
         return lm 
 
 
+    def load_local_instance(self):
+        """ The local model of the experiment, loaded unless it was shared by a previous one. """
+        if self.local_instance is None:
+            self.local_instance = load_model_agent(self.config)
+        return self.local_instance
+
+
 
 def load_model_agent(config):
     """
@@ -187,6 +477,24 @@ def load_model_agent(config):
 
 
 
+def index_outputs(rows):
+    """
+    DataFrame of the generated rows, indexed by their `index` in the dataset.
+    Empty (without columns) when the generation failed for every example.
+    """
+    if not rows:
+        return pd.DataFrame(index=pd.Index([], name="index"))
+    return pd.DataFrame(rows).set_index("index")
+
+
+def cached_prompt_tokens(usage):
+    """ Prompt tokens read from the provider cache, as reported in the usage of a call. """
+    details = usage.get("prompt_tokens_details")
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
 def extract_fields(output: str) -> dict:
     """
     Extracts delimited sections from an output string into a dict:
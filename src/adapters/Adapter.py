@@ -1,5 +1,8 @@
 from dspy.adapters.chat_adapter import ChatAdapter
 
+# Inputs shared by every submission of an exercise
+STATIC_FIELDS = ["problem_description", "items_description"]
+
 class NoSystemPromptAdapter(ChatAdapter):
     def format(self, signature, demos, inputs):
         messages = super().format(signature, demos, inputs)
@@ -7,3 +10,92 @@ class NoSystemPromptAdapter(ChatAdapter):
         if messages and messages[0]["role"] == "system":
             messages = messages[1:]
         return messages
+
+
+class PrefixCachingAdapter(ChatAdapter):
+    """
+    ChatAdapter whose prompts start with the longest possible static prefix,
+    so that providers can reuse their cache of it across requests.
+
+    The system message only depends on the signature. In the user message,
+    the inputs shared by all the submissions of an exercise (problem and rubric)
+    are moved before the inputs specific to each submission. With `cache_control`,
+    the system message and the static part of the user message are also marked
+    as cache breakpoints, as Anthropic models only cache marked prefixes.
+    """
+
+    def __init__(self, static_fields=None, cache_control=False):
+        """
+        Args:
+            static_fields (list of str, optional): Input fields placed first, in order.
+            cache_control (bool): Whether to add Anthropic cache breakpoints.
+        """
+        super().__init__()
+        self.static_fields = static_fields or STATIC_FIELDS
+        self.cache_control = cache_control
+        self.signatures = {}
+
+    def format(self, signature, demos, inputs):
+        signature, first_dynamic = self.static_first(signature)
+        messages = super().format(signature, demos, inputs)
+        if self.cache_control:
+            messages = add_cache_control(messages, first_dynamic)
+        return messages
+
+    def static_first(self, signature):
+        """ The signature with the static input fields first, and the first other input field. """
+        if signature not in self.signatures:
+            static = [f for f in self.static_fields if f in signature.input_fields]
+            dynamic = [f for f in signature.input_fields if f not in static]
+            reordered = signature
+            for name in dynamic:
+                field = signature.input_fields[name]
+                reordered = reordered.delete(name).append(name, field, field.annotation)
+            self.signatures[signature] = (reordered, dynamic[0] if dynamic and static else None)
+        return self.signatures[signature]
+
+
+def add_cache_control(messages, first_dynamic=None):
+    """
+    Mark the system message, and the user message up to the header of
+    `first_dynamic`, as Anthropic cache breakpoints.
+
+    Args:
+        messages (list of dict): ChatAdapter messages.
+        first_dynamic (str, optional): First input field which is not shared between requests.
+
+    Returns:
+        list of dict: The messages, with content blocks for the marked messages.
+    """
+    cached = {"type": "ephemeral"}
+    messages = [dict(m) for m in messages]
+    if messages and messages[0]["role"] == "system":
+        messages[0]["content"] = [{"type": "text", "text": messages[0]["content"], "cache_control": cached}]
+
+    text = messages[-1]["content"]
+    split = text.find(f"[[ ## {first_dynamic} ## ]]") if first_dynamic and isinstance(text, str) else -1
+    if split > 0:
+        messages[-1]["content"] = [
+            {"type": "text", "text": text[:split], "cache_control": cached},
+            {"type": "text", "text": text[split:]},
+        ]
+    return messages
+
+
+def format_prefilled(signature, inputs, field, prefill=""):
+    """
+    Format the ChatAdapter messages for a signature together with the
+    beginning of the answer, opened at the section of `field`. 
+    Used to score candidate values of a field instead of generating them.
+
+    Args:
+        signature (dspy.Signature): The signature to format.
+        inputs (dict): Values of the input fields.
+        field (str): The output field whose section starts the answer.
+        prefill (str): Text already written in that section.
+
+    Returns:
+        tuple: The messages and the answer prefix.
+    """
+    messages = ChatAdapter().format(signature, demos=[], inputs=inputs)
+    return messages, f"[[ ## {field} ## ]]\n{prefill}"
@@ -40,4 +40,42 @@ class CIPDataset():
             end = self.config.iloc.end
         data = data.iloc[start: end]
 
-        return data.reset_index(drop=True)
\ No newline at end of file
+        return data.reset_index(drop=True)
+
+    def iter_data(self, chunk_size):
+        """
+        Read the student data in chunks, joining each chunk with the rubrics.
+
+        Deduplication, zipf sampling and row ranges need the whole dataset:
+        with any of them configured, the data is loaded at once and then split.
+
+        Args:
+            chunk_size (int): Number of student rows read at a time.
+
+        Yields:
+            pd.DataFrame: The next chunk, in the same format as `get_data`.
+        """
+        if self.config.drop_duplicates or self.config.zipf_sampling or self.config.iloc:
+            data = self.get_data()
+            for start in range(0, len(data), chunk_size):
+                yield data.iloc[start: start + chunk_size]
+            return
+
+        rubrics_data = pd.read_csv(self.config.rubrics_data_path).set_index("diag_exercise")
+        for student_data in pd.read_csv(self.config.student_data_path, index_col=False, 
+                                        chunksize=chunk_size):
+            data = student_data.join(rubrics_data, on="diag_exercise")
+            data = data.dropna(how="all", axis=0)
+
+            if self.config.exclude_karel:
+                data = data[data["diag_exercise"] != "diagnostic3"]
+
+            if self.config.subset:
+                data = data[data["diag_exercise"].isin(self.config.subset)]
+
+            columns = [c for c in data.columns if "Unnamed" not in c]
+            data = data[columns]
+
+            if len(data):
+                yield data.reset_index(drop=True)
+
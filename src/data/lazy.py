@@ -0,0 +1,109 @@
+"""
+Lazy dspy datasets.
+
+Building the list of `dspy.Example` of a whole dataset up front keeps one
+Example per submission in memory, on top of the dataframe. The per-exercise
+strings (problem description and rubric) are identical for every student of
+an exercise, but `read_csv` gives each row its own copy of them.
+"""
+
+import sys
+
+
+def intern_columns(dataframe, columns):
+    """
+    Make every row of the given columns share a single string object per
+    distinct value, so memory grows with the number of exercises instead of
+    the number of submissions.
+
+    Args:
+        dataframe (pd.DataFrame): The dataset, modified in place.
+        columns (list of str): Columns holding per-exercise strings.
+
+    Returns:
+        pd.DataFrame: The same dataframe.
+    """
+    for column in columns:
+        if column in dataframe.columns:
+            dataframe[column] = dataframe[column].map(
+                lambda v: sys.intern(v) if isinstance(v, str) else v)
+    return dataframe
+
+
+class LazyDataset():
+    """
+    Sequence of `dspy.Example` built on demand from the rows of a dataframe.
+
+    Supports `len()`, iteration, random access and slicing (e.g. to split
+    the dataset into shards), which is all `Generate` and `dspy.Module.batch`
+    need from a dataset.
+    """
+
+    SHARED_COLUMNS = ["description", "items_description"]
+
+    def __init__(self, dataframe, build_example, shared_columns=None, intern=True):
+        """
+        Args:
+            dataframe (pd.DataFrame): The dataset.
+            build_example (callable): Builds the Example of a row
+                (e.g. `build_single_example` of a signature).
+            shared_columns (list of str, optional): Per-exercise columns to intern.
+            intern (bool): Whether to intern the shared columns.
+        """
+        if intern:
+            intern_columns(dataframe, shared_columns or self.SHARED_COLUMNS)
+        self.dataframe = dataframe
+        self.build_example = build_example
+
+    def __len__(self):
+        return len(self.dataframe)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyDataset(self.dataframe.iloc[index], self.build_example, intern=False)
+        return self.build_example(self.dataframe.iloc[index])
+
+    def __iter__(self):
+        for row in self.dataframe.itertuples(index=False):
+            yield self.build_example(row)
+
+    def shard(self, index, num_shards):
+        """ The `index`-th of `num_shards` interleaved shards of the dataset. """
+        return self[index::num_shards]
+
+
+class GroupedDataset():
+    """
+    Sequence of `dspy.Example` built on demand, one for each group of rows
+    sharing the same values in the given columns (e.g. several feedbacks
+    written for the same submission).
+    """
+
+    def __init__(self, dataframe, columns, build_example, max_size=None):
+        """
+        Args:
+            dataframe (pd.DataFrame): The dataset.
+            columns (list of str): Columns defining the groups.
+            build_example (callable): Builds the Example of a group from its rows.
+            max_size (int, optional): Larger groups are split into several examples.
+        """
+        intern_columns(dataframe, LazyDataset.SHARED_COLUMNS)
+        self.dataframe = dataframe
+        self.build_example = build_example
+
+        indices = dataframe.groupby(columns, sort=False, dropna=False).indices
+        self.groups = []
+        for positions in indices.values():
+            positions = sorted(positions)
+            size = max_size or len(positions)
+            self.groups.extend(positions[i: i + size] for i in range(0, len(positions), size))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __getitem__(self, index):
+        return self.build_example(self.dataframe.iloc[self.groups[index]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
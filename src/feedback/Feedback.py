@@ -1,8 +1,74 @@
+from warnings import warn
+from tqdm import tqdm
 from src.Generate import Generate
-from src.feedback.signatures.GenerateFeedback import FeedbackModule
+from src.feedback.signatures.GenerateFeedback import FeedbackModule, GenerateFeedback
+from src.feedback.scoring import (
+    grade_by_likelihood, grading_agreement,
+    options_from_gradings, parse_rubric_options
+)
+from src.utils.files import save_json
 
 class Feedback(Generate):
 
     def __init__(self, config, test_run):
         super().__init__(config, test_run, FeedbackModule)
-    
\ No newline at end of file
+
+    def run(self):
+        if self.config.task.scoring:
+            return self.score()
+        return super().run()
+
+    def score(self):
+        """
+        Grade every submission by log-likelihood instead of generating
+        the reasoning and the grading (see `src.feedback.scoring`).
+
+        The grading is saved in the same format as the generated one, in the
+        `scored_grading` column unless `outputs.grading` says otherwise. Its
+        agreement with the `reference` column is reported in the run metrics.
+        By default, the reference is the `grading` column of the generative
+        grading run used as the dataset, so that both graders are compared
+        on the same submissions.
+        """
+        dataframe = self.load_dataframe()
+        local_instance = self.load_local_instance()
+        signature = GenerateFeedback.delete("feedback")
+
+        column = self.config.task.outputs.grading or "scored_grading"
+        reference = self.config.task.reference or "grading"
+        if column == reference:
+            raise ValueError(f"The scored grading would overwrite the {reference} reference column, "
+                             "set another column in `outputs.grading`")
+        if reference not in dataframe.columns:
+            warn(f"No {reference} column in the dataset, the agreement is not reported")
+            reference = None
+        references = dataframe[reference].copy() if reference else None
+        observed = options_from_gradings(dataframe, reference) if reference else {}
+
+        rubrics, gradings = {}, []
+        for row in tqdm(dataframe.itertuples(index=False), total=len(dataframe)):
+            if row.items_description not in rubrics:
+                rubrics[row.items_description] = parse_rubric_options(row.items_description)
+            options = rubrics[row.items_description] or observed.get(row.diag_exercise)
+            if not options:
+                warn(f"Could not find the rubric options for exercise {row.diag_exercise}")
+                gradings.append(None)
+                continue
+
+            inputs = {
+                "problem_description": row.description,
+                "student_code": row.code,
+                "items_description": row.items_description,
+            }
+            gradings.append(grade_by_likelihood(local_instance, signature, inputs, options))
+
+        dataframe[column] = gradings
+        dataframe.to_csv(self.results_save_path)
+        print("Created dataframe", dataframe, dataframe.columns)
+
+        metrics = local_instance.get_metrics()
+        if reference:
+            metrics["agreement"] = {"reference": reference,
+                                    **grading_agreement(dataframe[column], references)}
+        print("Run metrics", metrics)
+        save_json(metrics, self.metrics_save_path)
@@ -0,0 +1,161 @@
+"""
+Grading by log-likelihood: instead of generating the reasoning and the
+grading, every option of every rubric item is scored as a continuation
+of the grading JSON and the most likely option is selected.
+"""
+
+import ast
+import json
+import re
+from collections import defaultdict
+from src.adapters.Adapter import format_prefilled
+
+ITEM_PATTERN = re.compile(r"^\s*(?:rubric\s+)?item\s*(?:id)?\s*[:#]?\s*([\w.-]+)", re.IGNORECASE)
+OPTION_PATTERN = re.compile(r"^\s*[-*]?\s*option\s*(?:id)?\s*[:#]?\s*(\d+)", re.IGNORECASE)
+
+
+def parse_literal(value):
+    """ Parse a dict or list stored as JSON or as a Python literal (e.g. read back from a csv). """
+    if isinstance(value, (dict, list)):
+        return value
+    if not isinstance(value, str):
+        return None
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            return parse(value)
+        except Exception:
+            continue
+    return None
+
+
+def parse_rubric_options(items_description):
+    """
+    Extract the rubric item IDs and their option IDs from a rubric description.
+
+    Supports rubrics stored as JSON (or Python literals), either as a mapping
+    from item ID to its options or as a list of items with an `id` and `options`,
+    and plain text rubrics where items and options are introduced by
+    `Item <id>` and `Option <id>` lines.
+
+    Args:
+        items_description (str): The rubric description given to the model.
+
+    Returns:
+        dict: Mapping from item ID (str) to the list of option IDs (int).
+    """
+    rubric = parse_literal(items_description)
+    if isinstance(rubric, list):
+        rubric = {item.get("id"): item.get("options") for item in rubric if isinstance(item, dict)}
+    if isinstance(rubric, dict):
+        options = {}
+        for item, item_options in rubric.items():
+            if isinstance(item_options, dict) and "options" in item_options:
+                item_options = item_options["options"]
+            if isinstance(item_options, dict):
+                options[str(item)] = [int(o) for o in item_options]
+            elif isinstance(item_options, list):
+                options[str(item)] = list(range(len(item_options)))
+        if options:
+            return options
+
+    options = {}
+    item = None
+    for line in str(items_description).splitlines():
+        option = OPTION_PATTERN.match(line)
+        if option and item is not None:
+            options[item].append(int(option.group(1)))
+            continue
+        match = ITEM_PATTERN.match(line)
+        if match:
+            item = match.group(1).rstrip(".")
+            options[item] = []
+
+    return {item: values for item, values in options.items() if values}
+
+
+def options_from_gradings(dataframe, column):
+    """
+    Fallback when the rubric cannot be parsed: the item and option IDs
+    observed in existing gradings of each exercise.
+
+    Args:
+        dataframe (pd.DataFrame): Dataset with a `diag_exercise` column.
+        column (str): Column holding the gradings.
+
+    Returns:
+        dict: Mapping from exercise to its rubric options.
+    """
+    observed = defaultdict(lambda: defaultdict(set))
+    for exercise, grading in zip(dataframe["diag_exercise"], dataframe[column]):
+        grading = parse_literal(grading)
+        if not isinstance(grading, dict):
+            continue
+        for item, option in grading.items():
+            observed[exercise][str(item)].add(int(option))
+
+    return {exercise: {item: sorted(options) for item, options in items.items()}
+            for exercise, items in observed.items()}
+
+
+def grade_by_likelihood(local_instance, signature, inputs, options, field="grading"):
+    """
+    Grade a submission by scoring every option of every rubric item with the
+    local model, in one batched forward pass over the shared prompt.
+
+    Args:
+        local_instance (HuggingFaceLocalModel): The local model.
+        signature (dspy.Signature): Signature whose output is the grading field.
+        inputs (dict): Values of the input fields.
+        options (dict): Mapping from item ID to its option IDs.
+        field (str): Name of the grading output field.
+
+    Returns:
+        dict: The grading, mapping each item ID to the most likely option ID.
+    """
+    messages, prefix = format_prefilled(signature, inputs, field, prefill="{")
+
+    # The trailing comma closes the number, so that "1" does not compete with "10"
+    candidates = [(item, option) for item, item_options in options.items() for option in item_options]
+    continuations = [f'"{item}": {option},' for item, option in candidates]
+    scores = local_instance.score_continuations(messages, prefix, continuations)
+
+    best = {}
+    for (item, option), score in zip(candidates, scores):
+        if item not in best or score > best[item][1]:
+            best[item] = (option, score)
+
+    return {item: option for item, (option, _) in best.items()}
+
+
+def grading_agreement(predictions, references):
+    """
+    Agreement between two series of gradings.
+
+    Args:
+        predictions (iterable of dict): Gradings to evaluate.
+        references (iterable of dict or str): Reference gradings.
+
+    Returns:
+        dict: Item-level accuracy, exact-match rate over submissions, and counts.
+    """
+    items, correct_items, submissions, exact = 0, 0, 0, 0
+    for prediction, reference in zip(predictions, references):
+        prediction, reference = parse_literal(prediction), parse_literal(reference)
+        if not isinstance(prediction, dict) or not isinstance(reference, dict):
+            continue
+
+        prediction = {str(k): str(v) for k, v in prediction.items()}
+        reference = {str(k): str(v) for k, v in reference.items()}
+        matches = sum(prediction.get(k) == v for k, v in reference.items())
+
+        items += len(reference)
+        correct_items += matches
+        submissions += 1
+        exact += matches == len(reference)
+
+    return {
+        "item_accuracy": correct_items / items if items else None,
+        "exact_match": exact / submissions if submissions else None,
+        "num_items": items,
+        "num_submissions": submissions,
+    }
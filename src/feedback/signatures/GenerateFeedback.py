@@ -1,5 +1,6 @@
 import dspy 
 from typing import Dict
+from src.data.lazy import LazyDataset
 
 class GenerateFeedback(dspy.Signature):
     """
@@ -62,17 +63,16 @@ class FeedbackModule(dspy.Module):
 
     @classmethod
     def build_dspy_dataset(cls, dataframe):
-        dspy_dataset = []
-        for row in dataframe.itertuples(index=False):
-            dspy_dataset.append(
-                dspy.Example(
-                    problem_description=row.description,
-                    student_code=row.code,
-                    items_description=row.items_description,
-                ).with_inputs(
-                    "problem_description", 
-                    "student_code", 
-                    "items_description"
-                ))
-
-        return dspy_dataset
\ No newline at end of file
+        return LazyDataset(dataframe, cls.build_single_example)
+
+    @classmethod
+    def build_single_example(cls, row):
+        return dspy.Example(
+                problem_description=row.description,
+                student_code=row.code,
+                items_description=row.items_description,
+            ).with_inputs(
+                "problem_description", 
+                "student_code", 
+                "items_description"
+            )
\ No newline at end of file
@@ -1,8 +1,242 @@
-from src.judging.signatures.GAGJudgingSignature import JudgingModule
-from src.Generate import Generate
+from collections import Counter
+from dotmap import DotMap
+from warnings import warn
+from tqdm import tqdm
+from src.judging.signatures.GAGJudgingSignature import JudgingModule, GAGJudgingSignature
+from src.judging.signatures.MultiGAGJudgingSignature import MultiJudgingModule
+from src.judging.logprobs import (
+    calibrate, escalation_reason, fast_signature, fit_temperature,
+    judging_criteria, local_verdicts, remote_verdicts, verdict_agreement
+)
+from src.Generate import Generate, index_outputs, load_model_agent
+from src.model.RemoteModel import RemoteModel
+from src.adapters.Adapter import PrefixCachingAdapter
+from src.utils.files import save_json
 
 class Judging(Generate):
 
     def __init__(self, config, test_run):
-        super().__init__(config, test_run, JudgingModule, can_batch=True)
-        
\ No newline at end of file
+        module_cls = MultiJudgingModule if config.task.multi else JudgingModule
+        super().__init__(config, test_run, module_cls, can_batch=True)
+
+    def run(self):
+        if self.config.task.fast:
+            return self.fast_judge()
+        if self.config.task.cascade:
+            return self.cascade_judge()
+        return super().run()
+
+    def setup(self, configure=True):
+        module, generate = super().setup(configure)
+        if self.config.task.multi:
+            generate = self._multi_generate
+        return module, generate
+
+    def build_dspy_dataset(self, dataframe):
+        if self.config.task.multi:
+            return self.module_cls.build_dspy_dataset(
+                dataframe, max_candidates=self.config.task.multi.max_candidates or None)
+        return super().build_dspy_dataset(dataframe)
+
+    def _multi_generate(self, dataset, module):
+        """
+        Judge all the feedbacks written for the same submission in a single call
+        (e.g. the feedbacks of several checkpoints), so that the submission, rubric
+        and reference feedback are only sent once. The evaluations are then split
+        back to the rows of the feedbacks, which share the judge reasoning.
+
+        Args:
+            dataset (GroupedDataset): One example per submission.
+            module (MultiJudgingModule): The judging module.
+
+        Returns:
+            pd.DataFrame: A DataFrame indexed by row position, as `_generate`.
+        """
+        mapping = self.config.task.outputs.toDict()
+        column = mapping.get("evaluations", "evaluation")
+
+        output_dataframe = []
+        for positions, x in zip(dataset.groups, tqdm(dataset)):
+            try:
+                pred = module(**x.inputs())
+                evaluations = pred.evaluations
+            except Exception:
+                warn(f"Generation failed for submission {x}")
+                continue
+
+            if not isinstance(evaluations, list) or len(evaluations) != len(positions):
+                warn(f"Expected {len(positions)} evaluations, got {evaluations}")
+                continue
+
+            outputs = {v: getattr(pred, k) for k, v in mapping.items() if k != "evaluations"}
+            for position, evaluation in zip(positions, evaluations):
+                output_dataframe.append({
+                    **outputs, column: evaluation, "index": position,
+                    "num_candidates": len(positions), "history_index": len(self.lm.history) - 1
+                })
+
+        return index_outputs(output_dataframe)
+
+    def fast_judge(self):
+        """
+        Judge every feedback from the judge's probabilities of `true` and `false`
+        for each criterion, without generating the reasoning
+        (see `src.judging.logprobs`). Local judges score both verdicts with
+        `HuggingFaceLocalModel`, remote judges use the provider log-probabilities.
+
+        With `reference_sample` set in the `fast` task config, the full reasoning
+        judge also evaluates a random sample of the dataset: the agreement with
+        its verdicts is reported in the run metrics, and the probabilities are
+        calibrated on that sample with temperature scaling.
+
+        Remote judges whose provider does not return log-probabilities
+        (Anthropic) judge with the full reasoning instead.
+        """
+        local_instance, remote = None, None
+        if self.config.model.source != "local":
+            remote = RemoteModel(self.config.model)
+            if not remote.supports_logprobs:
+                warn(f"{self.config.model.source} models do not return log-probabilities, "
+                     "judging with the full reasoning instead")
+                return super().run()
+
+        dataframe = self.load_dataframe()
+        signature = fast_signature(GAGJudgingSignature)
+        criteria = judging_criteria(GAGJudgingSignature)
+        column = self.config.task.outputs.evaluation or "evaluation"
+        fast = self.config.task.fast
+
+        if remote is None:
+            local_instance = self.load_local_instance()
+            judge = lambda inputs: local_verdicts(local_instance, signature, inputs, criteria)
+        else:
+            gen_kwargs = {"temperature": 0.0, "top_p": 1.0, "max_tokens": 256}
+            adapter = None
+            if self.config.model.prefix_caching:
+                adapter = PrefixCachingAdapter(cache_control=self.config.model.source == "anthropic")
+            judge = lambda inputs: remote_verdicts(remote, signature, inputs, criteria, gen_kwargs, adapter)
+
+        dataset = self.module_cls.build_dspy_dataset(dataframe)
+        probabilities = [judge(x.inputs().toDict()) for x in tqdm(dataset)]
+
+        metrics = {"criteria": criteria}
+        if fast.reference_sample:
+            sample = dataframe.sample(n=min(fast.reference_sample, len(dataframe)),
+                                      random_state=self.config.seed or 42)
+            self.lm = self.load_model(local_instance)
+            reference = self._generate(self.module_cls.build_dspy_dataset(sample), self.module_cls())
+            if column not in reference:
+                warn("The reference judge failed on every example of the sample")
+            labels = {sample.index[i]: evaluation for i, evaluation in reference.get(column, {}).items()}
+
+            metrics["agreement"], temperatures = {}, {}
+            for c in criteria:
+                pairs = [(probabilities[i][c], labels[i].get(c)) for i in labels
+                         if isinstance(labels[i], dict) and probabilities[i][c] is not None
+                         and labels[i].get(c) is not None]
+                if not pairs:
+                    continue
+                metrics["agreement"][c] = sum((p >= 0.5) == bool(l) for p, l in pairs) / len(pairs)
+                temperatures[c] = fit_temperature(*zip(*pairs))
+
+            # Temperature scaling keeps the verdicts, only the probabilities change
+            probabilities = [{c: calibrate(p, temperatures.get(c, 1.0)) for c, p in probs.items()}
+                             for probs in probabilities]
+            metrics["temperatures"] = temperatures
+            metrics["reference_sample"] = len(labels)
+
+        dataframe[column] = [{c: p >= 0.5 for c, p in probs.items() if p is not None}
+                             for probs in probabilities]
+        dataframe[f"{column}_probabilities"] = probabilities
+        dataframe.to_csv(self.results_save_path)
+        print("Created dataframe", dataframe, dataframe.columns)
+
+        if local_instance is not None:
+            metrics.update(local_instance.get_metrics())
+        if remote is not None:
+            metrics.update(remote.get_metrics())
+        print("Run metrics", metrics)
+        save_json(metrics, self.metrics_save_path)
+
+    def cascade_judge(self):
+        """
+        Cascaded judging: a local model judges every feedback first from its
+        probabilities of `true` and `false` (as `fast_judge`), and only the
+        uncertain cases are escalated to the judge of the model config, which
+        evaluates them with the full reasoning.
+
+        A feedback is escalated when the local confidence in any verdict is below
+        the `threshold` of the `cascade` task config, or when the verdicts are
+        inconsistent (e.g. helpful but not correct). With `baseline_sample` set,
+        the remote judge also evaluates a random sample of the dataset, and the
+        agreement of the cascade with it is reported in the run metrics.
+        """
+        dataframe = self.load_dataframe().reset_index(drop=True)
+        cascade = self.config.task.cascade
+        signature = fast_signature(GAGJudgingSignature)
+        criteria = judging_criteria(GAGJudgingSignature)
+        mapping = self.config.task.outputs.toDict()
+        column = mapping.get("evaluation", "evaluation")
+        threshold = cascade.threshold or 0.9
+        implies = cascade.implies.toDict() if cascade.implies else {"helpfulness": "correctness"}
+
+        local_config = DotMap(self.config.toDict())
+        local_config.model = cascade.model
+        local_instance = load_model_agent(local_config)
+
+        dataset = self.module_cls.build_dspy_dataset(dataframe)
+        probabilities = [local_verdicts(local_instance, signature, x.inputs().toDict(), criteria)
+                         for x in tqdm(dataset)]
+        local = [{c: p >= 0.5 for c, p in probs.items() if p is not None} for probs in probabilities]
+        reasons = [escalation_reason(probs, threshold, implies) for probs in probabilities]
+        escalated = [i for i, reason in enumerate(reasons) if reason]
+
+        baseline = []
+        if cascade.baseline_sample:
+            sample = dataframe.sample(n=min(cascade.baseline_sample, len(dataframe)),
+                                      random_state=self.config.seed or 42)
+            baseline = sample.index.tolist()
+
+        # Escalated and baseline feedbacks are judged together by the remote judge
+        rows = sorted(set(escalated) | set(baseline))
+        self.lm = self.load_model()
+        remote = {}
+        if rows:
+            outputs = self._generate(self.module_cls.build_dspy_dataset(dataframe.iloc[rows]), 
+                                     self.module_cls())
+            remote = {rows[i]: output for i, output in outputs.to_dict("index").items()}
+
+        verdicts, sources = list(local), ["local"] * len(local)
+        for i in escalated:
+            if isinstance(remote.get(i, {}).get(column), dict):
+                verdicts[i], sources[i] = remote[i][column], "remote"
+
+        dataframe[column] = verdicts
+        dataframe[f"{column}_source"] = sources
+        dataframe[f"{column}_probabilities"] = probabilities
+        dataframe["escalation_reason"] = reasons
+        for k, v in mapping.items():
+            if k != "evaluation":
+                dataframe[v] = [remote[i].get(v) if sources[i] == "remote" else None 
+                                for i in range(len(dataframe))]
+        dataframe.to_csv(self.results_save_path)
+        print("Created dataframe", dataframe, dataframe.columns)
+
+        metrics = {
+            "criteria": criteria,
+            "threshold": threshold,
+            "escalation_rate": len(escalated) / max(len(dataframe), 1),
+            "escalation_reasons": dict(Counter(r for r in reasons if r)),
+            "remote_calls": len(rows),
+        }
+        if baseline:
+            references = [remote.get(i, {}).get(column) for i in baseline]
+            metrics["baseline_sample"] = len(baseline)
+            metrics["agreement"] = verdict_agreement([verdicts[i] for i in baseline], references, criteria)
+            metrics["local_agreement"] = verdict_agreement([local[i] for i in baseline], references, criteria)
+
+        metrics.update(local_instance.get_metrics())
+        metrics.update(self.get_metrics())
+        print("Run metrics", metrics)
+        save_json(metrics, self.metrics_save_path)
+
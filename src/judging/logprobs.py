@@ -0,0 +1,181 @@
+"""
+Fast judging from next-token probabilities: instead of generating the
+reasoning and the evaluation, the probability of `true` and `false`
+is read directly for each boolean criterion of the evaluation JSON.
+"""
+
+import math
+import re
+import numpy as np
+from warnings import warn
+from dspy.adapters.chat_adapter import ChatAdapter
+from src.adapters.Adapter import format_prefilled
+from src.model.retry import GenerationError
+
+CRITERION_PATTERN = re.compile(r'"(\w+)"\s*:\s*true\s*/\s*false')
+KEY_BEFORE_VALUE = re.compile(r'"(\w+)"\s*:\s*$')
+
+
+def judging_criteria(signature):
+    """
+    The boolean criteria a judging signature asks for, read from the
+    evaluation JSON template of its instructions.
+
+    Args:
+        signature (dspy.Signature): The judging signature.
+
+    Returns:
+        list of str: The criteria, in order.
+    """
+    return list(dict.fromkeys(CRITERION_PATTERN.findall(signature.instructions)))
+
+
+def fast_signature(signature):
+    """ The judging signature without the reasoning output, answering with the evaluation only. """
+    if "reasoning" in signature.output_fields:
+        return signature.delete("reasoning")
+    return signature
+
+
+def local_verdicts(local_instance, signature, inputs, criteria, field="evaluation"):
+    """
+    Probability of `true` for each criterion according to a local model,
+    with a single batched forward pass over the shared prompt.
+
+    Args:
+        local_instance (HuggingFaceLocalModel): The local judge.
+        signature (dspy.Signature): Judging signature without reasoning.
+        inputs (dict): Values of the input fields.
+        criteria (list of str): The criteria to judge.
+        field (str): Name of the evaluation output field.
+
+    Returns:
+        dict: Mapping from criterion to the probability of `true`.
+    """
+    messages, prefix = format_prefilled(signature, inputs, field, prefill="{")
+    continuations = [f'"{c}": {verdict},' for c in criteria for verdict in ("true", "false")]
+    scores = local_instance.score_continuations(messages, prefix, continuations)
+
+    return {c: sigmoid(scores[2 * i] - scores[2 * i + 1]) for i, c in enumerate(criteria)}
+
+
+def remote_verdicts(remote_model, signature, inputs, criteria, gen_kwargs, adapter=None):
+    """
+    Probability of `true` for each criterion according to a remote model,
+    read from the log-probabilities of the generated evaluation JSON.
+
+    Args:
+        remote_model (RemoteModel): The remote judge.
+        signature (dspy.Signature): Judging signature without reasoning.
+        inputs (dict): Values of the input fields.
+        criteria (list of str): The criteria to judge.
+        gen_kwargs (dict): Generation arguments.
+        adapter (ChatAdapter, optional): Adapter formatting the messages.
+
+    Returns:
+        dict: Mapping from criterion to the probability of `true`
+            (None for criteria missing from the answer).
+    """
+    messages = (adapter or ChatAdapter()).format(signature, demos=[], inputs=inputs)
+    try:
+        _, logprobs = remote_model.query_logprobs(messages, gen_kwargs)
+    except GenerationError as e:
+        # Recorded by the model, the verdicts are left missing
+        warn(str(e))
+        return {c: None for c in criteria}
+
+    verdicts, text = {}, ""
+    for token in logprobs:
+        key = KEY_BEFORE_VALUE.search(text)
+        value = token["token"].strip().lower()
+        if key and key.group(1) in criteria and value in ("true", "false"):
+            alternatives = token["top_logprobs"] or [token]
+            p_true = sum(math.exp(a["logprob"]) for a in alternatives if a["token"].strip().lower() == "true")
+            p_false = sum(math.exp(a["logprob"]) for a in alternatives if a["token"].strip().lower() == "false")
+            verdicts[key.group(1)] = p_true / (p_true + p_false) if p_true + p_false else float(value == "true")
+        text += token["token"]
+
+    return {c: verdicts.get(c) for c in criteria}
+
+
+def sigmoid(x):
+    return 1 / (1 + math.exp(-x))
+
+
+def fit_temperature(probabilities, labels):
+    """
+    Temperature scaling: find the temperature of the verdict logits which
+    best fits the labels (e.g. the verdicts of the full reasoning judge).
+
+    Args:
+        probabilities (list of float): Probabilities of `true`.
+        labels (list of bool): Reference verdicts.
+
+    Returns:
+        float: The temperature minimizing the negative log-likelihood.
+    """
+    p = np.clip(np.asarray(probabilities, dtype=float), 1e-6, 1 - 1e-6)
+    y = np.asarray(labels, dtype=float)
+    logits = np.log(p / (1 - p))
+
+    best, best_nll = 1.0, float("inf")
+    for temperature in np.logspace(-1, 1.5, 60):
+        q = np.clip(1 / (1 + np.exp(-logits / temperature)), 1e-6, 1 - 1e-6)
+        nll = -np.mean(y * np.log(q) + (1 - y) * np.log(1 - q))
+        if nll < best_nll:
+            best, best_nll = float(temperature), nll
+
+    return best
+
+
+def calibrate(probability, temperature):
+    if probability is None:
+        return None
+    p = min(max(probability, 1e-6), 1 - 1e-6)
+    return sigmoid(math.log(p / (1 - p)) / temperature)
+
+
+def escalation_reason(probabilities, threshold, implies=None):
+    """
+    Why the verdicts of a cheap judge should be checked by a stronger one.
+
+    Args:
+        probabilities (dict): Probability of `true` for each criterion.
+        threshold (float): Minimum confidence, i.e. probability of the chosen verdict.
+        implies (dict, optional): Criteria which can only be `true` when another one
+            is (e.g. feedback can only be helpful if it is correct).
+
+    Returns:
+        str or None: "missing", "low_confidence" or "inconsistent", None to keep the verdicts.
+    """
+    if any(p is None for p in probabilities.values()):
+        return "missing"
+    if any(max(p, 1 - p) < threshold for p in probabilities.values()):
+        return "low_confidence"
+    for criterion, required in (implies or {}).items():
+        if probabilities.get(criterion, 0) >= 0.5 and probabilities.get(required, 1) < 0.5:
+            return "inconsistent"
+    return None
+
+
+def verdict_agreement(predictions, references, criteria):
+    """
+    Agreement of the verdicts of two judges on each criterion.
+
+    Args:
+        predictions (iterable of dict): Verdicts to evaluate.
+        references (iterable of dict): Reference verdicts.
+        criteria (list of str): The criteria to compare.
+
+    Returns:
+        dict: Mapping from criterion to the fraction of matching verdicts.
+    """
+    pairs = [(p, r) for p, r in zip(predictions, references)
+             if isinstance(p, dict) and isinstance(r, dict)]
+    agreement = {}
+    for c in criteria:
+        matches = [bool(p[c]) == bool(r[c]) for p, r in pairs if c in p and c in r]
+        if matches:
+            agreement[c] = sum(matches) / len(matches)
+    return agreement
+
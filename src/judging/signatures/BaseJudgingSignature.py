@@ -1,5 +1,6 @@
 import dspy
 from typing import Dict
+from src.data.lazy import LazyDataset
 
 class BaseJudgingSignature(dspy.Signature):
     """
@@ -65,9 +66,11 @@ class BaseJudgingSignature(dspy.Signature):
 
     @classmethod
     def build_dspy_dataset(cls, dataframe):
-        dspy_dataset = []
-        for row in dataframe.itertuples(index=False):
-            dspy_dataset.append(dspy.Example(
+        return LazyDataset(dataframe, cls.build_single_example)
+
+    @classmethod
+    def build_single_example(cls, row):
+        return dspy.Example(
                 problem_description=row.description,
                 student_code=row.code,
                 items_description=row.items_description,
@@ -75,7 +78,5 @@ class BaseJudgingSignature(dspy.Signature):
             ).with_inputs("problem_description", 
                             "student_code", 
                             "items_description",
-                            "evaluated_feedback"))
-
-        return dspy_dataset
+                            "evaluated_feedback")
 
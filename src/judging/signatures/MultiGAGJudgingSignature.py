@@ -0,0 +1,115 @@
+import dspy
+from typing import Dict, List
+from src.data.lazy import GroupedDataset
+
+class MultiGAGJudgingSignature(dspy.Signature):
+    """
+    # Context and Input 
+
+    You are a computer science professor for an introductory Python programming course.
+
+    You will be provided with:
+    - A problem description.
+    - A student solution.
+    - A grading rubric used to evaluate the quality of student solutions.
+    - A list of feedback responses written by different teaching assistants (TAs) to evaluate.
+        - Each TA was instructed to highlight all positive aspects of the student solution, mentioning every satisfied rubric item.
+        - If there were mistakes, each TA was instructed to explain only the first two mistakes, corresponding to the first two unmet rubric items in order.
+
+    Your task is to evaluate the quality of each feedback response, independently of the others.
+    To help you in that task, you are also given:
+    - A reference feedback (an example of high-quality feedback for the same student solution).
+
+    # Evaluation Criteria
+
+    When evaluating a feedback response, consider these two binary dimensions:
+
+    1. **Correctness:**  
+        - Does the feedback accurately identify all positive aspects of the student solution?
+        - If there are mistakes in the student solution, does the feedback explain only the first two mistakes?
+    2. **Helpfulness:**  
+        - Is the feedback communicated in a way that a typical student would find useful for improving their solution?
+        - Focus on whether the information is actionable, specific, and enables learning.
+
+    **Only feedback that is fully correct can be rated as helpful. If any part of the feedback is incorrect or misleading, helpfulness must be rated as `false`.**
+
+    # Task
+
+    ## Reasoning
+
+    For each feedback response, in order, follow these steps, reasoning carefully at each stage:
+    - Assess the correctness of the evaluated feedback using the provided reference feedback.
+    - Then, consider helpfulness using once again the reference feedback as a guide for what constitutes high-quality feedback.  
+    The evaluated feedback does not need to match the reference exactly; there may be multiple equally valid or even better ways to be helpful. 
+    Do not compare the feedback responses with each other.
+
+    ## Evaluations (output)
+
+    Provide your final assessment as a JSON list with one dictionary per feedback response, in the order they were given, with `true` or `false` for each criterion:
+
+    [
+        {
+            "correctness": true/false,
+            "helpfulness": true/false,
+        },
+        ...
+    ]
+    """
+
+    problem_description = dspy.InputField()
+    student_code = dspy.InputField()
+    items_description = dspy.InputField()
+    reference_feedback = dspy.InputField()
+    evaluated_feedbacks: List[str] = dspy.InputField()
+
+    reasoning = dspy.OutputField()
+    evaluations: List[Dict[str, bool]] = dspy.OutputField()
+
+    # Rows with the same values share every input but the evaluated feedback
+    SUBMISSION_COLUMNS = ["diag_exercise", "code", "teacher_feedback"]
+
+    @classmethod
+    def build_dspy_dataset(cls, dataframe, max_candidates=None):
+        return GroupedDataset(dataframe, cls.SUBMISSION_COLUMNS, 
+                              cls.build_group_example, max_size=max_candidates)
+
+    @classmethod
+    def build_group_example(cls, rows):
+        row = rows.iloc[0]
+        return dspy.Example(
+                problem_description=row.description,
+                student_code=row.code,
+                items_description=row.items_description,
+                reference_feedback=row.teacher_feedback,
+                evaluated_feedbacks=list(rows.feedback),
+            ).with_inputs("problem_description", 
+                            "student_code", 
+                            "items_description",
+                            "reference_feedback",
+                            "evaluated_feedbacks")
+
+
+class MultiJudgingModule(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.predictor = dspy.ChainOfThought(MultiGAGJudgingSignature)
+
+    def forward(
+        self,
+        problem_description,
+        student_code,
+        items_description,
+        reference_feedback,
+        evaluated_feedbacks,
+    ):
+        return self.predictor(
+            problem_description=problem_description,
+            student_code=student_code,
+            items_description=items_description,
+            reference_feedback=reference_feedback,
+            evaluated_feedbacks=evaluated_feedbacks,
+        )
+
+    @classmethod
+    def build_dspy_dataset(cls, dataframe, max_candidates=None):
+        return MultiGAGJudgingSignature.build_dspy_dataset(dataframe, max_candidates)
@@ -1,5 +1,6 @@
 import dspy
 from typing import Dict
+from src.data.lazy import LazyDataset
 
 class SAGJudgingSignature(dspy.Signature):
     """
@@ -72,23 +73,7 @@ class SAGJudgingSignature(dspy.Signature):
 
     @classmethod
     def build_dspy_dataset(cls, dataframe):
-        dspy_dataset = []
-        for row in dataframe.itertuples(index=False):
-            dspy_dataset.append(dspy.Example(
-                problem_description=row.description,
-                student_code=row.code,
-                items_description=row.items_description,
-                reference_grading=row.teacher_grading,
-                reference_feedback=row.teacher_feedback,
-                evaluated_feedback=row.feedback,
-            ).with_inputs("problem_description", 
-                            "student_code", 
-                            "items_description",
-                            "reference_grading",
-                            "reference_feedback",
-                            "evaluated_feedback"))
-
-        return dspy_dataset
+        return LazyDataset(dataframe, cls.build_single_example)
 
     @classmethod
     def build_single_example(cls, row):
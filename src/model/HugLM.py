@@ -17,6 +17,10 @@ class HugLM(BaseLM):
         self.local_instance = local_instance
         self.config = self.local_instance.config
         super().__init__(self.config.name, model_type, temperature, max_tokens, cache, **kwargs)
+        # Signature of the active predictor, used to constrain the output format
+        self.signature = None
+        # Adapter of the local model to generate with, when several are loaded
+        self.adapter = None
 
     def forward(self, prompt, messages=None, **kwargs):
         """
@@ -29,39 +33,59 @@ class HugLM(BaseLM):
         # Build generation kwargs, as before
         gen_kwargs = {**self.kwargs}
         gen_kwargs.update(kwargs)
+        adapter = gen_kwargs.pop("adapter", None) or self.adapter
         gen_kwargs = adapt_gen_kwargs(gen_kwargs)
 
         # Generate response(s)
-        generations = self.local_instance.query(messages, gen_kwargs)
-        if not isinstance(generations, list):
-            generations = [generations]
+        choices = self.local_instance.batch_generate([messages], gen_kwargs, self.signature, adapter)[0]
+        response = chat_completion(choices, adapter or self.config.name)
+        
+        return DotMap(response)
+
+
+def chat_completion(choices, model):
+    """
+    Build an OpenAI chat completion response from the generations of a local model.
+
+    Token counts come from generation: the prompt is counted once, with
+    its chat template, and every returned sequence adds its completion.
 
-        # Simulate token usage (optional: use tokenizer to compute exact if you wish)
-        prompt_tokens = sum(len(self.local_instance.tokenizer.encode(msg['content'])) for msg in messages)
-        completion_tokens_list = [len(self.local_instance.tokenizer.encode(gen)) for gen in generations]
-        total_tokens_list = [prompt_tokens + ct for ct in completion_tokens_list]
+    Args:
+        choices (list of dict): Generations of one conversation (see 
+            `HuggingFaceLocalModel.batch_generate`).
+        model (str): Name of the model.
 
-        response = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": self.config.name,
-            "choices": [
-                {
-                    "index": i,
-                    "message": {
-                        "role": "assistant",
-                        "content": gen
-                    },
-                    "finish_reason": "stop"  # Could be 'length' if max_tokens reached, etc.
+    Returns:
+        dict: The response, with the usage of the call and of each choice.
+    """
+    prompt_tokens = choices[0]["prompt_tokens"] if choices else 0
+    completion_tokens = sum(c["completion_tokens"] for c in choices)
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": i,
+                "message": {
+                    "role": "assistant",
+                    "content": c["text"]
+                },
+                "finish_reason": c["finish_reason"],
+                "usage": {
+                    "prompt_tokens": c["prompt_tokens"],
+                    "completion_tokens": c["completion_tokens"],
+                    "total_tokens": c["prompt_tokens"] + c["completion_tokens"],
                 }
-                for i, gen in enumerate(generations)
-            ],
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens_list[0] if completion_tokens_list else 0,
-                "total_tokens": total_tokens_list[0] if total_tokens_list else 0,
             }
+            for i, c in enumerate(choices)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
         }
-        
-        return DotMap(response)
+    }
+
@@ -1,15 +1,27 @@
 """ Wrapper class around common HuggingFace model loading and inference functionalities """
 
 import os 
+import json
+import time
+import threading
 import torch 
+from glob import glob
 from accelerate import Accelerator
 from transformers import (
     AutoModelForCausalLM, AutoTokenizer,
-    BitsAndBytesConfig, pipeline
+    BitsAndBytesConfig, StoppingCriteriaList, LogitsProcessorList
 )
 from copy import deepcopy
-from peft import AutoPeftModelForCausalLM
+from warnings import warn
+from peft import AutoPeftModelForCausalLM, PeftModel
 from trl import get_kbit_device_map
+from src.model.stopping import FieldMarkerStoppingCriteria, trim_output
+from src.model.constrained import (
+    ChatFormatLogitsProcessor, ChatFormatMachine, Vocabulary, output_schemas
+)
+
+# Name selecting the base model, without any adapter, when adapters are loaded
+BASE_ADAPTER = "__base__"
 
 class HuggingFaceLocalModel():
     
@@ -28,9 +40,14 @@ class HuggingFaceLocalModel():
 
         self.device = get_current_device(self.accelerator)
         self.supports_flash_attention = supports_flash_attention()
+        # Named LoRA adapters kept on a single resident base model
+        self.adapters = adapter_paths(config) if not is_training else {}
+        self.adapter_lock = threading.Lock()
         self.model = self.load_model()
         self.tokenizer = self.load_tokenizer()           
-        self.pipe = self.load_pipeline() if not self.is_training else None 
+        self.vocabulary = None
+        self.reset_metrics()
+        self.draft_model = self.load_draft_model() if not self.is_training else None
 
     def batch_query(self, batch, gen_kwargs):
         """
@@ -44,25 +61,407 @@ class HuggingFaceLocalModel():
         Returns:
             list of str: The generated responses.
         """
+        return [choice["text"]
+                for choices in self.batch_generate(batch, gen_kwargs)
+                for choice in choices]
+
+
+    def batch_generate(self, batch, gen_kwargs, signature=None, adapters=None):
+        """
+        Generate responses for a list of conversations, keeping the
+        information about how each generation ended. 
+
+        When the conversations follow the DSPy ChatAdapter format, 
+        generation stops as soon as the last output field is closed. 
+        With `constrained_decoding` enabled in the model config, the
+        output is also constrained to the ChatAdapter format, with JSON
+        sections matching the types of the signature output fields.
+
+        When several adapters are loaded, each conversation can be generated
+        with its own adapter. Conversations using different adapters are 
+        generated in the same batch when a single sequence is returned; 
+        otherwise they are generated adapter by adapter.
 
-        tokenizer = self.pipe.tokenizer
+        Args:
+            batch (list of list of dict): Conversations to continue.
+            gen_kwargs (dict): Generation arguments.
+            signature (dspy.Signature, optional): Signature of the active predictor.
+            adapters (str or list of str, optional): Adapter of all the conversations,
+                or of each of them. Defaults to the `default_adapter` of the config.
+
+        Returns:
+            list of list of dict: For each conversation, one dict per returned 
+                sequence with the generated `text`, its `finish_reason`
+                ("stop" or "length"), and the number of `prompt_tokens` and
+                `completion_tokens` counted during generation.
+        """
         new_kwargs = adapt_gen_kwargs(deepcopy(gen_kwargs))
+        names = self.resolve_adapters(adapters, len(batch))
+        if names is not None:
+            with self.adapter_lock:
+                return self._generate_with_adapters(batch, new_kwargs, signature, names)
+
+        return self._batch_generate(batch, new_kwargs, signature)
+
+
+    def _batch_generate(self, batch, new_kwargs, signature=None, **other_kwargs):
         agp = batch[-1][-1]["role"] == "user"
 
-        # For trained models, this pipeline is more efficeint
-        inputs = tokenizer.apply_chat_template(batch, tokenize=False, 
-                                               add_generation_prompt=agp,
-                                               continue_final_message=not agp,
-                                               pad_to_multiple_of=8)
-        responses = self.pipe(inputs, return_full_text=False, **new_kwargs)
+        prompts = self.tokenizer.apply_chat_template(batch, tokenize=False, 
+                                                     add_generation_prompt=agp,
+                                                     continue_final_message=not agp)
+
+        if self.can_assist(new_kwargs):
+            return [self.assisted_generate([p], [m], new_kwargs, signature)[0]
+                    for p, m in zip(prompts, batch)]
+
+        return self.generate(prompts, batch, new_kwargs, signature, **other_kwargs)
+
+
+    def _generate_with_adapters(self, batch, new_kwargs, signature, names):
+        if len(set(names)) == 1:
+            self.activate_adapter(names[0])
+            return self._batch_generate(batch, new_kwargs, signature)
+
+        n = new_kwargs.get("num_return_sequences") or 1
+        if n > 1 or self.can_assist(new_kwargs):
+            # The rows of the batch are expanded or split by generation,
+            # so each adapter gets its own batch
+            generations = [None] * len(batch)
+            for name in dict.fromkeys(names):
+                rows = [i for i, a in enumerate(names) if a == name]
+                self.activate_adapter(name)
+                outputs = self._batch_generate([batch[i] for i in rows], new_kwargs, signature)
+                for i, output in zip(rows, outputs):
+                    generations[i] = output
+            return generations
+
+        # PEFT routes every row of the batch through its own adapter
+        self.model.base_model.enable_adapter_layers()
+        return self._batch_generate(batch, new_kwargs, signature, adapter_names=names)
+
+
+    def resolve_adapters(self, adapters, size):
+        """
+        Adapter used for each of the `size` conversations of a batch.
+
+        Returns:
+            list of str or None: The adapter names, or None when no adapters are loaded.
+
+        Raises:
+            ValueError: When an adapter is asked for but not loaded.
+        """
+        if adapters is None or isinstance(adapters, str):
+            adapters = [adapters] * size
+
+        if not self.adapters:
+            if any(adapters):
+                raise ValueError(f"No adapters are loaded, cannot use {set(adapters)}")
+            return None
+
+        names = [a or self.default_adapter for a in adapters]
+        unknown = set(names) - set(self.adapters) - {BASE_ADAPTER}
+        if unknown:
+            raise ValueError(f"Unknown adapters {unknown}, loaded adapters are {list(self.adapters)}")
+        return names
+
+
+    @property
+    def default_adapter(self):
+        return self.config.default_adapter or next(iter(self.adapters))
+
+
+    def activate_adapter(self, name):
+        """ Switch the adapter used by the model, without merging it. """
+        if name == BASE_ADAPTER:
+            self.model.base_model.disable_adapter_layers()
+        else:
+            self.model.base_model.enable_adapter_layers()
+            self.model.set_adapter(name)
+
+
+    @torch.no_grad()
+    def generate(self, prompts, batch, gen_kwargs, signature=None, **other_kwargs):
+        """
+        Run generation on prompts which already have the chat template applied.
+
+        Args:
+            prompts (list of str): Formatted prompts.
+            batch (list of list of dict): The conversations the prompts were built from.
+            gen_kwargs (dict): Adapted generation arguments.
+            signature (dspy.Signature, optional): Signature of the active predictor.
+            other_kwargs: Other arguments forwarded to `model.generate`.
+
+        Returns:
+            list of list of dict: See `batch_generate`.
+        """
+        n = gen_kwargs.get("num_return_sequences") or 1
+        max_new_tokens = gen_kwargs.get("max_new_tokens")
+
+        # The chat template already contains the special tokens
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, 
+                                add_special_tokens=False).to(self.model.device)
+        prompt_length = inputs["input_ids"].shape[1]
+
+        stopping = FieldMarkerStoppingCriteria.from_batch(self.tokenizer, batch, prompt_length, n)
+        if stopping is not None:
+            other_kwargs["stopping_criteria"] = StoppingCriteriaList([stopping])
+
+        end_ids = get_end_token_ids(self.model, self.tokenizer)
+        eos_ids = get_eos_token_ids(self.model, self.tokenizer)
+        if self.config.constrained_decoding and stopping is not None:
+            processor = self.format_processor(stopping.fields, signature, end_ids, prompt_length,
+                                              sample=bool(gen_kwargs.get("do_sample")))
+            other_kwargs["logits_processor"] = LogitsProcessorList([processor])
+
+        if n > 1 and prompt_length > 1:
+            other_kwargs["past_key_values"] = self.prefill(inputs, n)
+
+        outputs = self.model.generate(**inputs, 
+                                      pad_token_id=self.tokenizer.pad_token_id,
+                                      **gen_kwargs, **other_kwargs)
         
-        if True: #and not self.needs_custom_pipeline: # Because using personal cache 
-            responses = [resp[j]['generated_text'] 
-                        for resp in responses 
-                        for j in range(len(resp))]
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        generations = []
+        for row, tokens in enumerate(outputs[:, prompt_length:].tolist()):
+            ended = next((i for i, t in enumerate(tokens) if t in end_ids), None)
+            length = len(tokens) if ended is None else ended
+            text = self.tokenizer.decode(tokens[:length], skip_special_tokens=True)
+
+            # Rows stopped on the output markers are followed by padding, not by an EOS
+            marker_stop = stopping is not None and stopping.stopped[row]
+            stopped = ended is not None or marker_stop
+            if stopping is not None and stopping.fields[row]:
+                text = trim_output(text, stopping.fields[row])
+
+            truncated = not stopped and max_new_tokens is not None and length >= max_new_tokens
+            generated_eos = ended is not None and tokens[ended] in eos_ids and not marker_stop
+            generations.append({
+                "text": text, 
+                "finish_reason": "length" if truncated else "stop",
+                "prompt_tokens": prompt_tokens[row // n],
+                # Tokens the model generated, including those trimmed from the text
+                "completion_tokens": length + generated_eos,
+            })
+
+        return [generations[i * n: (i + 1) * n] for i in range(len(prompts))]
         
-        return responses
+
+    def prefill(self, inputs, n):
+        """
+        Run the prompts through the model once and share their cache between
+        the `n` sequences sampled for each prompt, instead of letting 
+        `generate` prefill every expanded copy of the prompt.
+
+        The last prompt token is left out of the cache: `generate` only 
+        processes the tokens missing from the cache, and needs the logits
+        of the last one to sample the first new token.
+
+        Args:
+            inputs (BatchEncoding): Tokenized (left padded) prompts.
+            n (int): Number of sequences returned for each prompt.
+
+        Returns:
+            Cache: The prompt cache, with each row repeated `n` times.
+        """
+        attention_mask = inputs["attention_mask"][:, :-1]
+        # Same positions as `generate` gives to left padded prompts
+        position_ids = (attention_mask.cumsum(-1) - 1).masked_fill(attention_mask == 0, 1)
+        outputs = self.model(input_ids=inputs["input_ids"][:, :-1],
+                             attention_mask=attention_mask,
+                             position_ids=position_ids,
+                             use_cache=True)
+        cache = outputs.past_key_values
+        cache.batch_repeat_interleave(n)
+        return cache
+
+
+    def can_assist(self, gen_kwargs):
+        """
+        Assisted generation in transformers only supports a batch of
+        one prompt and a single returned sequence.
+        """
+        n = gen_kwargs.get("num_return_sequences") or 1
+        return self.draft_model is not None and n == 1
+
+
+    def format_processor(self, fields, signature, end_ids, prompt_length, sample=True):
+        """
+        Build the logits processor constraining each sequence to the 
+        ChatAdapter format. The JSON schemas of structured fields are 
+        derived from the signature when it is known.
+
+        Args:
+            fields (list of list of str or None): Output fields of each sequence.
+            signature (dspy.Signature or None): Signature of the active predictor.
+            end_ids (set of int): Tokens ending a sequence.
+            prompt_length (int): Length of the (padded) prompt in tokens.
+            sample (bool): Whether tokens are sampled rather than chosen greedily.
+
+        Returns:
+            ChatFormatLogitsProcessor: The logits processor.
+        """
+        if self.vocabulary is None:
+            self.vocabulary = Vocabulary(self.tokenizer)
+
+        schemas = output_schemas(signature) if signature is not None else {}
+        machines = [ChatFormatMachine(f, [schemas.get(name) for name in f]) if f else None
+                    for f in fields]
+        
+        return ChatFormatLogitsProcessor(machines, self.vocabulary, end_ids, prompt_length, sample=sample)
+
+
+    def assisted_generate(self, prompts, batch, gen_kwargs, signature=None):
+        """
+        Generate with the draft model proposing tokens that the main 
+        model verifies. With greedy decoding the outputs are identical
+        to the ones of the main model alone. 
+
+        Transformers does not report which drafted tokens were accepted,
+        so the acceptance rate is only an estimate from forward-pass counts:
+        every drafted token costs one forward pass of the draft model, and
+        every verification pass of the main model yields the accepted draft
+        tokens plus one token of its own. Passes cut short by the end of the
+        sequence or by a stopping criterion make it slightly pessimistic.
+        For the first `draft_calibration_calls` calls, we also generate
+        without the draft model to check that greedy outputs match and to
+        measure the actual speedup.
+
+        Args:
+            prompts (list of str): A single prompt with the chat template applied.
+            batch (list of list of dict): The conversation the prompt was built from.
+            gen_kwargs (dict): Adapted generation arguments.
+            signature (dspy.Signature, optional): Signature of the active predictor.
+
+        Returns:
+            list of list of dict: See `batch_generate`.
+        """
+        stats = self.assisted_stats
+        calibrate = stats["calibration_calls"] < (self.config.draft_calibration_calls or 0)
+
+        target_calls, draft_calls = stats["target_forwards"], stats["draft_forwards"]
+        start = time.perf_counter()
+        generations = self.generate(prompts, batch, gen_kwargs, signature,
+                                    assistant_model=self.draft_model)
+        assisted_time = time.perf_counter() - start
+        responses = [g["text"] for choices in generations for g in choices]
+
+        new_tokens = sum(g["completion_tokens"] for choices in generations for g in choices)
+        target_calls = stats["target_forwards"] - target_calls
+        draft_calls = stats["draft_forwards"] - draft_calls
+
+        stats["calls"] += 1
+        stats["new_tokens"] += new_tokens
+        stats["drafted_tokens"] += draft_calls
+        stats["accepted_tokens"] += max(new_tokens - target_calls, 0)
+        stats["assisted_time"] += assisted_time
+
+        if calibrate:
+            start = time.perf_counter()
+            baseline = self.generate(prompts, batch, gen_kwargs, signature)
+            baseline_time = time.perf_counter() - start
+            baseline = [g["text"] for choices in baseline for g in choices]
+
+            stats["calibration_calls"] += 1
+            stats["calibration_assisted_time"] += assisted_time
+            stats["calibration_baseline_time"] += baseline_time
+            if baseline != responses:
+                stats["calibration_mismatches"] += 1
+                if not gen_kwargs.get("do_sample"):
+                    warn("Assisted greedy generation differs from the main model output")
+
+        return generations
+
+
+    def reset_metrics(self):
+        """ Start counting the generation statistics again, e.g. for another experiment. """
+        self.assisted_stats = init_assisted_stats()
+        self.scoring_stats = {"calls": 0, "prompt_tokens": 0, "candidate_tokens": 0}
+
+
+    def get_metrics(self):
+        """
+        Summary of the generation statistics to report with the run results.
+        The `acceptance_rate` of assisted generation is estimated from the
+        forward passes of both models (see `assisted_generate`).
+        """
+        metrics = {}
+        stats = self.assisted_stats
+        if self.draft_model is not None and stats["calls"]:
+            metrics["assisted_generation"] = {
+                "draft_model": self.config.draft_model,
+                **stats,
+                "acceptance_rate": stats["accepted_tokens"] / max(stats["drafted_tokens"], 1),
+                "tokens_per_second": stats["new_tokens"] / max(stats["assisted_time"], 1e-9),
+                "speedup": (stats["calibration_baseline_time"] / stats["calibration_assisted_time"]
+                            if stats["calibration_assisted_time"] else None),
+            }
+        if self.scoring_stats["calls"]:
+            metrics["scoring"] = dict(self.scoring_stats)
+        if self.adapters:
+            metrics["adapters"] = list(self.adapters)
+        return metrics
+
+
+    @torch.no_grad()
+    def score_continuations(self, messages, prefix, continuations):
+        """
+        Score candidate continuations of a conversation by their log-likelihood.
+
+        Each candidate is tokenized together with the prompt (conversation and
+        the beginning of the assistant answer), so that the tokens at their
+        boundary are the ones the model would see (e.g. `{"` is a single token
+        in BPE vocabularies). The tokens shared by all the candidates go 
+        through the model once, and their cache is shared by the remaining
+        tokens of every candidate, scored together in a single batched pass.
+
+        Args:
+            messages (list of dict): The conversation.
+            prefix (str): Beginning of the assistant answer, shared by all candidates.
+            continuations (list of str): Candidate texts following the prefix.
+
+        Returns:
+            list of float: Sum of the log-probabilities of the tokens of each
+                candidate following the tokens shared by all candidates.
+        """
+        prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, 
+                                                    add_generation_prompt=True) + prefix
+        full_ids = self.tokenizer([prompt + c for c in continuations], 
+                                  add_special_tokens=False).input_ids
+        shared = shared_prefix_length(full_ids)
+        # Every candidate keeps at least one token of its own
+        shared = max(min(shared, min(map(len, full_ids)) - 1), 1)
+
+        prompt_ids = torch.tensor([full_ids[0][:shared]], device=self.model.device)
+        outputs = self.model(prompt_ids, use_cache=True)
+        first_logprobs = torch.log_softmax(outputs.logits[0, -1].float(), dim=-1)
+
+        ids = [i[shared:] for i in full_ids]
+        n, length = len(ids), max(map(len, ids))
+        pad = self.tokenizer.pad_token_id
+        candidates = torch.tensor([i + [pad] * (length - len(i)) for i in ids], device=self.model.device)
+        mask = torch.tensor([[1] * len(i) + [0] * (length - len(i)) for i in ids], device=self.model.device)
+        attention_mask = torch.cat([torch.ones(n, prompt_ids.shape[1], dtype=mask.dtype, 
+                                               device=self.model.device), mask], dim=1)
+
+        cache = outputs.past_key_values
+        cache.batch_repeat_interleave(n)
+        logits = self.model(candidates, attention_mask=attention_mask, 
+                            past_key_values=cache, use_cache=True).logits
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+
+        scores = []
+        for row, tokens in enumerate(ids):
+            score = first_logprobs[tokens[0]].item()
+            score += sum(logprobs[row, j - 1, tokens[j]].item() for j in range(1, len(tokens)))
+            scores.append(score)
+
+        self.scoring_stats["calls"] += 1
+        self.scoring_stats["prompt_tokens"] += prompt_ids.shape[1]
+        self.scoring_stats["candidate_tokens"] += int(mask.sum())
         
+        return scores
+
 
     def query(self, messages, gen_kwargs):
         return self.batch_query([messages], gen_kwargs)
@@ -82,6 +481,10 @@ class HuggingFaceLocalModel():
         If the model is an adapter model, it is loaded with the specified
         adapter configuration.
 
+        With `adapters` (a mapping from name to adapter path) or 
+        `checkpoint_sweep` in the config, the base model is loaded once and
+        every adapter is loaded on top of it, see `adapter_paths`.
+
         The model is then converted to the specified dtype and device map.
 
         Returns:
@@ -129,7 +532,7 @@ class HuggingFaceLocalModel():
         ## the adapters. However, it does not have the merge_and_unload()
         ## functionality which is useful for speeding up inference
 
-        if has_adapters: 
+        if has_adapters and not self.adapters: 
             print("Loading saved adapters at", self.config.name)
             model = AutoPeftModelForCausalLM.from_pretrained(
                 self.config.name,
@@ -148,9 +551,10 @@ class HuggingFaceLocalModel():
                     print("Merging model with adapters for faster inference")
                     model = model.merge_and_unload()
         else:
-            print("Loading model from normal source")
+            name = base_model_name(self.config, self.adapters) if self.adapters else self.config.name
+            print("Loading model from normal source", name)
             model = AutoModelForCausalLM.from_pretrained(
-                self.config.name,
+                name,
                 torch_dtype=torch_dtype,
                 device_map = device_map, 
                 attn_implementation=attn_implementation,
@@ -158,6 +562,10 @@ class HuggingFaceLocalModel():
                 **other_args
             )
 
+            # Adapters stay unmerged, so that one base model serves all of them
+            if self.adapters:
+                model = load_adapters(model, self.adapters)
+
         # Bellow "padding_right" issue might arise, especially with Phi models 
         # https://github.com/huggingface/trl/issues/1217#issuecomment-1889282654
         if self.is_training:
@@ -199,16 +607,74 @@ class HuggingFaceLocalModel():
         return tokenizer 
     
 
-    def load_pipeline(self):
-        return pipeline("text-generation", 
-                        model=self.model, 
-                        tokenizer=self.tokenizer)
-    
+    def load_draft_model(self):
+        """
+        Load the optional small draft model used for assisted generation.
+        The draft model must share the tokenizer of the main model
+        (e.g. a smaller model of the same family).
+
+        Returns:
+            The loaded draft model, or None if no draft model is configured.
+        """
+        if not self.config.draft_model:
+            return None
+        
+        print("Loading draft model", self.config.draft_model)
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            self.config.draft_model,
+            torch_dtype=self.model.dtype,
+            device_map=self.model.device,
+            low_cpu_mem_usage=True,
+        )
+        draft_model.eval()
+
+        # Counting forward passes lets us estimate the acceptance rate
+        draft_model.register_forward_hook(self._count_forward("draft_forwards"))
+        self.model.register_forward_hook(self._count_forward("target_forwards"))
+
+        return draft_model
+
+
+    def _count_forward(self, key):
+        def hook(module, inputs, outputs):
+            self.assisted_stats[key] += 1
+        return hook
+
 def get_current_device(accelerator):
     return accelerator.local_process_index #.device 
 
+def init_assisted_stats():
+    return {
+        "calls": 0,
+        "new_tokens": 0,
+        "drafted_tokens": 0,
+        "accepted_tokens": 0,
+        "target_forwards": 0,
+        "draft_forwards": 0,
+        "assisted_time": 0.0,
+        "calibration_calls": 0,
+        "calibration_mismatches": 0,
+        "calibration_assisted_time": 0.0,
+        "calibration_baseline_time": 0.0,
+    }
+
+def get_eos_token_ids(model, tokenizer):
+    """ EOS token ids of the model and of the tokenizer. """
+    eos = model.generation_config.eos_token_id
+    eos = eos if isinstance(eos, list) else [eos]
+    return {t for t in [*eos, tokenizer.eos_token_id] if t is not None}
+
+def get_end_token_ids(model, tokenizer):
+    """ Token ids which end a generated sequence (EOS tokens and padding). """
+    pad = {tokenizer.pad_token_id} if tokenizer.pad_token_id is not None else set()
+    return get_eos_token_ids(model, tokenizer) | pad
+
 def adapt_gen_kwargs(gen_kwargs):
 
+    # Already adapted (e.g. by HugLM before querying the local model)
+    if "do_sample" in gen_kwargs:
+        return gen_kwargs
+
     gen_kwargs.pop("seed", None)
     gen_kwargs.pop("response_format", None)
 
@@ -227,12 +693,68 @@ def adapt_gen_kwargs(gen_kwargs):
 
     return gen_kwargs
 
+def shared_prefix_length(sequences):
+    """ Number of leading tokens shared by all the sequences. """
+    length = min(map(len, sequences))
+    for i in range(length):
+        if any(s[i] != sequences[0][i] for s in sequences):
+            return i
+    return length
+
 def has_saved_adapters(path):
     return os.path.isdir(path) and "adapter_config.json" in os.listdir(path)
 
+def adapter_paths(config):
+    """
+    Named LoRA adapters to load on the base model.
+
+    `adapters` maps names to adapter directories. `checkpoint_sweep` adds 
+    every `checkpoint-<step>` directory holding adapters in a training 
+    directory (the model `name` when set to `true`), named after the
+    checkpoint, and the final adapters of the directory as `final`.
+
+    Returns:
+        dict: Adapter paths by name, in loading order.
+    """
+    adapters = dict(config.adapters.toDict()) if config.adapters else {}
+
+    sweep = config.checkpoint_sweep
+    if sweep:
+        directory = config.name if sweep is True else sweep
+        checkpoints = [p for p in glob(os.path.join(directory, "checkpoint-*"))
+                       if p.rsplit("-", 1)[-1].isdigit() and has_saved_adapters(p)]
+        for path in sorted(checkpoints, key=lambda p: int(p.rsplit("-", 1)[-1])):
+            adapters[os.path.basename(path)] = path
+        if has_saved_adapters(directory):
+            adapters["final"] = directory
+        if not adapters:
+            warn(f"No saved adapters found in {directory}")
+
+    return adapters
+
+def base_model_name(config, adapters):
+    """ The base model of the adapters, unless set with `base_model` in the config. """
+    if config.base_model:
+        return config.base_model
+    with open(os.path.join(next(iter(adapters.values())), "adapter_config.json")) as fp:
+        return json.load(fp)["base_model_name_or_path"]
+
+def load_adapters(model, adapters):
+    """ Load every adapter on the base model, the first one being active. """
+    for i, (name, path) in enumerate(adapters.items()):
+        print("Loading adapter", name, "from", path)
+        if i == 0:
+            model = PeftModel.from_pretrained(model, path, adapter_name=name)
+        else:
+            model.load_adapter(path, adapter_name=name)
+    return model
+
 def supports_flash_attention():
     """Check if a GPU supports FlashAttention."""
 
+    if not torch.cuda.is_available():
+        return False
+
     DEVICE = 0 if torch.cuda.is_available() else "cpu"
     major, minor = torch.cuda.get_device_capability(DEVICE)
     
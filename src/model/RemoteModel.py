@@ -6,11 +6,11 @@ https://platform.openai.com/docs/api-reference/chat
 
 
 import os
-from time import sleep 
-from warnings import warn
 from anthropic import Anthropic
 from openai import OpenAI
 from huggingface_hub import InferenceClient
+from src.model.stopping import message_text
+from src.model.retry import RetryingCaller
 
 class RemoteModel():
 
@@ -18,26 +18,29 @@ class RemoteModel():
         self.config = config 
         self.seed = seed
         self.name = self.config.name 
-        self.max_retries, self.expo_factor = 15, 2
+        # Retries are handled by the caller, not by the clients
+        self.caller = RetryingCaller(self.config.source, self.config.retry)
         self.batch_size = 1
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, 
+                      "cache_creation_tokens": 0, "completion_tokens": 0}
 
         if self.config.source == "huggingface":
             self.client = InferenceClient().chat.completions
         elif self.config.source == "anthropic":
             # defaults to os.environ.get("ANTHROPIC_API_KEY")
-            self.client = Anthropic().messages
+            self.client = Anthropic(max_retries=0).messages
         elif self.config.source == "google":
             self.client = OpenAI(
                 base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-                api_key=os.environ.get("GOOGLE_API_KEY")
-                # api_key defaults to os.environ.get("OPENAI_API_KEY")
-                #max_retries=self.max_retries,
-                #timeout=300.0, # 5 minutes timeout
+                api_key=os.environ.get("GOOGLE_API_KEY"),
+                max_retries=0,
+                timeout=300.0, # 5 minutes timeout
             ).chat.completions
         else:
             self.client = OpenAI(
                 # api_key defaults to os.environ.get("OPENAI_API_KEY")
-                max_retries=self.max_retries,
+                base_url=self.config.base_url or None,
+                max_retries=0,
                 timeout=300.0, # 5 minutes timeout
             ).chat.completions
 
@@ -45,7 +48,52 @@ class RemoteModel():
     def batch_query(self, batch, gen_kwargs):
         return [self.query(m, gen_kwargs) for m in batch]
     
-    def query(self, messages, gen_kwargs):            
+    def query(self, messages, gen_kwargs):
+        """
+        Query the model and return the generated text.
+
+        Raises:
+            GenerationError: When the model could not answer after all the retries.
+        """
+        completions = self.create(messages, gen_kwargs)
+        if self.config.source == "anthropic":
+            return completions.content[0].text
+        return completions.choices[0].message.content
+
+    @property
+    def supports_logprobs(self):
+        """ Whether the provider returns log-probabilities (Anthropic does not). """
+        return self.config.source != "anthropic"
+
+    def query_logprobs(self, messages, gen_kwargs, top_logprobs=5):
+        """
+        Query the model and return the log-probabilities of the generated tokens,
+        when the provider supports it (see `supports_logprobs`).
+
+        Args:
+            messages (list of dict): The conversation.
+            gen_kwargs (dict): Generation arguments.
+            top_logprobs (int): Number of alternatives returned for each token.
+
+        Returns:
+            tuple: The generated text and, for each generated token, a dict with
+                its `token`, `logprob` and `top_logprobs` (list of dicts with `token` and `logprob`).
+        """
+        if not self.supports_logprobs:
+            raise NotImplementedError(f"Log-probabilities are not available for {self.config.source} models")
+
+        gen_kwargs = {**gen_kwargs, "logprobs": True, "top_logprobs": top_logprobs}
+        completions = self.create(messages, gen_kwargs)
+        choice = completions.choices[0]
+        logprobs = [{
+            "token": t.token,
+            "logprob": t.logprob,
+            "top_logprobs": [{"token": a.token, "logprob": a.logprob} for a in (t.top_logprobs or [])],
+        } for t in (choice.logprobs.content if choice.logprobs else [])]
+
+        return choice.message.content, logprobs
+    
+    def create(self, messages, gen_kwargs):            
         if type(messages[0]) == list:
             msg = """
             You passed in argument as multiple list of messages 
@@ -53,56 +101,63 @@ class RemoteModel():
             """
             raise ValueError(msg)
                     
-        if ("gemma" in self.config.name.lower() or self.config.source == "anthropic") and (messages[0]["role"] == "system"):
+        other_kwargs = {}
+        if self.config.source == "anthropic" and messages[0]["role"] == "system":
+            # Anthropic takes the system prompt (and its cache breakpoint) separately
+            other_kwargs["system"] = messages[0]["content"]
+            messages = messages[1:]
+        elif "gemma" in self.config.name.lower() and messages[0]["role"] == "system":
             messages = messages[1:]
+
+        if self.config.source != "anthropic":
+            # Cache breakpoints are only understood by Anthropic
+            messages = [{**m, "content": message_text(m)} for m in messages]
             
-        tries = 1
-        while tries <= self.max_retries:
-            rejected = ["num_beams"]
-            if self.config.source == "anthropic":
-                rejected.extend(["response_format", "seed", "n"])
-                if gen_kwargs["top_p"] is None:
-                    gen_kwargs["top_p"] = 1.0
-                    
-            gen_kwargs = {k: v for k, v in gen_kwargs.items() if k not in rejected}
+        rejected = ["num_beams"]
+        if self.config.source == "anthropic":
+            rejected.extend(["response_format", "seed", "n"])
+            if gen_kwargs["top_p"] is None:
+                gen_kwargs["top_p"] = 1.0
+                
+        gen_kwargs = {k: v for k, v in gen_kwargs.items() if k not in rejected}
 
-            try:
-                completions = self.client.create(
-                    model=self.config.name,
-                    messages=messages,
-                    **gen_kwargs,
-                )
+        completions = self.caller.call(lambda: self.client.create(
+            model=self.config.name,
+            messages=messages,
+            **gen_kwargs,
+            **other_kwargs,
+        ))
+        self.record_usage(completions)
+        return completions
 
-                if self.config.source == "anthropic":
-                    r = completions.content[0].text
-                else:
-                    r = completions.choices[0].message.content
+    def record_usage(self, completions):
+        """ Add the token usage of a completion, including the prompt tokens read from the provider cache. """
+        usage = getattr(completions, "usage", None)
+        if usage is None:
+            return
+
+        self.usage["calls"] += 1
+        if self.config.source == "anthropic":
+            cached = getattr(usage, "cache_read_input_tokens", None) or 0
+            created = getattr(usage, "cache_creation_input_tokens", None) or 0
+            self.usage["prompt_tokens"] += usage.input_tokens + cached + created
+            self.usage["cached_tokens"] += cached
+            self.usage["cache_creation_tokens"] += created
+            self.usage["completion_tokens"] += usage.output_tokens
+        else:
+            details = getattr(usage, "prompt_tokens_details", None)
+            self.usage["prompt_tokens"] += usage.prompt_tokens or 0
+            self.usage["cached_tokens"] += getattr(details, "cached_tokens", None) or 0
+            self.usage["completion_tokens"] += usage.completion_tokens or 0
+
+    def get_metrics(self):
+        """ Token usage of the run and the fraction of prompt tokens read from the provider cache. """
+        prompt_tokens = self.usage["prompt_tokens"]
+        return {
+            "usage": {
+                **self.usage,
+                "cache_hit_rate": self.usage["cached_tokens"] / prompt_tokens if prompt_tokens else None,
+            },
+            "retries": self.caller.get_metrics(),
+        }
 
-                return r 
-            
-            except Exception as e:
-
-                if "PRO" in str(e):
-                    sleep_time = 60 * 10
-                    m = f"""An error occured while generating: {e}.
-                    Retrying generation in half an hour to wait for pro subscription
-                    to come back 
-                    """
-                elif "500 Server Error:" in str(e):
-                    sleep_time = 0
-                    m = f"""An error occured while generating: {e}.
-                    Retrying generation in 2 seconds to see if it works then
-                    """
-                    tries -= 1
-                else:
-                    sleep_time = (20 * self.expo_factor) #* tries
-                    m = f"""An error occured while generating: {e}.
-                    Retrying generation in {sleep_time / 60} minute
-                    {self.max_retries - tries} lefts
-                    """
-                warn(m)
-                sleep(sleep_time)
-                tries += 1
-        
-        warn(f"Could not generate, giving up")
-        return ""
@@ -0,0 +1,343 @@
+"""
+Bulk generation through the OpenAI batch API.
+
+The requests are formatted with the DSPy ChatAdapter, written to a JSONL file,
+uploaded and submitted as one batch. The batch is then polled until it ends and
+its results are parsed back into the output fields of each example.
+
+Every step saves its state in the experiment directory, so an interrupted run
+resumes from the submitted batch instead of submitting it again. Results are
+only saved for completed batches: failed batches are submitted again by the
+next run, and the missing requests of expired batches are submitted again
+at once. The files of a batch are keyed by a hash of its requests: the batches
+of different chunks or inputs never share results, and a batch is only
+resumed for the same requests.
+https://platform.openai.com/docs/guides/batch
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+from warnings import warn
+import pandas as pd
+from openai import OpenAI
+from dspy.adapters.chat_adapter import ChatAdapter
+from src.utils.files import load_json, save_json
+
+ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+BATCH_DIR = "batches"
+
+
+def requests_hash(bodies):
+    """ Key of a batch, from the bodies of its requests. """
+    digest = hashlib.sha256()
+    for body in bodies:
+        digest.update((json.dumps(body, sort_keys=True) + "\n").encode())
+    return digest.hexdigest()[:16]
+
+
+def is_success(result):
+    """ Whether a line of the batch results is a successful request. """
+    return not result.get("error") and (result.get("response") or {}).get("status_code") == 200
+
+
+def remove_stale_batches(save_dir, fingerprint):
+    """
+    Remove the files of the batches submitted by another version of the
+    experiment (different fingerprint). Batches of the same version are kept
+    so that an interrupted run still resumes them.
+
+    Returns:
+        list of str: The keys of the removed batches.
+    """
+    removed = []
+    for state_path in glob.glob(os.path.join(save_dir, BATCH_DIR, "*_state.json")):
+        if load_json(state_path).get("fingerprint") == fingerprint:
+            continue
+        key = os.path.basename(state_path)[:-len("_state.json")]
+        for path in glob.glob(os.path.join(save_dir, BATCH_DIR, f"{key}_*")):
+            os.remove(path)
+        removed.append(key)
+    return removed
+
+
+class BatchRunner():
+
+    def __init__(self, config, save_dir, gen_kwargs=None, poll_interval=60, adapter=None,
+                 fingerprint=None):
+        """
+        Args:
+            config (DotMap): Model config. `base_url` points the client to another
+                OpenAI compatible server (e.g. a local stand-in batch server).
+            save_dir (str): Experiment directory, where the requests, results 
+                and state of the batches are saved.
+            gen_kwargs (dict, optional): Generation arguments of every request.
+            poll_interval (int): Seconds between two status checks of the batch.
+            adapter (ChatAdapter, optional): Adapter formatting the requests.
+            fingerprint (str, optional): Fingerprint of the experiment, saved with
+                the batches (see `remove_stale_batches`).
+        """
+        self.config = config
+        self.gen_kwargs = gen_kwargs or {"temperature": 0.0, "top_p": 1.0, "max_tokens": 4096}
+        self.poll_interval = poll_interval
+        self.client = OpenAI(base_url=config.base_url or None)
+        self.adapter = adapter or ChatAdapter()
+        self.fingerprint = fingerprint
+
+        self.batch_dir = os.path.join(save_dir, BATCH_DIR)
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self.keys = []
+        self.key, self.state = None, {}
+
+    def path(self, kind, key=None):
+        """ Path of the `requests`, `results` or `state` file of a batch. """
+        extension = "json" if kind == "state" else "jsonl"
+        return os.path.join(self.batch_dir, f"{key or self.key}_{kind}.{extension}")
+
+    @property
+    def requests_path(self):
+        return self.path("requests")
+
+    @property
+    def results_path(self):
+        return self.path("results")
+
+    @property
+    def state_path(self):
+        return self.path("state")
+
+    @property
+    def partial_path(self):
+        return self.path("partial")
+
+    def run(self, dataset, signature, mapping):
+        """
+        Generate the outputs of a dataset (or of a chunk) with a single batch.
+        The batch of the same requests is resumed, or its results reused, 
+        if it was already submitted.
+
+        When the batch expires, the requests which succeeded are kept and the 
+        others are submitted again. When it fails or is cancelled, only the 
+        outputs kept from expired batches are returned, and the next run 
+        submits the batch again.
+
+        Args:
+            dataset (list of dspy.Example): Input examples.
+            signature (dspy.Signature): Signature of the predictor.
+            mapping (dict): Mapping from output field to column name.
+
+        Returns:
+            pd.DataFrame: The outputs, indexed by example index.
+        """
+        bodies = self.format_requests(dataset, signature)
+        self.key = requests_hash(bodies)
+        self.keys.append(self.key)
+        self.state = load_json(self.state_path) if os.path.exists(self.state_path) else {}
+
+        if self.state.get("requests_hash") != self.key:
+            # State saved by another version of the batch
+            self.state = {}
+            for path in [self.results_path, self.partial_path, self.state_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        while not os.path.exists(self.results_path):
+            if "batch_id" not in self.state:
+                if not self.write_requests(bodies):
+                    # Every request succeeded before the previous batch expired
+                    os.replace(self.partial_path, self.results_path)
+                    break
+                self.submit()
+
+            status = self.wait()
+            if status == "completed":
+                self.download()
+            elif status == "expired":
+                # Keep the requests which succeeded, and submit the others again
+                self.download(partial=True)
+                self.clear_batch()
+            else:
+                # Submitted again by the next run
+                self.clear_batch()
+                break
+
+        return self.parse_results(signature, mapping, num_requests=len(bodies))
+
+    def format_requests(self, dataset, signature):
+        """ Bodies of the chat completion requests of the examples. """
+        bodies = []
+        for x in dataset:
+            messages = self.adapter.format(signature, demos=[], inputs=x.inputs().toDict())
+            bodies.append({"model": self.config.name, "messages": messages, **self.gen_kwargs})
+        return bodies
+
+    def custom_id(self, index):
+        # Results are only matched to the requests of the same batch
+        return f"{self.key}-{index}"
+
+    def write_requests(self, bodies):
+        """ 
+        Write the requests which have no result yet.
+
+        Returns:
+            int: The number of requests written.
+        """
+        done = self.partial_ids()
+        written = 0
+        with open(self.requests_path, "w") as fp:
+            for i, body in enumerate(bodies):
+                if self.custom_id(i) in done:
+                    continue
+                request = {
+                    "custom_id": self.custom_id(i),
+                    "method": "POST",
+                    "url": ENDPOINT,
+                    "body": body,
+                }
+                fp.write(json.dumps(request) + "\n")
+                written += 1
+        self.update_state(requests_hash=self.key, fingerprint=self.fingerprint)
+        return written
+
+    def submit(self):
+        with open(self.requests_path, "rb") as fp:
+            input_file = self.client.files.create(file=fp, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id,
+                                           endpoint=ENDPOINT,
+                                           completion_window="24h")
+        self.update_state(input_file_id=input_file.id, batch_id=batch.id,
+                          status=batch.status, submitted_at=time.time())
+        print("Submitted batch", batch.id)
+
+    def wait(self):
+        """ Poll the batch until it ends, and return its final status. """
+        while True:
+            batch = self.client.batches.retrieve(self.state["batch_id"])
+            self.update_state(status=batch.status,
+                              output_file_id=batch.output_file_id,
+                              error_file_id=batch.error_file_id,
+                              request_counts=batch.request_counts.to_dict() if batch.request_counts else None)
+            if batch.status in FINAL_STATUSES:
+                break
+            print("Batch", batch.id, batch.status, self.state["request_counts"])
+            time.sleep(self.poll_interval)
+
+        self.update_state(finished_at=time.time())
+        if batch.status != "completed":
+            warn(f"Batch {batch.id} ended with status {batch.status}")
+        return batch.status
+
+    def download(self, partial=False):
+        """
+        Save the results of a completed batch, with the results kept from 
+        the previous batches which expired. With `partial`, only keep the 
+        successful requests of an expired batch.
+        """
+        lines = []
+        for key in ["output_file_id"] if partial else ["output_file_id", "error_file_id"]:
+            if self.state.get(key):
+                lines.extend(self.client.files.content(self.state[key]).text.splitlines())
+        lines = [line for line in lines if line.strip()]
+
+        if partial:
+            lines = [line for line in lines if is_success(json.loads(line))]
+            with open(self.partial_path, "a") as fp:
+                fp.write("".join(line + "\n" for line in lines))
+            return
+
+        if os.path.exists(self.partial_path):
+            with open(self.partial_path) as fp:
+                lines = fp.read().splitlines() + lines
+        with open(self.results_path, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def partial_ids(self):
+        """ Custom ids of the requests which succeeded in expired batches. """
+        if not os.path.exists(self.partial_path):
+            return set()
+        with open(self.partial_path) as fp:
+            return {json.loads(line)["custom_id"] for line in fp if line.strip()}
+
+    def clear_batch(self):
+        """ Forget the submitted batch, so that the pending requests are submitted again. """
+        for key in ["batch_id", "input_file_id", "output_file_id", "error_file_id"]:
+            self.state.pop(key, None)
+        self.update_state(attempts=self.state.get("attempts", 1) + 1)
+
+    def parse_results(self, signature, mapping, num_requests):
+        custom_ids = {self.custom_id(i): i for i in range(num_requests)}
+        rows = []
+        # Without results, the batch failed: only the requests of expired batches are kept
+        path = self.results_path if os.path.exists(self.results_path) else self.partial_path
+        lines = []
+        if os.path.exists(path):
+            with open(path) as fp:
+                lines = fp.read().splitlines()
+        for line in lines:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.get("custom_id") not in custom_ids:
+                warn(f"Ignoring the result of request {result.get('custom_id')} from another batch")
+                continue
+            index = custom_ids[result["custom_id"]]
+            response = result.get("response") or {}
+            if not is_success(result):
+                warn(f"Request {index} failed: {result.get('error') or response}")
+                continue
+
+            body = response["body"]
+            outputs = [c["message"]["content"] for c in body["choices"]]
+            try:
+                fields = self.adapter.parse(signature, outputs[0])
+            except Exception:
+                warn(f"Could not parse the output of request {index}")
+                continue
+
+            rows.append({
+                "index": index,
+                **{v: fields.get(k) for k, v in mapping.items()},
+                "outputs": outputs,
+                "usage": body.get("usage"),
+                "model": body.get("model"),
+            })
+
+        if not rows:
+            return pd.DataFrame(columns=["index", *mapping.values()]).set_index("index")
+        return pd.DataFrame(rows).set_index("index").sort_index()
+
+    def update_state(self, **kwargs):
+        self.state.update(kwargs)
+        save_json(self.state, self.state_path)
+
+    def get_metrics(self):
+        """ Request counts, duration and token usage of the batches, and their total usage. """
+        batches = [self.batch_metrics(key) for key in dict.fromkeys(self.keys)]
+        return {
+            "batches": batches,
+            "usage": {k: sum(b["usage"][k] for b in batches) for k in ["prompt_tokens", "completion_tokens"]},
+        }
+
+    def batch_metrics(self, key):
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        if os.path.exists(self.path("results", key)):
+            with open(self.path("results", key)) as fp:
+                for line in fp:
+                    body = ((json.loads(line).get("response") or {}).get("body") or {}) if line.strip() else {}
+                    for k in usage:
+                        usage[k] += (body.get("usage") or {}).get(k) or 0
+
+        state = load_json(self.path("state", key)) if os.path.exists(self.path("state", key)) else {}
+        submitted, finished = state.get("submitted_at"), state.get("finished_at")
+        return {
+            "batch_id": state.get("batch_id"),
+            "status": state.get("status"),
+            "request_counts": state.get("request_counts"),
+            "duration": finished - submitted if submitted and finished else None,
+            "usage": usage,
+        }
@@ -0,0 +1,490 @@
+"""
+Constrained decoding for the DSPy ChatAdapter output format.
+
+The model has to write the `[[ ## field ## ]]` sections in the order requested
+by the ChatAdapter, finish with `[[ ## completed ## ]]`, and the sections of
+fields annotated with a structured type (e.g. `Dict[str, int]`) must contain
+JSON matching the schema derived from the signature.
+
+The constraint is checked character by character with a small state machine.
+Inside free text fields, only the tokens containing a `[` can break the format,
+so all the others are allowed at once. Elsewhere, tokens are checked from the
+most likely one until the checked tokens hold almost all the probability mass,
+so the cost per step stays small compared to the forward pass.
+
+Tokens are fed to the machine as the bytes they stand for, as decoding them one
+at a time mangles the tokens holding part of a UTF-8 character and drops the
+leading space of SentencePiece tokens.
+"""
+
+import re
+import json
+import typing
+import torch
+from transformers import LogitsProcessor
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+COMPLETED = "completed"
+BYTE_FALLBACK = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+# Stands for any character following an incomplete UTF-8 character
+NON_ASCII = "\u00e9"
+
+# Frames of the JSON state machine
+VALUE, OBJECT, ARRAY, STRING, NUMBER, LITERAL = range(6)
+
+
+def output_schemas(signature):
+    """
+    Derive a JSON schema for each output field of a DSPy signature.
+    Free text (str) fields have no schema.
+
+    Args:
+        signature (dspy.Signature): The signature class.
+
+    Returns:
+        dict: Mapping from output field name to a JSON schema, or None.
+    """
+    return {name: annotation_to_schema(field.annotation)
+            for name, field in signature.output_fields.items()}
+
+
+def annotation_to_schema(annotation):
+    if annotation in (None, str):
+        return None
+    if annotation is bool:
+        return {"type": "boolean"}
+    if annotation is int:
+        return {"type": "integer"}
+    if annotation is float:
+        return {"type": "number"}
+
+    origin, args = typing.get_origin(annotation), typing.get_args(annotation)
+    if origin is dict:
+        values = annotation_to_schema(args[1]) if len(args) == 2 else {}
+        return {"type": "object", "additionalProperties": values or {}}
+    if origin is list:
+        items = annotation_to_schema(args[0]) if args else {}
+        return {"type": "array", "items": items or {}}
+
+    # Anything else is left unconstrained
+    return None
+
+
+def json_step(stack, ch):
+    """
+    Feed one character to the JSON state machine.
+
+    Args:
+        stack (tuple): Current state, a stack of frames. The empty tuple
+            means a complete value was read.
+        ch (str): The next character.
+
+    Returns:
+        tuple or None: The new state, or None if the character is not allowed.
+    """
+    if not stack:
+        return stack if ch.isspace() else None
+
+    frame, rest = stack[-1], stack[:-1]
+    kind = frame[0]
+
+    if kind == VALUE:
+        schema = frame[1]
+        kind = schema.get("type")
+        if ch.isspace():
+            return stack
+        if ch == "{" and kind in (None, "object"):
+            return rest + ((OBJECT, schema, "start"),)
+        if ch == "[" and kind in (None, "array"):
+            return rest + ((ARRAY, schema, "start"),)
+        if ch == '"' and kind in (None, "string"):
+            return rest + ((STRING, False),)
+        if (ch == "-" or ch.isdigit()) and kind in (None, "integer", "number"):
+            return rest + ((NUMBER, ch, kind),)
+        if ch in "tf" and kind in (None, "boolean"):
+            return rest + ((LITERAL, "rue" if ch == "t" else "alse"),)
+        if ch == "n" and kind is None:
+            return rest + ((LITERAL, "ull"),)
+        return None
+
+    if kind == STRING:
+        escaped = frame[1]
+        if escaped:
+            return rest + ((STRING, False),)
+        if ch == "\\":
+            return rest + ((STRING, True),)
+        if ch == '"':
+            return json_close(rest)
+        if ord(ch) < 0x20:
+            return None
+        return stack
+
+    if kind == LITERAL:
+        remaining = frame[1]
+        if ch != remaining[0]:
+            return None
+        if len(remaining) == 1:
+            return json_close(rest)
+        return rest + ((LITERAL, remaining[1:]),)
+
+    if kind == NUMBER:
+        text, number_type = frame[1], frame[2]
+        if ch.isdigit():
+            return rest + ((NUMBER, text + ch, number_type),)
+        if number_type != "integer" and ch in ".eE+-":
+            return rest + ((NUMBER, text + ch, number_type),)
+        if not text[-1].isdigit():
+            return None
+        # The number ended, the character belongs to the parent
+        closed = json_close(rest)
+        return json_step(closed, ch)
+
+    if kind == OBJECT:
+        schema, phase = frame[1], frame[2]
+        if ch.isspace():
+            return stack
+        if phase in ("start", "next_key") and ch == '"':
+            return rest + ((OBJECT, schema, "key"), (STRING, False))
+        if phase == "start" and ch == "}":
+            return json_close(rest)
+        if phase == "colon" and ch == ":":
+            values = schema.get("additionalProperties") or {}
+            return rest + ((OBJECT, schema, "value"), (VALUE, values))
+        if phase == "after_value" and ch == ",":
+            return rest + ((OBJECT, schema, "next_key"),)
+        if phase == "after_value" and ch == "}":
+            return json_close(rest)
+        return None
+
+    if kind == ARRAY:
+        schema, phase = frame[1], frame[2]
+        if ch.isspace():
+            return stack
+        if phase == "start" and ch == "]":
+            return json_close(rest)
+        if phase == "start":
+            items = schema.get("items") or {}
+            return json_step(rest + ((ARRAY, schema, "value"), (VALUE, items)), ch)
+        if phase == "after_value" and ch == ",":
+            items = schema.get("items") or {}
+            return rest + ((ARRAY, schema, "value"), (VALUE, items))
+        if phase == "after_value" and ch == "]":
+            return json_close(rest)
+        return None
+
+    return None
+
+
+def json_close(stack):
+    """ A value was completed: move its parent frame to its next phase. """
+    if not stack:
+        return ()
+
+    parent = stack[-1]
+    if parent[0] == OBJECT:
+        phase = "colon" if parent[2] == "key" else "after_value"
+    else:
+        phase = "after_value"
+    return stack[:-1] + ((parent[0], parent[1], phase),)
+
+
+def json_complete(stack):
+    """ Whether the characters read so far form a complete JSON value. """
+    if not stack:
+        return True
+    return len(stack) == 1 and stack[0][0] == NUMBER and stack[0][1][-1].isdigit()
+
+
+class ChatFormatMachine():
+    """
+    Character-level state machine accepting the ChatAdapter answer format:
+    each field section introduced by its `[[ ## field ## ]]` header, in order,
+    followed by `[[ ## completed ## ]]`. Headers must start a line, as the
+    ChatAdapter only parses headers at the beginning of lines.
+
+    States are tuples, so they can be copied and compared cheaply:
+        - ("header", index, matched): writing the header of field `index`
+        - ("text", index, tail): inside a free text field
+        - ("json", index, stack, newline): inside a structured field
+        - ("done",): after the completed marker
+    """
+
+    HEADER_START = "\n[[ ## "
+
+    def __init__(self, fields, schemas):
+        """
+        Args:
+            fields (list of str): Output fields in the order they must be written.
+            schemas (list of dict or None): JSON schema of each field, None for free text.
+        """
+        self.fields = fields
+        self.schemas = schemas
+        self.headers = [f"[[ ## {f} ## ]]" for f in [*fields, COMPLETED]]
+
+    def initial(self):
+        return ("header", 0, 0)
+
+    def is_done(self, state):
+        return state[0] == "done"
+
+    def advance(self, state, text):
+        """ Feed a piece of text, returning the new state or None if it violates the format. """
+        for ch in text:
+            state = self.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def step(self, state, ch):
+        kind = state[0]
+
+        if kind == "done":
+            return state if ch.isspace() else None
+
+        if kind == "header":
+            index, matched = state[1], state[2]
+            header = self.headers[index]
+            if matched == 0 and ch.isspace():
+                return state
+            if ch != header[matched]:
+                return None
+            if matched + 1 < len(header):
+                return ("header", index, matched + 1)
+            return self.enter_field(index)
+
+        if kind == "text":
+            index, tail = state[1], state[2]
+            tail = (tail + ch)[-len(self.HEADER_START):]
+            if tail == self.HEADER_START:
+                return ("header", index + 1, len(self.HEADER_START) - 1)
+            # Only keep the tail if it may still become a header start
+            while tail and not self.HEADER_START.startswith(tail):
+                tail = tail[1:]
+            return ("text", index, tail)
+
+        if kind == "json":
+            index, stack, newline = state[1], state[2], state[3]
+            if json_complete(stack):
+                if ch == "[" and newline:
+                    return self.step(("header", index + 1, 0), ch)
+                if ch.isspace():
+                    # Numbers end with the first character following them
+                    stack = json_step(stack, ch) if stack else stack
+                    return ("json", index, stack, newline or ch == "\n")
+            stack = json_step(stack, ch)
+            if stack is None:
+                return None
+            return ("json", index, stack, False)
+
+        return None
+
+    def enter_field(self, index):
+        if index == len(self.fields):
+            return ("done",)
+        schema = self.schemas[index]
+        if schema is None:
+            return ("text", index, "")
+        return ("json", index, ((VALUE, schema),), False)
+
+    def accepts_text(self, state, text):
+        """ Fast path: free text without any `[` cannot start a header. """
+        return state[0] == "text" and not state[2] and "[" not in text
+
+
+def is_byte_level(tokenizer):
+    """ Whether the tokens of a tokenizer are byte-level BPE tokens (e.g. GPT-2, Llama 3, Qwen). """
+    if hasattr(tokenizer, "byte_decoder"):
+        return True
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is None:
+        return False
+    decoder = json.loads(backend.to_str()).get("decoder")
+    return '"ByteLevel"' in json.dumps(decoder)
+
+
+def token_bytes(tokenizer):
+    """
+    Bytes of every token of the vocabulary: mapped back with the byte
+    decoder for byte-level BPE vocabularies, and from the `▁` space marker
+    and the `<0x..>` byte fallback tokens for SentencePiece vocabularies.
+    Special tokens have no bytes.
+
+    Returns:
+        list of bytes: The bytes of each token id.
+    """
+    byte_decoder = {c: b for b, c in bytes_to_unicode().items()} if is_byte_level(tokenizer) else None
+    special = set(tokenizer.all_special_ids)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+    result = []
+    for i, token in enumerate(tokens):
+        if token is None or i in special:
+            result.append(b"")
+        elif byte_decoder is not None and all(c in byte_decoder for c in token):
+            result.append(bytes(byte_decoder[c] for c in token))
+        elif byte_decoder is None and BYTE_FALLBACK.fullmatch(token):
+            result.append(bytes([int(token[3:5], 16)]))
+        elif byte_decoder is None:
+            result.append(token.replace("\u2581", " ").encode())
+        else:
+            # Added tokens are stored as plain text
+            result.append(token.encode())
+    return result
+
+
+def decode_utf8(data):
+    """
+    Decode bytes which may end in the middle of a character.
+
+    Returns:
+        tuple: The decoded text, and the trailing bytes of the incomplete character.
+    """
+    for cut in range(min(3, len(data)) + 1):
+        try:
+            return data[:len(data) - cut].decode("utf-8"), data[len(data) - cut:]
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace"), b""
+
+
+class Vocabulary():
+    """ Bytes and text of every token, built once per tokenizer. """
+
+    def __init__(self, tokenizer):
+        self.bytes = token_bytes(tokenizer)
+        # None for the tokens ending in the middle of a character
+        self.texts = []
+        for data in self.bytes:
+            text, rest = decode_utf8(data)
+            self.texts.append(None if rest else text)
+        # Tokens without "[" never break a free text field
+        self.plain_ids = torch.tensor([i for i, b in enumerate(self.bytes) if b and b"[" not in b],
+                                      dtype=torch.long)
+        self.bracket_ids = [i for i, b in enumerate(self.bytes) if b"[" in b]
+
+    def __len__(self):
+        return len(self.bytes)
+
+
+class ChatFormatLogitsProcessor(LogitsProcessor):
+    """
+    Masks the tokens which would break the ChatAdapter format or the
+    JSON schema of the structured output fields.
+
+    The state of each sequence is derived from all its generated tokens at
+    every call, rather than from the last token only: during assisted
+    generation the processor is called for each drafted position, and by
+    the draft model as well, and rejected draft tokens must not count.
+    The state after every token is kept, so only new tokens are fed to the
+    machine and rejected tokens are rolled back.
+    """
+
+    def __init__(self, machines, vocabulary, end_ids, prompt_length, sample=True, mass=0.999):
+        """
+        Args:
+            machines (list of ChatFormatMachine or None): One machine per sequence
+                of the (expanded) batch. None leaves the sequence unconstrained.
+            vocabulary (Vocabulary): Bytes and text of every token.
+            end_ids (set of int): Tokens ending a sequence, only allowed once the answer is complete.
+            prompt_length (int): Length of the (padded) prompt in tokens.
+            sample (bool): Whether tokens are sampled. With greedy decoding, the
+                search stops at the first chunk of ranked tokens with a valid token.
+            mass (float): Outside free text, tokens are checked from the most likely
+                one until the checked tokens hold this share of the probability.
+        """
+        self.machines = machines
+        self.vocabulary = vocabulary
+        self.end_ids = end_ids
+        self.prompt_length = prompt_length
+        self.sample = sample
+        self.mass = mass
+        plain_ids = vocabulary.plain_ids
+        self.plain_ids = plain_ids[~torch.isin(plain_ids, torch.tensor(sorted(end_ids), dtype=plain_ids.dtype))]
+        self.tokens = [[] for _ in machines]
+        self.trails = [[(m.initial(), b"")] if m else None for m in machines]
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids[:, self.prompt_length:].tolist()
+        if self.plain_ids.device != scores.device:
+            self.plain_ids = self.plain_ids.to(scores.device)
+
+        mask = torch.zeros_like(scores)
+        for row, machine in enumerate(self.machines):
+            if machine is None:
+                continue
+            state, pending = self.sync(row, generated[row])
+            mask[row] = float("-inf")
+            mask[row, self.allowed_tokens(machine, state, pending, scores[row])] = 0
+
+        return scores + mask
+
+    def sync(self, row, tokens):
+        """
+        State of a sequence after its generated tokens, and the bytes of its
+        last incomplete character.
+        """
+        seen, trail = self.tokens[row], self.trails[row]
+        if tokens[:len(seen)] != seen:
+            common = next((i for i, (a, b) in enumerate(zip(seen, tokens)) if a != b),
+                          min(len(seen), len(tokens)))
+            del seen[common:]
+            del trail[common + 1:]
+
+        for token in tokens[len(seen):]:
+            state, pending = trail[-1]
+            if token not in self.end_ids:
+                advanced = self.advance(self.machines[row], state, pending, token)
+                # Should not happen, but never leave a row without a state
+                state, pending = advanced if advanced is not None else (state, pending)
+            seen.append(token)
+            trail.append((state, pending))
+
+        return trail[-1]
+
+    def advance(self, machine, state, pending, token):
+        """ Feed a token to the machine, returning the new state and pending bytes, or None. """
+        if token >= len(self.vocabulary):
+            return None
+        text = self.vocabulary.texts[token]
+        if pending or text is None:
+            text, pending = decode_utf8(pending + self.vocabulary.bytes[token])
+
+        state = machine.advance(state, text)
+        if state is None:
+            return None
+        # The incomplete character must be allowed once complete
+        if pending and machine.advance(state, NON_ASCII) is None:
+            return None
+        return state, pending
+
+    def allowed_tokens(self, machine, state, pending, scores):
+        if machine.is_done(state):
+            return list(self.end_ids)
+
+        vocab_size = scores.shape[-1]
+        if state[0] == "text":
+            extra = [t for t in self.vocabulary.bracket_ids
+                     if t < vocab_size and self.is_valid(machine, state, pending, t)]
+            plain_ids = self.plain_ids[self.plain_ids < vocab_size]
+            return torch.cat([plain_ids, torch.tensor(extra, dtype=plain_ids.dtype, device=plain_ids.device)])
+
+        probabilities = torch.softmax(scores.float(), dim=-1)
+        ranked = torch.argsort(scores, descending=True)
+        allowed, checked, start, size = [], 0.0, 0, 32
+        while start < vocab_size:
+            chunk = ranked[start: start + size]
+            allowed += [t for t in chunk.tolist() if self.is_valid(machine, state, pending, t)]
+            checked += probabilities[chunk].sum().item()
+            start, size = start + size, 1024
+            if allowed and (not self.sample or checked >= self.mass):
+                break
+
+        return allowed or list(self.end_ids)
+
+    def is_valid(self, machine, state, pending, token):
+        if token in self.end_ids or token >= len(self.vocabulary) or not self.vocabulary.bytes[token]:
+            return False
+        text = self.vocabulary.texts[token]
+        if not pending and text is not None and machine.accepts_text(state, text):
+            return True
+        return self.advance(machine, state, pending, token) is not None
@@ -0,0 +1,137 @@
+"""
+Bounded LM history.
+
+DSPy appends an entry to `lm.history` for every call, with the full messages,
+outputs and response object, and keeps all of them in memory. The history
+store replaces that list: only the last entries are kept in memory, and every
+entry is appended to a JSON lines log on disk, indexed by position and uuid,
+so that older entries can still be read back on demand.
+"""
+
+import json
+import os
+import threading
+import pandas as pd
+from collections import deque
+
+try:
+    # Every LM also keeps its entries in the global history of dspy
+    from dspy.clients.base_lm import GLOBAL_HISTORY
+except ImportError:
+    GLOBAL_HISTORY = None
+
+
+def to_jsonable(value):
+    """ Fallback to serialize the response objects of the history entries. """
+    if hasattr(value, "toDict"):
+        return value.toDict()
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    return str(value)
+
+
+class HistoryStore():
+    """
+    List-like LM history keeping a window of the most recent entries in memory,
+    backed by an append-only log on disk.
+
+    Supports what `Generate` and dspy need from `lm.history`: `append`, `len`,
+    indexing (including negative indices and slices) and iteration.
+    Entries older than the window are read back from the log, so their
+    response objects come back as plain dicts.
+    """
+
+    def __init__(self, path, window=100):
+        """
+        Args:
+            path (str): Path of the JSON lines log. An existing log is truncated.
+            window (int): Number of recent entries kept in memory.
+        """
+        self.path = path
+        self.window = window
+        self.recent = deque(maxlen=window)
+        self.offsets = []
+        self.positions = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        open(self.path, "w").close()
+
+    def append(self, entry):
+        line = json.dumps(entry, default=to_jsonable) + "\n"
+        with self.lock:
+            with open(self.path, "a") as fp:
+                self.offsets.append(self.size)
+                fp.write(line)
+            self.size += len(line.encode())
+            if entry.get("uuid"):
+                self.positions[entry["uuid"]] = len(self.offsets) - 1
+            self.recent.append(entry)
+
+        if GLOBAL_HISTORY is not None and len(GLOBAL_HISTORY) > self.window:
+            del GLOBAL_HISTORY[:-self.window]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+
+        # Entries still in the window are returned as they were appended
+        start = len(self) - len(self.recent)
+        if index >= start:
+            return self.recent[index - start]
+        return self.read(index)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, start=0):
+        """ Read the entries back from the log, from position `start`. """
+        with open(self.path) as fp:
+            if start < len(self):
+                fp.seek(self.offsets[start])
+            for _ in range(start, len(self)):
+                yield json.loads(fp.readline())
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __deepcopy__(self, memo):
+        # `BaseLM.copy` deep copies the LM and then resets its history
+        return []
+
+    def read(self, index):
+        """ Read an entry back from the log. """
+        with open(self.path) as fp:
+            fp.seek(self.offsets[index])
+            return json.loads(fp.readline())
+
+    def get(self, uuid):
+        """ The entry of a request, from its uuid. """
+        return self[self.positions[uuid]]
+
+    def dataframe(self, columns=None, start=0):
+        """
+        Load the history as a DataFrame, keeping only some columns
+        to avoid loading the messages and responses of every call.
+
+        Args:
+            columns (list of str, optional): Columns to keep. Defaults to all.
+            start (int): Position of the first call to load.
+
+        Returns:
+            pd.DataFrame: One row per call, in call order, indexed by position.
+        """
+        start = min(start, len(self))
+        index = pd.RangeIndex(start, len(self))
+        entries = self.iterate(start)
+        if columns is None:
+            return pd.DataFrame(list(entries), index=index)
+        return pd.DataFrame([{c: entry.get(c) for c in columns} for entry in entries],
+                            columns=columns, index=index)
@@ -0,0 +1,310 @@
+"""
+Retry policy for remote model calls.
+
+- Exponential backoff with full jitter, or the delay asked by the provider
+  in the `Retry-After` (or rate limit reset) headers.
+- A circuit breaker per provider: after repeated retryable failures (rate
+  limits, server errors, timeouts), every caller waits for the provider to
+  recover instead of piling up requests on it.
+- Optional hedged requests: when a call takes longer than a percentile of the
+  recent latencies, a duplicate request is sent and the first answer wins.
+
+Every failure is recorded, and callers get a `GenerationError` once the
+retries are exhausted instead of an empty answer.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from warnings import warn
+
+RETRYABLE_STATUS = [408, 409, 425, 429]
+
+
+class GenerationError(Exception):
+    """ Raised when a remote call still fails after all the retries. """
+
+
+def status_code(error):
+    """ HTTP status of a client error, if any. """
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def retry_after(error):
+    """
+    Delay in seconds asked by the provider, read from the `retry-after-ms`,
+    `retry-after` or `x-ratelimit-reset-*` headers of the error response.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+
+    # OpenAI rate limit headers, e.g. "1s", "6m0s" or "20ms"
+    for key in ["x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"]:
+        if headers.get(key):
+            seconds = parse_duration(headers[key])
+            if seconds is not None:
+                return seconds
+
+    return None
+
+
+def parse_duration(value):
+    total, number = 0.0, ""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    i = 0
+    while i < len(value):
+        ch = value[i]
+        if ch.isdigit() or ch == ".":
+            number += ch
+            i += 1
+            continue
+        unit = "ms" if value[i:i + 2] == "ms" else ch
+        if unit not in units or not number:
+            return None
+        total += float(number) * units[unit]
+        number = ""
+        i += len(unit)
+    return total if not number else None
+
+
+def is_retryable(error):
+    code = status_code(error)
+    if code is None:
+        # Connection errors, timeouts, ...
+        return True
+    return code in RETRYABLE_STATUS or code >= 500
+
+
+class RetryPolicy():
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=120.0):
+        """
+        Args:
+            max_retries (int): Number of retries after the first attempt.
+            base_delay (float): Delay before the first retry, doubled at every attempt.
+            max_delay (float): Maximum delay between two attempts.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error):
+        """ Seconds to wait before retrying after the `attempt`-th failure. """
+        asked = retry_after(error)
+        if asked is not None:
+            return min(asked, self.max_delay)
+        # Full jitter: spread the retries of concurrent callers
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker():
+    """
+    Opens after `failure_threshold` consecutive failures. While open, callers
+    wait for `reset_timeout` seconds; one trial request then decides whether
+    the circuit closes again or stays open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        """ Seconds to wait before sending a request, 0 if it can be sent now. """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining <= 0 and not self.trial:
+                # Half open: let a single trial request through
+                self.trial = True
+                return 0
+            return max(remaining, 1.0)
+
+    def record_success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    warn(f"Circuit opened after {self.failures} failures")
+                self.opened_at, self.trial = time.time(), False
+
+
+class Hedger():
+    """ Sends a duplicate request when a call is slower than a percentile of the recent latencies. """
+
+    def __init__(self, percentile=0.95, min_samples=20, window=200):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def hedge_after(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(self.percentile * len(latencies)), len(latencies) - 1)]
+
+    def call(self, fn, stats):
+        """ Run `fn`, and a duplicate of it if it is too slow. Returns the first result. """
+        delay = self.hedge_after()
+        first = self.executor.submit(fn)
+        if delay is None:
+            return first.result()
+
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        stats["hedged"] += 1
+        second = self.executor.submit(fn)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner is second:
+            stats["hedge_wins"] += 1
+        # If the first to finish failed, fall back on the other one
+        if winner.exception() is not None:
+            other = second if winner is first else first
+            return other.result()
+        return winner.result()
+
+
+# One circuit breaker per provider, shared by all the models of the process
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(provider, **kwargs):
+    with BREAKERS_LOCK:
+        if provider not in BREAKERS:
+            BREAKERS[provider] = CircuitBreaker(**kwargs)
+        return BREAKERS[provider]
+
+
+class RetryingCaller():
+    """ Runs remote calls with the retry policy, the provider circuit breaker and hedging. """
+
+    def __init__(self, provider, config=None):
+        """
+        Args:
+            provider (str): Name of the provider, sharing a circuit breaker.
+            config (DotMap, optional): The `retry` section of the model config, with
+                `max_retries`, `base_delay`, `max_delay`, `failure_threshold`,
+                `reset_timeout` and `hedge_percentile` (hedging is disabled without it).
+        """
+        config = config or {}
+        self.policy = RetryPolicy(max_retries=config.get("max_retries", 6),
+                                  base_delay=config.get("base_delay", 1.0),
+                                  max_delay=config.get("max_delay") or 120.0)
+        self.breaker = get_breaker(provider,
+                                   failure_threshold=config.get("failure_threshold") or 5,
+                                   reset_timeout=config.get("reset_timeout") or 60.0)
+        percentile = config.get("hedge_percentile")
+        self.hedger = Hedger(percentile=percentile) if percentile else None
+
+        self.failures = []
+        self.stats = {"calls": 0, "retries": 0, "giveups": 0, "hedged": 0, "hedge_wins": 0,
+                      "circuit_wait": 0.0}
+        self.lock = threading.Lock()
+
+    def call(self, fn):
+        """
+        Call `fn` until it succeeds or the retries are exhausted.
+
+        Raises:
+            GenerationError: When the call still fails after all the retries,
+                or fails with an error which cannot be retried.
+        """
+        with self.lock:
+            self.stats["calls"] += 1
+
+        for attempt in range(self.policy.max_retries + 1):
+            wait_time = self.breaker.wait_time()
+            while wait_time > 0:
+                time.sleep(wait_time)
+                with self.lock:
+                    self.stats["circuit_wait"] += wait_time
+                wait_time = self.breaker.wait_time()
+
+            start = time.time()
+            try:
+                result = self.hedger.call(fn, self.stats) if self.hedger else fn()
+            except Exception as e:
+                self.record_failure(e, attempt)
+                if is_retryable(e):
+                    self.breaker.record_failure()
+                else:
+                    # The provider answered: the request is at fault, not the provider
+                    self.breaker.record_success()
+                if not is_retryable(e) or attempt == self.policy.max_retries:
+                    with self.lock:
+                        self.stats["giveups"] += 1
+                    raise GenerationError(f"Giving up after {attempt + 1} attempts: {e}") from e
+
+                delay = self.policy.delay(attempt, e)
+                warn(f"An error occured while generating: {e}. Retrying in {delay:.1f}s")
+                with self.lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            if self.hedger:
+                self.hedger.record(time.time() - start)
+            return result
+
+    def record_failure(self, error, attempt):
+        with self.lock:
+            self.failures.append({
+                "time": time.time(),
+                "attempt": attempt,
+                "status": status_code(error),
+                "error": f"{type(error).__name__}: {error}"[:500],
+            })
+
+    def get_metrics(self):
+        with self.lock:
+            return {**self.stats, "failures": len(self.failures),
+                    "failures_by_status": count_by_status(self.failures)}
+
+
+def count_by_status(failures):
+    counts = {}
+    for f in failures:
+        key = str(f["status"])
+        counts[key] = counts.get(key, 0) + 1
+    return counts
@@ -0,0 +1,142 @@
+"""
+Stopping criteria for the DSPy ChatAdapter output format.
+
+The ChatAdapter asks the model to answer with one section per output field,
+each introduced by a marker such as `[[ ## reasoning ## ]]`, and to close the
+answer with `[[ ## completed ## ]]`. Some models do not emit EOS after the
+closing marker and keep generating until the token budget is exhausted.
+
+https://github.com/stanfordnlp/dspy/blob/main/dspy/adapters/chat_adapter.py
+"""
+
+import re
+import torch
+from transformers import StoppingCriteria
+
+COMPLETED = "completed"
+MARKER = re.compile(r"\[\[ ## (\w+) ## \]\]")
+OUTPUT_REQUIREMENTS = "Respond with the corresponding output fields"
+
+
+def message_text(message):
+    """ Text of a chat message, whether its content is a string or a list of content blocks. """
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def output_fields_from_messages(messages):
+    """
+    Recover the ordered output fields the ChatAdapter asked for in the
+    last user message of the conversation.
+
+    Args:
+        messages (list of dict): Chat messages formatted by the ChatAdapter.
+
+    Returns:
+        list of str or None: Output field names (without `completed`), or None
+            if the messages do not follow the ChatAdapter format (e.g. JSONAdapter).
+    """
+    user_messages = [m for m in messages if m["role"] == "user"]
+    if not user_messages:
+        return None
+
+    text = message_text(user_messages[-1])
+    start = text.rfind(OUTPUT_REQUIREMENTS)
+    if start == -1:
+        return None
+
+    fields = [f for f in MARKER.findall(text[start:]) if f != COMPLETED]
+    return fields or None
+
+
+def trim_output(text, fields):
+    """
+    Remove anything the model generated after the last output field closed:
+    either text after `[[ ## completed ## ]]`, or a new section started once
+    all the expected fields were written.
+
+    Args:
+        text (str): Generated text.
+        fields (list of str): Expected output fields, in order.
+
+    Returns:
+        str: The trimmed text.
+    """
+    seen = set()
+    for match in MARKER.finditer(text):
+        name = match.group(1)
+        if name == COMPLETED:
+            return text[:match.end()]
+        if seen.issuperset(fields):
+            return text[:match.start()].rstrip()
+        seen.add(name)
+    return text
+
+
+class FieldMarkerStoppingCriteria(StoppingCriteria):
+    """
+    Stops a sequence as soon as its final output field closes, i.e. when
+    the `[[ ## completed ## ]]` marker is generated or when a new section
+    marker appears after all expected fields were written.
+
+    Only the tokens added since the previous step are searched, with a short
+    window of the tokens before them for markers spanning both. Assisted
+    generation appends several tokens per step, so a marker may be followed
+    by more text within the same step.
+    """
+
+    def __init__(self, tokenizer, fields, prompt_length, window=16):
+        """
+        Args:
+            tokenizer: The tokenizer of the generating model.
+            fields (list of list of str or None): Expected output fields for each
+                sequence in the (expanded) batch. None disables stopping for that row.
+            prompt_length (int): Length of the (padded) prompt in tokens.
+            window (int): Number of tokens before the new ones decoded at each step.
+        """
+        self.tokenizer = tokenizer
+        self.fields = fields
+        self.prompt_length = prompt_length
+        self.window = window
+        self.seen = [set() for _ in fields]
+        self.stopped = [False for _ in fields]
+        self.checked = 0
+
+    @classmethod
+    def from_batch(cls, tokenizer, batch, prompt_length, num_return_sequences=1):
+        """ Build the criteria for a batch of conversations, or None if no row uses the ChatAdapter format. """
+        fields = [output_fields_from_messages(messages)
+                  for messages in batch
+                  for _ in range(num_return_sequences)]
+        if not any(fields):
+            return None
+        return cls(tokenizer, fields, prompt_length)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        length = generated.shape[1]
+        if length <= self.checked:
+            return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+        start = max(self.checked - self.window, 0)
+        before = self.tokenizer.batch_decode(generated[:, start:self.checked], skip_special_tokens=True)
+        texts = self.tokenizer.batch_decode(generated[:, start:], skip_special_tokens=True)
+        self.checked = length
+
+        for row, (text, previous) in enumerate(zip(texts, before)):
+            if self.stopped[row] or not self.fields[row]:
+                continue
+
+            for match in MARKER.finditer(text):
+                # Markers completed at a previous step were already counted
+                if match.end() <= len(previous):
+                    continue
+                name = match.group(1)
+                if name == COMPLETED or self.seen[row].issuperset(self.fields[row]):
+                    self.stopped[row] = True
+                    break
+                self.seen[row].add(name)
+
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
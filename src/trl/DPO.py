@@ -1,9 +1,18 @@
+import os
 import torch
+import hashlib
+import pandas as pd
+from contextlib import contextmanager
+from datasets import load_from_disk
 from peft import PeftModel
 from trl import DPOConfig, DPOTrainer
+from trl.data_utils import maybe_apply_chat_template
 from datasets import Dataset, DatasetDict 
 from warnings import warn 
 from src.trl.TRL import TRL
+from src.feedback.scoring import parse_literal
+from src.trl.tokenized import is_cached, load_or_build
+from src.utils.experiments import read_fingerprint
 from src.trl.KTO import (
     add_metadata, 
     format_prompt_completion, 
@@ -12,6 +21,9 @@ from src.trl.KTO import (
 
 class DPO(TRL):
 
+    # The maximum length of prompt and completion together is applied by the trainer
+    tokenized_lengths = ["max_prompt_length", "max_completion_length"]
+
     def __init__(self, config, test_run) -> None:
         super().__init__(config, test_run)
         self.other_args = {
@@ -23,8 +35,15 @@ class DPO(TRL):
     def prepare_dataset(self):
         df = self.load_dataframe()
         df = add_metadata(df)
-        df = format_prompt_completion(df)
-        df = create_preference_pairs(df)
+        pairs = self.config.task.pairs
+        # Seeded shuffling: the same pairs give the same tokenized dataset (and cache key)
+        random_state = self.config.task.sampling.get("random_state", self.config.seed or 42)
+        if pairs.source == "samples":
+            df = mine_sample_pairs(df, reference=pairs.reference or "teacher_grading",
+                                   column=pairs.column or "grading", random_state=random_state)
+        else:
+            df = format_prompt_completion(df)
+            df = create_preference_pairs(df, random_state=random_state)
         
         train_df, val_df = stratified_train_val_split_zipf(df, **self.config.task.sampling)
         columns = ["prompt", "chosen", "rejected"]
@@ -37,6 +56,14 @@ class DPO(TRL):
 
         return dataset 
 
+
+    @staticmethod
+    def tokenize_example(example, tokenizer, max_prompt_length=None, max_completion_length=None):
+        """ Tokenize a preference pair as DPOTrainer does. """
+        example = maybe_apply_chat_template(example, tokenizer)
+        return DPOTrainer.tokenize_row(example, tokenizer, max_prompt_length, 
+                                       max_completion_length, add_special_tokens=False)
+
         
     def train(self, dataset, train_args, peft_config):
 
@@ -49,6 +76,11 @@ class DPO(TRL):
         # adapter later. Currently, this means that a model that was trained
         # with adapters will continue being trained with adapters as well
         
+        # With `precompute_ref_log_probs`, the reference log-probabilities are
+        # computed once before training, when the policy is still the reference
+        # model, so no reference model or adapter is kept for training
+        precompute = bool(train_args.get("precompute_ref_log_probs"))
+
         ref_adapter_name, merge_full_model = None, False
         if isinstance(model, PeftModel) and peft_config:
             m = """
@@ -61,7 +93,7 @@ class DPO(TRL):
             model = model.merge_and_unload()
             merge_full_model = True 
 
-        elif isinstance(model, PeftModel):
+        elif isinstance(model, PeftModel) and not precompute:
             m = """
             Model loaded already has an adapter, 
             we are continuing training with a frozen reference model
@@ -77,15 +109,28 @@ class DPO(TRL):
 
         args = DPOConfig(**train_args)
 
-        trainer = DPOTrainer(
+        reference_path = self.reference_dataset_path() if precompute else None
+        cached = reference_path is not None and is_cached(reference_path)
+        if cached:
+            print("Loading cached reference log-probabilities", reference_path)
+            dataset = load_from_disk(reference_path)
+
+        trainer = PretokenizedDPOTrainer(
             model=model,
             peft_config=peft_config,
             processing_class=self.agent.tokenizer,
             train_dataset=dataset["train"],
             eval_dataset=dataset["test"],
             args=args,
+            callbacks=self.training_callbacks(),
         )
 
+        if precompute and not cached:
+            trainer.precompute_ref_log_probs()
+            load_or_build(reference_path, lambda: DatasetDict({
+                "train": trainer.train_dataset, "test": trainer.eval_dataset
+            }), self.agent.accelerator)
+
         print("Dataset", dataset)
         print("Arguments", args)
         print("peft config", peft_config)
@@ -110,7 +155,66 @@ class DPO(TRL):
         torch.cuda.empty_cache()
 
 
-def create_preference_pairs(df):
+    def reference_dataset_path(self):
+        """
+        Where the tokenized dataset is cached with the reference log-probabilities,
+        keyed by the reference model: the loaded model and, for a model trained 
+        by a previous experiment, the fingerprint of that experiment.
+        """
+        name = self.agent.config.name
+        reference = {"name": name, "fingerprint": (read_fingerprint(name) or {}).get("fingerprint")}
+        key = hashlib.sha256(str(sorted(reference.items())).encode()).hexdigest()[:16]
+        return f"{self.tokenized_dataset_path}-reference-{key}"
+
+
+class PretokenizedDPOTrainer(DPOTrainer):
+    """ 
+    DPOTrainer which leaves the datasets tokenized by `DPO.tokenize_example` as they are,
+    and uses the reference log-probabilities already stored in them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.policy_is_reference = False
+        super().__init__(*args, **kwargs)
+        if "ref_chosen_logps" in self.train_dataset.column_names:
+            self._precomputed_train_ref_log_probs = True
+        if self.eval_dataset is not None and "ref_chosen_logps" in self.eval_dataset.column_names:
+            self._precomputed_eval_ref_log_probs = True
+
+    def _prepare_dataset(self, dataset, *args, **kwargs):
+        if "prompt_input_ids" in dataset.column_names:
+            return dataset
+        return super()._prepare_dataset(dataset, *args, **kwargs)
+
+    def precompute_ref_log_probs(self):
+        """
+        Add the reference log-probabilities to the train and eval datasets with
+        the trainer's own precomputation. Before the first training step, the
+        policy is the reference model (new LoRA adapters start as the identity,
+        and continued adapters start from the reference adapter), so the 
+        log-probabilities are computed with the policy as it is.
+        """
+        training = self.model.training
+        self.model.eval()
+        self.policy_is_reference = True
+        try:
+            self.get_train_dataloader()
+            if self.eval_dataset is not None:
+                self.get_eval_dataloader()
+        finally:
+            self.policy_is_reference = False
+            self.model.train(training)
+
+    @contextmanager
+    def null_ref_context(self):
+        if self.policy_is_reference:
+            yield
+        else:
+            with super().null_ref_context():
+                yield
+
+
+def create_preference_pairs(df, random_state=42):
 
     student_mask = (~df.feedback.isna())
     student_df = df[student_mask].reset_index(drop=True)
@@ -124,7 +228,66 @@ def create_preference_pairs(df):
 
     # Merge the two, using teacher as good, student as bad 
     df = teacher_df.join(student_df[["rejected"]])
-    df = df.sample(frac=1).reset_index(drop=False) # shuffling
+    df = df.sample(frac=1, random_state=random_state).reset_index(drop=False) # shuffling
     df = df.dropna(subset=["chosen", "rejected"], axis=0) 
 
     return df
+
+
+def mine_sample_pairs(df, reference="teacher_grading", column="grading", random_state=42):
+    """
+    Mine preference pairs from several completions sampled for the same prompt
+    (see `samples` in the generation task config). Each sample is ranked by the
+    agreement of its grading with the reference grading: the best sample is 
+    chosen, the worst rejected. Prompts where all samples agree equally well
+    give no pair.
+
+    Args:
+        df (pd.DataFrame): Generations with the LM history `messages` and 
+            `outputs`, and the sampled gradings in `<column>_samples`.
+        reference (str): Column holding the reference grading.
+        column (str): Name of the grading output column.
+        random_state (int): Seed of the shuffling of the pairs.
+
+    Returns:
+        pd.DataFrame: The rows which gave a pair, with `prompt`, `chosen`, 
+            `rejected` and the agreement of both completions.
+    """
+    rows = []
+    for _, row in df.iterrows():
+        outputs = parse_literal(row["outputs"]) or []
+        gradings = parse_literal(row[f"{column}_samples"]) or []
+        expected = parse_literal(row[reference])
+        if len(outputs) < 2 or len(outputs) != len(gradings) or not isinstance(expected, dict):
+            continue
+
+        scores = [grading_score(g, expected) for g in gradings]
+        best = max(range(len(scores)), key=scores.__getitem__)
+        worst = min(range(len(scores)), key=scores.__getitem__)
+        if scores[best] == scores[worst]:
+            continue
+
+        rows.append({
+            **row.to_dict(),
+            "prompt": parse_literal(row["messages"]),
+            "chosen": [{"role": "assistant", "content": outputs[best]}],
+            "rejected": [{"role": "assistant", "content": outputs[worst]}],
+            "chosen_score": scores[best],
+            "rejected_score": scores[worst],
+        })
+
+    print(f"Mined {len(rows)} preference pairs from {len(df)} prompts")
+    if not rows:
+        raise ValueError(f"No preference pairs mined, check `samples` in the generation config "
+                         f"and the `{column}_samples` and `{reference}` columns")
+    df = pd.DataFrame(rows)
+    return df.sample(frac=1, random_state=random_state).reset_index(drop=True) # shuffling
+
+
+def grading_score(grading, reference):
+    """ Fraction of the reference rubric items graded the same way. """
+    grading = parse_literal(grading)
+    if not isinstance(grading, dict) or not reference:
+        return 0.0
+    grading = {str(k): str(v) for k, v in grading.items()}
+    return sum(grading.get(str(k)) == str(v) for k, v in reference.items()) / len(reference)
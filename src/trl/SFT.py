@@ -3,19 +3,74 @@
 https://huggingface.co/docs/trl/main/en/sft_trainer
 
 """
+import os
 import torch 
 import pandas as pd
 import numpy as np
 from src.trl.TRL import TRL
+from src.trl.tokenized import load_or_build
+from src.trl.packing import (
+    PackedCollator, check_max_length, first_fit_decreasing, pack_dataset, packing_report
+)
+from src.utils.files import save_json
 from trl import SFTConfig, SFTTrainer
+from trl.data_utils import maybe_apply_chat_template
 from datasets import Dataset, DatasetDict
 
 class SFT(TRL):
 
     def __init__(self, config, test_run) -> None:
         super().__init__(config, test_run)
+        self.packing_report_path = os.path.join(self.save_dir, "packing_report.json")
+        self.packing_report = None
         
 
+    def tokenize_dataset(self, dataset, train_args):
+        """
+        With `packing` in the task config, the tokenized conversations are 
+        also bin-packed into sequences of at most `max_length` tokens, 
+        and cached next to the tokenized dataset.
+        """
+        dataset = super().tokenize_dataset(dataset, train_args)
+
+        lengths = [len(ids) for ids in dataset["train"]["input_ids"]]
+        padding_free = bool(self.config.task.packing) and self.agent.supports_flash_attention
+        max_length = train_args["max_length"]
+        bins = first_fit_decreasing(lengths, max_length)
+        self.packing_report = packing_report(lengths, bins, train_args["per_device_train_batch_size"],
+                                             padding_free=padding_free)
+        self.packing_report.update(packing=bool(self.config.task.packing), padding_free=padding_free, 
+                                   max_length=max_length)
+        print("Packing report", self.packing_report)
+
+        if not self.config.task.packing:
+            return dataset
+
+        check_max_length(max_length, padding_free)
+        build = lambda: DatasetDict({
+            "train": pack_dataset(dataset["train"], bins, max_length),
+            "test": pack_dataset(dataset["test"], first_fit_decreasing(
+                [len(ids) for ids in dataset["test"]["input_ids"]], max_length), max_length),
+        })
+        return load_or_build(f"{self.tokenized_dataset_path}-packed", build, self.agent.accelerator)
+
+
+    @staticmethod
+    def tokenize_example(example, tokenizer, max_length=None):
+        """
+        Tokenize a prompt-completion conversation as SFTTrainer does, 
+        marking the completion tokens for the completion only loss.
+        """
+        example = maybe_apply_chat_template(example, tokenizer)
+        prompt_ids = tokenizer(text=example["prompt"])["input_ids"]
+        input_ids = tokenizer(text=example["prompt"] + example["completion"])["input_ids"]
+        completion_mask = [0] * len(prompt_ids) + [1] * (len(input_ids) - len(prompt_ids))
+
+        if max_length is not None:
+            input_ids, completion_mask = input_ids[:max_length], completion_mask[:max_length]
+        return {"input_ids": input_ids, "completion_mask": completion_mask}
+
+
     def prepare_dataset(self):
         df = self.load_dataframe()
         
@@ -49,24 +104,56 @@ class SFT(TRL):
         print("Peft config", peft_config)
         print("Model", model)
 
-        trainer = SFTTrainer(
+        if self.config.task.packing:
+            other_trainer_args["data_collator"] = PackedCollator(
+                self.agent.tokenizer.pad_token_id, 
+                padding_free=self.packing_report["padding_free"], 
+                dtype=model.dtype)
+
+        trainer = PretokenizedSFTTrainer(
             model=model,
             peft_config=peft_config,
             processing_class=self.agent.tokenizer,
             train_dataset=dataset["train"],
             eval_dataset=dataset["test"],
             args=args,
+            callbacks=self.training_callbacks(),
             **other_trainer_args
         )
 
-        trainer.train()
+        output = trainer.train()
         trainer.save_model()
+        self.save_packing_report(output.metrics, trainer.state.epoch)
 
         del self.agent.model
         del trainer
         torch.cuda.empty_cache()
 
 
+    def save_packing_report(self, train_metrics, epochs):
+        """
+        Save the padding of the batches with and without packing, and the 
+        throughput of the run in conversation tokens per second, to compare
+        runs with and without packing.
+        """
+        if self.packing_report is None or not self.agent.accelerator.is_main_process:
+            return
+        runtime = train_metrics.get("train_runtime")
+        tokens = self.packing_report["tokens"] * (epochs or 0)
+        self.packing_report["train_runtime"] = runtime
+        self.packing_report["tokens_per_second"] = tokens / runtime if runtime else None
+        save_json(self.packing_report, self.packing_report_path)
+
+
+class PretokenizedSFTTrainer(SFTTrainer):
+    """ SFTTrainer which leaves the datasets tokenized by `SFT.tokenize_example` as they are. """
+
+    def _prepare_dataset(self, dataset, *args, **kwargs):
+        if "input_ids" in dataset.column_names:
+            return dataset
+        return super()._prepare_dataset(dataset, *args, **kwargs)
+
+
 def sample_group(df, train_size, random_state):
     """
     Sample a DataFrame using normalized_cluster_frequency as probabilities.
@@ -3,15 +3,23 @@ from peft import LoraConfig
 from src.Experiment import Experiment
 from src.utils.files import create_dir
 from src.model.HuggingFaceLocalModel import HuggingFaceLocalModel
+from src.trl.tokenized import cache_key, load_or_build
+from src.trl.callbacks import ThroughputCallback
 
 
 class TRL(Experiment):
 
+    # Training arguments limiting the length of the tokenized examples
+    tokenized_lengths = ["max_length"]
+
     def __init__(self, config, test_run) -> None:
 
         super().__init__(config, test_run)
         self.dataset_save_path = os.path.join(self.save_dir, "dataset")
         create_dir(self.dataset_save_path)
+        # Tokenized datasets are shared by the experiments of the same save directory
+        self.tokenized_cache_dir = self.config.task.tokenized_cache_dir or \
+            os.path.join(self.config.save_dir, "tokenized_datasets")
         self.other_args = {}
 
     def run(self):
@@ -19,15 +27,51 @@ class TRL(Experiment):
         self.agent = load_model_agent(self.config)
 
         dataset = self.prepare_dataset()
-        if self.dataset_save_path: 
+        if self.dataset_save_path and self.agent.accelerator.is_main_process: 
             dataset.save_to_disk(self.dataset_save_path)
 
         train_args = self.prepare_training()
+        dataset = self.tokenize_dataset(dataset, train_args)
         peft_config = self.prepare_peft_config(train_args)
 
         self.train(dataset, train_args, peft_config)
 
 
+    def tokenize_dataset(self, dataset, train_args):
+        """
+        Tokenize the dataset as the trainer would, or load it from the cache
+        when it was already tokenized with the same tokenizer, lengths and data.
+
+        Args:
+            dataset (DatasetDict): The dataset returned by `prepare_dataset`.
+            train_args (dict): Training arguments, with the maximum lengths.
+
+        Returns:
+            DatasetDict: The tokenized dataset.
+        """
+        tokenizer = self.agent.tokenizer
+        lengths = {k: train_args.get(k) for k in self.tokenized_lengths}
+        key = cache_key(dataset, tokenizer, **lengths)
+        path = os.path.join(self.tokenized_cache_dir, f"{type(self).__name__.lower()}-{key}")
+        self.tokenized_dataset_path = path
+
+        columns = dataset["train"].column_names
+        build = lambda: dataset.map(self.tokenize_example, remove_columns=columns,
+                                    fn_kwargs={"tokenizer": tokenizer, **lengths},
+                                    num_proc=self.config.task.num_proc or None)
+        return load_or_build(path, build, self.agent.accelerator)
+
+
+    @staticmethod
+    def tokenize_example(example, tokenizer, **lengths):
+        raise NotImplementedError()
+
+
+    def training_callbacks(self):
+        """ Callbacks of every trainer: throughput and memory records in the save directory. """
+        return [ThroughputCallback(self.save_dir, pad_token_id=self.agent.tokenizer.pad_token_id)]
+
+
     def prepare_training(self):
         """
         Prepare a dictionary of training arguments for the Trainer.
@@ -0,0 +1,214 @@
+"""
+Training throughput and memory instrumentation, without an external service.
+
+Every optimizer step is split into:
+
+- `data`: from the end of the previous step (or of the evaluation, saving
+  and logging which follow it) until the step begins, i.e. waiting for the
+  data loader to provide the batches of the step;
+- `compute`: forward and backward passes of every accumulated micro-batch;
+- `optimizer`: the optimizer step (with gradient clipping);
+- `other`: the scheduler step, gradient zeroing and callbacks.
+
+Tokens are counted by a forward pre-hook on the model, separating the real
+tokens from the padding. Packed batches (see `src.trl.packing`) are counted
+from their position ids, since their padding tokens may be the same as
+the end of sequence tokens. One record per step is written to
+`throughput.jsonl` in the experiment directory, and a summary to
+`throughput_summary.json` when training ends.
+"""
+
+import os
+import json
+import time
+import resource
+import torch
+from transformers import TrainerCallback
+from src.utils.files import save_json
+
+
+class ThroughputCallback(TrainerCallback):
+
+    def __init__(self, save_dir, pad_token_id=None, synchronize=True):
+        """
+        Args:
+            save_dir (str): Directory of the records and summary.
+            pad_token_id (int, optional): Padding token, to count the padding of
+                batches without a 2D attention mask nor position ids.
+            synchronize (bool): Wait for the GPU at every boundary, so that each
+                part of the step is timed rather than only queued.
+        """
+        self.records_path = os.path.join(save_dir, "throughput.jsonl")
+        self.summary_path = os.path.join(save_dir, "throughput_summary.json")
+        self.pad_token_id = pad_token_id
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.hook = None
+        self.optimizer_begin = self.optimizer_end = None
+        self.records = []
+        self.eval_time = 0.0
+        self.evaluations = 0
+
+    # Timing
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.is_main = state.is_world_process_zero
+        self.world_size = max(args.world_size, 1)
+        self.tokens, self.padding = 0, 0
+        if model is not None:
+            self.hook = model.register_forward_pre_hook(self.count_tokens, with_kwargs=True)
+        if self.synchronize:
+            torch.cuda.reset_peak_memory_stats()
+        if self.is_main:
+            open(self.records_path, "w").close()
+        self.train_start = self.last_event = self.now()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_begin = self.now()
+        self.tokens_at_begin, self.padding_at_begin = self.tokens, self.padding
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self.optimizer_begin = self.now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self.optimizer_end = self.now()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        end = self.now()
+        optimizer_begin = self.optimizer_begin or end
+        optimizer_end = self.optimizer_end or end
+        tokens = self.tokens - self.tokens_at_begin
+        padding = self.padding - self.padding_at_begin
+        step_time = end - self.last_event
+
+        record = {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "step_time": step_time,
+            "data": self.step_begin - self.last_event,
+            "compute": optimizer_begin - self.step_begin,
+            "optimizer": optimizer_end - optimizer_begin,
+            "other": end - optimizer_end,
+            "tokens": tokens,
+            "padding": padding,
+            "padding_ratio": padding / (tokens + padding) if tokens + padding else 0.0,
+            "tokens_per_second": tokens / step_time if step_time else None,
+            **memory_usage(),
+        }
+        self.records.append(record)
+        if self.is_main:
+            with open(self.records_path, "a") as fp:
+                fp.write(json.dumps(record) + "\n")
+
+        self.optimizer_begin = self.optimizer_end = None
+        self.last_event = self.now()
+
+    # Evaluation, saving and logging happen after the end of a step,
+    # they are not counted as waiting for data
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        self.eval_time += (metrics or {}).get("eval_runtime") or 0.0
+        self.evaluations += 1
+        self.last_event = self.now()
+
+    def on_save(self, args, state, control, **kwargs):
+        self.last_event = self.now()
+
+    def on_log(self, args, state, control, **kwargs):
+        self.last_event = self.now()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.hook is not None:
+            self.hook.remove()
+            self.hook = None
+
+        summary = summarize(self.records, time.perf_counter() - self.train_start, self.world_size)
+        summary.update(eval_time=self.eval_time, evaluations=self.evaluations)
+        if self.is_main:
+            print("Throughput summary", summary)
+            save_json(summary, self.summary_path)
+
+    # Token counting
+
+    def count_tokens(self, module, args, kwargs):
+        if not module.training:
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if not torch.is_tensor(input_ids):
+            return
+
+        attention_mask = kwargs.get("attention_mask")
+        position_ids = kwargs.get("position_ids")
+        total = input_ids.numel()
+        if torch.is_tensor(attention_mask) and attention_mask.dim() == 2:
+            real = int(attention_mask.sum())
+        elif torch.is_tensor(position_ids):
+            real = packed_tokens(position_ids)
+        elif self.pad_token_id is not None:
+            real = int((input_ids != self.pad_token_id).sum())
+        else:
+            real = total
+        self.tokens += real
+        self.padding += total - real
+
+
+def packed_tokens(position_ids):
+    """
+    Number of tokens before the padding of packed rows. The padding is at the
+    end of the rows with position 0, while the last token of a conversation
+    always has a position above 0.
+    """
+    after_last = torch.arange(1, position_ids.shape[-1] + 1, device=position_ids.device)
+    return int((after_last * (position_ids > 0)).amax(dim=-1).sum())
+
+
+def memory_usage():
+    """ Peak memory of the process (RSS) and of the GPU, in GB. """
+    # ru_maxrss is in kilobytes on Linux
+    usage = {"peak_rss_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2}
+    if torch.cuda.is_available():
+        usage["peak_gpu_allocated_gb"] = torch.cuda.max_memory_allocated() / 1024 ** 3
+        usage["peak_gpu_reserved_gb"] = torch.cuda.max_memory_reserved() / 1024 ** 3
+    return usage
+
+
+def summarize(records, train_time, world_size=1):
+    """
+    Totals of the step records: time breakdown, throughput and peak memory.
+
+    Args:
+        records (list of dict): One record per step (see `ThroughputCallback`).
+        train_time (float): Duration of the whole training, in seconds.
+        world_size (int): Number of processes, each counting its own tokens.
+
+    Returns:
+        dict: The summary.
+    """
+    if not records:
+        return {"steps": 0, "train_time": train_time}
+
+    step_times = sorted(r["step_time"] for r in records)
+    totals = {k: sum(r[k] for r in records) for k in ["step_time", "data", "compute", "optimizer", "other"]}
+    tokens = sum(r["tokens"] for r in records)
+    padding = sum(r["padding"] for r in records)
+
+    return {
+        "steps": len(records),
+        "train_time": train_time,
+        "step_time_mean": totals["step_time"] / len(records),
+        "step_time_p50": step_times[len(step_times) // 2],
+        "step_time_p95": step_times[min(int(0.95 * len(step_times)), len(step_times) - 1)],
+        "time": {k: totals[k] for k in ["data", "compute", "optimizer", "other"]},
+        "time_fraction": {k: totals[k] / totals["step_time"] if totals["step_time"] else 0.0
+                          for k in ["data", "compute", "optimizer", "other"]},
+        "tokens": tokens,
+        "padding_ratio": padding / (tokens + padding) if tokens + padding else 0.0,
+        "tokens_per_second": tokens / totals["step_time"] if totals["step_time"] else None,
+        # Every process counts its own tokens
+        "global_tokens_per_second": tokens * world_size / totals["step_time"] if totals["step_time"] else None,
+        **{k: max(r.get(k) or 0 for r in records) for k in records[-1] if k.startswith("peak_")},
+    }
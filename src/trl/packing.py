@@ -0,0 +1,192 @@
+"""
+Sequence packing for SFT.
+
+Feedback examples vary widely in length, so padded batches are mostly padding.
+Tokenized conversations (see `SFT.tokenize_example`) are instead bin-packed into
+sequences of at most `max_length` tokens with first-fit decreasing. Every
+conversation keeps its own positions (restarting at 0) and only attends to
+its own tokens:
+
+- with flash attention, the batch is flattened into a single row without
+  padding, and the attention boundaries are derived from the position ids;
+- with the other attention implementations (e.g. on CPU), the collator
+  builds a 4D block diagonal causal mask. Its size grows with the square
+  of `max_length`, so packing is refused there beyond `MAX_MASKED_LENGTH`.
+
+The completion mask is packed as well, so the loss stays on completions only.
+"""
+
+import torch
+from datasets import Dataset
+
+# Longest packed sequence with a 4D mask: at 16384 tokens, the mask of every
+# row takes 1 GB in float32, before the attention scores of every layer
+MAX_MASKED_LENGTH = 8192
+
+
+def check_max_length(max_length, padding_free):
+    """ Refuse packing into sequences too long for a 4D attention mask. """
+    if not padding_free and max_length > MAX_MASKED_LENGTH:
+        raise ValueError(f"Packing into sequences of {max_length} tokens needs flash attention, "
+                         f"set max_length to at most {MAX_MASKED_LENGTH} without it")
+
+
+def first_fit_decreasing(lengths, max_length):
+    """
+    Bin-pack sequences: from the longest to the shortest, every sequence goes
+    into the first bin where it fits, or a new bin.
+
+    Args:
+        lengths (list of int): Length of every sequence.
+        max_length (int): Capacity of a bin.
+
+    Returns:
+        list of list of int: The indices of the sequences of every bin.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    bins, free = [], []
+    for i in order:
+        length = min(lengths[i], max_length)
+        for b, space in enumerate(free):
+            if length <= space:
+                bins[b].append(i)
+                free[b] -= length
+                break
+        else:
+            bins.append([i])
+            free.append(max_length - length)
+    return bins
+
+
+def pack_dataset(dataset, bins, max_length):
+    """
+    Pack a tokenized dataset with `input_ids` and `completion_mask` columns.
+
+    Args:
+        dataset (Dataset): The tokenized conversations.
+        bins (list of list of int): Conversations of every packed sequence
+            (see `first_fit_decreasing`).
+        max_length (int): Maximum length of a packed sequence.
+
+    Returns:
+        Dataset: One row per bin, with `input_ids`, `completion_mask` and
+            `position_ids` restarting at 0 for every conversation.
+    """
+    input_ids, completion_mask = dataset["input_ids"], dataset["completion_mask"]
+
+    packed = {"input_ids": [], "completion_mask": [], "position_ids": []}
+    for indices in bins:
+        row = {k: [] for k in packed}
+        for i in indices:
+            ids = input_ids[i][:max_length]
+            row["input_ids"].extend(ids)
+            row["completion_mask"].extend(completion_mask[i][:max_length])
+            row["position_ids"].extend(range(len(ids)))
+        for k in packed:
+            packed[k].append(row[k])
+
+    return Dataset.from_dict(packed)
+
+
+class PackedCollator():
+    """ Batches packed sequences, keeping the conversations of a sequence apart. """
+
+    def __init__(self, pad_token_id, padding_free=False, dtype=torch.float32):
+        """
+        Args:
+            pad_token_id (int): Token used to pad the sequences.
+            padding_free (bool): Flatten the batch into a single row, for flash attention.
+            dtype (torch.dtype): Dtype of the model, used for the 4D attention mask.
+        """
+        self.pad_token_id = pad_token_id
+        self.padding_free = padding_free
+        self.dtype = dtype
+
+    def __call__(self, examples):
+        if self.padding_free:
+            examples = [{k: [v for e in examples for v in e[k]] for k in examples[0]}]
+
+        length = max(len(e["input_ids"]) for e in examples)
+        input_ids, labels, position_ids = [], [], []
+        for e in examples:
+            padding = length - len(e["input_ids"])
+            # Labels are shifted in the model: the first token of a conversation
+            # is never predicted from the end of the previous one
+            row_labels = [t if m and p > 0 else -100 for t, m, p
+                          in zip(e["input_ids"], e["completion_mask"], e["position_ids"])]
+            input_ids.append(e["input_ids"] + [self.pad_token_id] * padding)
+            labels.append(row_labels + [-100] * padding)
+            position_ids.append(e["position_ids"] + [0] * padding)
+
+        batch = {
+            "input_ids": torch.tensor(input_ids),
+            "labels": torch.tensor(labels),
+            "position_ids": torch.tensor(position_ids),
+        }
+        if not self.padding_free:
+            lengths = torch.tensor([len(e["input_ids"]) for e in examples])
+            batch["attention_mask"] = block_causal_mask(batch["position_ids"], lengths, self.dtype)
+        return batch
+
+
+def block_causal_mask(position_ids, lengths, dtype=torch.float32):
+    """
+    4D additive attention mask where every token only attends to the previous
+    tokens of its own conversation.
+
+    Args:
+        position_ids (torch.Tensor): (batch, length) positions, restarting at 0
+            for every conversation.
+        lengths (torch.Tensor): (batch,) number of tokens of every row before padding.
+        dtype (torch.dtype): Dtype of the mask.
+
+    Returns:
+        torch.Tensor: (batch, 1, length, length) mask, 0 where attention is allowed.
+    """
+    _, length = position_ids.shape
+    positions = torch.arange(length)
+    is_token = positions[None, :] < lengths[:, None]
+    # Conversation index of every token, padding gets its own
+    sequence = torch.cumsum(position_ids == 0, dim=1).masked_fill(~is_token, -1)
+
+    causal = positions[None, :, None] >= positions[None, None, :]
+    allowed = causal & (sequence[:, :, None] == sequence[:, None, :]) & is_token[:, None, :]
+    # Padding attends to itself, avoiding fully masked rows
+    allowed |= torch.eye(length, dtype=torch.bool)[None]
+
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def packing_report(lengths, bins, batch_size, padding_free=False):
+    """
+    Tokens and padding of the training batches without and with packing.
+
+    Args:
+        lengths (list of int): Length of every conversation, in dataset order.
+        bins (list of list of int): Packed conversations (see `first_fit_decreasing`).
+        batch_size (int): Rows per device batch.
+        padding_free (bool): Whether packed batches are flattened without padding.
+
+    Returns:
+        dict: For both cases, the number of rows, the padded tokens and the padding ratio.
+    """
+    tokens = sum(lengths)
+    bin_lengths = [sum(lengths[i] for i in b) for b in bins]
+
+    def padded(row_lengths):
+        batches = [row_lengths[i: i + batch_size] for i in range(0, len(row_lengths), batch_size)]
+        return sum(max(b) * len(b) for b in batches)
+
+    unpacked = padded(lengths)
+    packed = tokens if padding_free else padded(bin_lengths)
+    return {
+        "conversations": len(lengths),
+        "tokens": tokens,
+        "unpacked": {"rows": len(lengths), "padded_tokens": unpacked,
+                     "padding_ratio": 1 - tokens / unpacked if unpacked else 0.0},
+        "packed": {"rows": len(bins), "padded_tokens": packed,
+                   "padding_ratio": 1 - tokens / packed if packed else 0.0,
+                   "conversations_per_row": len(lengths) / len(bins) if bins else 0.0},
+    }
@@ -0,0 +1,99 @@
+"""
+Pre-tokenized training datasets, cached on disk.
+
+SFTTrainer and DPOTrainer apply the chat template and tokenize their datasets
+when they are created, on every rank and for every run. Instead, the datasets
+are tokenized once, by the main process, and saved as Arrow files. The other
+ranks wait for them and load them memory-mapped.
+
+The cache key covers everything the tokenized dataset depends on: the
+tokenizer and its chat template, the maximum lengths and the source data.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from datasets import load_from_disk
+
+# Written last by `DatasetDict.save_to_disk`
+COMPLETE_FILE = "dataset_dict.json"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ What the token ids of a tokenizer depend on. """
+    return {
+        "class": type(tokenizer).__name__,
+        "name": tokenizer.name_or_path,
+        "vocabulary_size": len(tokenizer),
+        "chat_template": tokenizer.chat_template,
+        "special_tokens": tokenizer.all_special_tokens,
+    }
+
+
+def data_fingerprint(dataset):
+    """ Hash of the rows of every split of a DatasetDict. """
+    digest = hashlib.sha256()
+    for split in sorted(dataset):
+        digest.update(split.encode())
+        for row in dataset[split]:
+            digest.update(json.dumps(row, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def cache_key(dataset, tokenizer, **lengths):
+    """
+    Key of a tokenized dataset.
+
+    Args:
+        dataset (DatasetDict): The source (untokenized) dataset.
+        tokenizer: The tokenizer, with its chat template.
+        lengths: Maximum lengths used when tokenizing (e.g. `max_length`).
+
+    Returns:
+        str: A short hash.
+    """
+    key = {
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "lengths": lengths,
+        "data": data_fingerprint(dataset),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def is_cached(path):
+    return os.path.exists(os.path.join(path, COMPLETE_FILE))
+
+
+def save_dataset(dataset, path):
+    """ Save a DatasetDict atomically, so that a partial save is never loaded. """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset.save_to_disk(tmp_path)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_or_build(path, build, accelerator):
+    """
+    Load a cached dataset, building it first if needed.
+
+    The main process builds and saves the dataset while the other processes
+    wait, then every process loads it from disk (memory-mapped).
+
+    Args:
+        path (str): Directory of the cached dataset.
+        build (callable): Returns the DatasetDict to cache.
+        accelerator (Accelerator): The accelerator of the training processes.
+
+    Returns:
+        DatasetDict: The cached dataset.
+    """
+    with accelerator.main_process_first():
+        if accelerator.is_main_process:
+            if is_cached(path):
+                print("Loading cached tokenized dataset", path)
+            else:
+                print("Tokenizing dataset into", path)
+                save_dataset(build(), path)
+        return load_from_disk(path)
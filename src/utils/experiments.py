@@ -0,0 +1,192 @@
+""" Helpers relating experiment configs to each other, without running them. """
+
+import os
+import json
+import glob
+import hashlib
+from functools import lru_cache
+from src.utils.files import load_json
+
+FINGERPRINT_FILE = "fingerprint.json"
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def experiment_dir(config):
+    """ Directory where an experiment saves its results. """
+    return os.path.join(config.save_dir, config.name)
+
+
+def is_experiment(config):
+    """ Whether a dataset or model config is a previous experiment rather than a source. """
+    return all(config.get(k) for k in ["save_dir", "name"]) and any(config.get(k) for k in ["model", "task"])
+
+
+def upstream_dirs(config):
+    """
+    Directories of the experiments an experiment depends on: the previous
+    experiments used as datasets, and the training experiment of its model.
+
+    Returns:
+        list of str: The experiment directories, in config order.
+    """
+    dirs = [experiment_dir(ds) for ds in config.get("dataset") or [] if is_experiment(ds)]
+    if "model" in config.model:
+        dirs.append(experiment_dir(config.model))
+    return list(dict.fromkeys(dirs))
+
+
+def model_identity(config):
+    """
+    Identity of the local model an inference experiment loads with
+    `load_model_agent`, so that experiments sharing it can reuse one instance.
+
+    Returns:
+        str or None: The resolved model config as JSON, or None when the
+            experiment does not load a local model for inference
+            (remote models, training experiments).
+    """
+    if is_training(config):
+        return None
+
+    if "model" in config.model:
+        agent_config = config.model.model.toDict()
+        agent_config["name"] = experiment_dir(config.model)
+        if config.task.get("model_args"):
+            agent_config.update(config.task.model_args.toDict())
+    elif config.model.get("source") == "local":
+        agent_config = config.model.toDict()
+    else:
+        return None
+
+    return json.dumps(agent_config, sort_keys=True)
+
+
+def is_training(config):
+    # Same dispatch on the name as `load_experiment` in scripts/run.py
+    name = config.name
+    return not ("grade" in name or "feedback" in name) and ("sft" in name or "dpo" in name)
+
+
+def group_by_model(configs):
+    """
+    Order experiments so that the ones loading the same local model run
+    one after the other, while every experiment still runs after the
+    experiments of the list it depends on.
+
+    Starting from the first pending experiment, the pending experiments
+    sharing its model are added to its group as soon as their dependencies
+    have run.
+
+    Args:
+        configs (list of DotMap): Experiment configs, in the order given by the user.
+
+    Returns:
+        list of tuple: `(identity, configs)` groups, `identity` being None for
+            experiments which do not share a model.
+    """
+    dirs = [experiment_dir(c) for c in configs]
+    pending = list(range(len(configs)))
+    done, groups = set(), []
+
+    def ready(i):
+        return all(d in done or d not in dirs for d in upstream_dirs(configs[i]))
+
+    def take(i):
+        pending.remove(i)
+        done.add(dirs[i])
+        return i
+
+    while pending:
+        first = next((i for i in pending if ready(i)), pending[0])
+        identity = model_identity(configs[first])
+        members = [take(first)]
+        while identity is not None:
+            # Experiments becoming ready as the group runs can join it
+            i = next((i for i in pending if ready(i) and model_identity(configs[i]) == identity), None)
+            if i is None:
+                break
+            members.append(take(i))
+        groups.append((identity, [configs[i] for i in members]))
+
+    return groups
+
+
+def fingerprint(config):
+    """
+    Fingerprint of everything the results of an experiment depend on: its
+    config, the code, the data files it reads and the fingerprints of the
+    experiments it depends on. When an upstream experiment runs again, the
+    fingerprints of the experiments downstream of it change as well.
+
+    Args:
+        config (DotMap): Experiment config.
+
+    Returns:
+        dict: The hash of every part, and their combined `fingerprint`.
+    """
+    parts = {
+        "config": hash_json(prune(config.toDict())),
+        "code": code_hash(),
+        "inputs": {path: file_hash(path) for path in input_files(config)},
+        "upstream": {d: (read_fingerprint(d) or {}).get("fingerprint") for d in upstream_dirs(config)},
+    }
+    parts["fingerprint"] = hash_json(parts)
+    return parts
+
+
+def read_fingerprint(directory):
+    """ The fingerprint saved when the experiment completed, or None. """
+    path = os.path.join(directory, FINGERPRINT_FILE)
+    return load_json(path) if os.path.exists(path) else None
+
+
+def input_files(config):
+    """ Data files (`*_path` entries) of the datasets which are not previous experiments. """
+    paths = []
+    for ds in config.get("dataset") or []:
+        if is_experiment(ds):
+            continue
+        for key, value in ds.items():
+            if key.endswith("_path") and isinstance(value, str) and os.path.isfile(value):
+                paths.append(value)
+    return sorted(set(paths))
+
+
+@lru_cache(maxsize=None)
+def code_hash():
+    """ Hash of the python sources of the project. """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(SOURCE_DIR, "**", "*.py"), recursive=True)):
+        digest.update(os.path.relpath(path, SOURCE_DIR).encode())
+        with open(path, "rb") as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def file_hash(path):
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_json(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def prune(data):
+    # Reading a missing key of a DotMap adds it as an empty map, which
+    # must not change the fingerprint
+    if isinstance(data, dict):
+        pruned = {k: prune(v) for k, v in data.items()}
+        return {k: v for k, v in pruned.items() if v != {}}
+    if isinstance(data, list):
+        return [prune(v) for v in data]
+    return data
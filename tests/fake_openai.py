@@ -0,0 +1,179 @@
+"""
+Local stand-in for the OpenAI API, serving the chat completions, files and
+batches endpoints from memory. Failures can be injected in the chat completions
+(status code and headers of the next responses) to test the retry policy,
+and batches can end as expired, failed or cancelled.
+"""
+
+import json
+import re
+import threading
+import time
+from collections import deque
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUESTION = re.compile(r"\[\[ ## question ## \]\]\n(.*)")
+
+
+def reply(body):
+    """ ChatAdapter answer echoing the question of the request. """
+    content = body["messages"][-1]["content"]
+    match = QUESTION.search(content)
+    question = match.group(1) if match else content
+    return f"[[ ## answer ## ]]\nAnswer to {question}\n\n[[ ## completed ## ]]"
+
+
+def completion(body):
+    return {
+        "id": f"chatcmpl-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": reply(body)}}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.faults = deque()
+        self.completions = 0
+        self.files = {}
+        self.batches = {}
+        self.outcomes = deque()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def fail(self, status, times=1, headers=None):
+        """ Answer the next `times` chat completions with an error. """
+        self.faults.extend([(status, headers or {})] * times)
+
+    def end_batch(self, status, completed=0):
+        """ End the next batch with `status`, after completing its first `completed` requests. """
+        self.outcomes.append((status, completed))
+
+    def add_file(self, content, purpose="batch"):
+        with self.lock:
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = {"content": content, "purpose": purpose}
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        return {"id": file_id, "object": "file", "bytes": len(self.files[file_id]["content"]),
+                "created_at": int(time.time()), "filename": f"{file_id}.jsonl",
+                "purpose": self.files[file_id]["purpose"], "status": "processed"}
+
+    def create_batch(self, body):
+        """ Batches are processed at once, and reported as validating until their first retrieval. """
+        lines = self.files[body["input_file_id"]]["content"].decode().splitlines()
+        results = []
+        for line in filter(str.strip, lines):
+            request = json.loads(line)
+            results.append(json.dumps({
+                "id": f"batch_req_{len(results)}", "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": "", "body": completion(request["body"])},
+                "error": None,
+            }))
+        status, completed = self.outcomes.popleft() if self.outcomes else ("completed", len(results))
+        errors = [json.dumps({"id": f"batch_req_{i}", "custom_id": json.loads(line)["custom_id"],
+                              "response": None, "error": {"code": f"batch_{status}", "message": status}})
+                  for i, line in enumerate(results[completed:], completed)]
+        output = self.add_file("\n".join(results[:completed]).encode(), purpose="batch_output")
+        error = self.add_file("\n".join(errors).encode(), purpose="batch_output")
+
+        with self.lock:
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                "status": "validating", "created_at": int(time.time()),
+                "output_file_id": None, "error_file_id": None,
+                "request_counts": {"total": len(results), "completed": 0, "failed": 0},
+                "result": (status, completed, output["id"] if completed else None,
+                           error["id"] if errors else None),
+            }
+        return self.batch_object(batch_id)
+
+    def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch["status"] == "validating":
+            status, completed, output_file_id, error_file_id = batch["result"]
+            total = batch["request_counts"]["total"]
+            batch.update(status=status, output_file_id=output_file_id, error_file_id=error_file_id,
+                         request_counts={"total": total, "completed": completed, "failed": total - completed})
+        return self.batch_object(batch_id)
+
+    def batch_object(self, batch_id):
+        return {k: v for k, v in self.batches[batch_id].items() if k != "result"}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, payload, headers=None, raw=False):
+        data = payload if raw else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if raw else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        server = self.server
+        body = self.read_body()
+
+        if self.path == "/v1/chat/completions":
+            with server.lock:
+                server.completions += 1
+                fault = server.faults.popleft() if server.faults else None
+            if fault is not None:
+                status, headers = fault
+                return self.send(status, {"error": {"message": f"Injected {status}", "type": "fake"}}, headers)
+            return self.send(200, completion(json.loads(body)))
+
+        if self.path == "/v1/files":
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+            form = BytesParser().parsebytes(header + body)
+            fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                      for part in form.get_payload()}
+            return self.send(200, server.add_file(fields["file"], fields["purpose"].decode()))
+
+        if self.path == "/v1/batches":
+            return self.send(200, server.create_batch(json.loads(body)))
+
+        self.send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip("/").split("/")
+
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in server.batches:
+            return self.send(200, server.retrieve_batch(parts[2]))
+
+        if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in server.files:
+            return self.send(200, server.files[parts[2]]["content"], raw=True)
+
+        self.send(404, {"error": {"message": f"Unknown path {self.path}"}})
@@ -0,0 +1,46 @@
+""" Assisted generation with a draft model, on CPU with tiny models. """
+
+import pytest
+
+pytest.importorskip("torch")
+dotmap = pytest.importorskip("dotmap")
+local_model = pytest.importorskip("src.model.HuggingFaceLocalModel")
+
+GREEDY = {"temperature": 0.0, "top_p": 1.0, "max_tokens": 24}
+CONVERSATIONS = [
+    [{"role": "user", "content": "Grade the submission of the student."}],
+    [{"role": "user", "content": "def main():\n    print(i)"}],
+]
+
+
+def load(name, **config):
+    return local_model.HuggingFaceLocalModel(dotmap.DotMap(name=name, dtype="fp32", **config))
+
+
+def test_greedy_assisted_output_matches_plain_greedy(tiny_model_dir):
+    plain = load(tiny_model_dir)
+    # The main model drafting for itself accepts almost every drafted token
+    assisted = load(tiny_model_dir, draft_model=tiny_model_dir, draft_calibration_calls=1)
+
+    expected = plain.batch_generate(CONVERSATIONS, GREEDY)
+    generations = assisted.batch_generate(CONVERSATIONS, GREEDY)
+
+    assert [g[0]["text"] for g in generations] == [g[0]["text"] for g in expected]
+    assert [g[0]["completion_tokens"] for g in generations] == [g[0]["completion_tokens"] for g in expected]
+
+
+def test_assisted_metrics_are_plausible(tiny_model_dir):
+    assisted = load(tiny_model_dir, draft_model=tiny_model_dir, draft_calibration_calls=1)
+    assisted.batch_generate(CONVERSATIONS, GREEDY)
+
+    metrics = assisted.get_metrics()["assisted_generation"]
+    assert metrics["calls"] == len(CONVERSATIONS)
+    assert metrics["new_tokens"] > 0
+    assert 0 < metrics["accepted_tokens"] <= metrics["drafted_tokens"]
+    assert 0.5 < metrics["acceptance_rate"] <= 1.0
+    assert metrics["calibration_calls"] == 1
+    assert metrics["calibration_mismatches"] == 0
+    assert metrics["speedup"] is not None and metrics["speedup"] > 0
+
+    assisted.reset_metrics()
+    assert "assisted_generation" not in assisted.get_metrics()
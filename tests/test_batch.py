@@ -0,0 +1,102 @@
+""" Batch API runs against a local stand-in server. """
+
+import json
+import os
+import pytest
+
+pytest.importorskip("openai")
+dspy = pytest.importorskip("dspy")
+dotmap = pytest.importorskip("dotmap")
+batch = pytest.importorskip("src.model.batch")
+
+MAPPING = {"answer": "answer"}
+
+
+def dataset(*questions):
+    return [dspy.Example(question=q).with_inputs("question") for q in questions]
+
+
+def runner(server, save_dir, fingerprint="v1"):
+    config = dotmap.DotMap(name="gpt-fake", base_url=server.base_url)
+    return batch.BatchRunner(config, str(save_dir), poll_interval=0, fingerprint=fingerprint)
+
+
+def test_every_chunk_gets_its_own_batch(openai_server, tmp_path):
+    signature = dspy.Signature("question -> answer")
+    first = runner(openai_server, tmp_path).run(dataset("a", "b"), signature, MAPPING)
+    # A new runner on the same directory, as for the next chunk
+    second = runner(openai_server, tmp_path).run(dataset("c"), signature, MAPPING)
+
+    assert first["answer"].tolist() == ["Answer to a", "Answer to b"]
+    assert second["answer"].tolist() == ["Answer to c"]
+    assert len(openai_server.batches) == 2
+
+
+def test_same_requests_reuse_the_results(openai_server, tmp_path):
+    signature = dspy.Signature("question -> answer")
+    runner(openai_server, tmp_path).run(dataset("a"), signature, MAPPING)
+    results = runner(openai_server, tmp_path).run(dataset("a"), signature, MAPPING)
+
+    assert results["answer"].tolist() == ["Answer to a"]
+    assert len(openai_server.batches) == 1
+
+
+def test_results_of_other_batches_are_ignored(openai_server, tmp_path):
+    signature = dspy.Signature("question -> answer")
+    first = runner(openai_server, tmp_path)
+    first.run(dataset("a", "b"), signature, MAPPING)
+
+    # Result of a request of another batch, with the same position
+    with open(first.results_path) as fp:
+        lines = fp.read().splitlines()
+    result = json.loads(lines[0])
+    result["custom_id"] = "0123456789abcdef-0"
+    with open(first.results_path, "w") as fp:
+        fp.write("\n".join(lines[1:] + [json.dumps(result)]) + "\n")
+
+    with pytest.warns(UserWarning, match="another batch"):
+        results = runner(openai_server, tmp_path).run(dataset("a", "b"), signature, MAPPING)
+    assert results.index.tolist() == [1]
+
+
+def test_stale_batches_are_removed(openai_server, tmp_path):
+    signature = dspy.Signature("question -> answer")
+    old = runner(openai_server, tmp_path, fingerprint="v1")
+    old.run(dataset("a"), signature, MAPPING)
+    current = runner(openai_server, tmp_path, fingerprint="v2")
+    current.run(dataset("b"), signature, MAPPING)
+
+    assert batch.remove_stale_batches(str(tmp_path), "v2") == [old.key]
+    assert not os.path.exists(old.results_path) and not os.path.exists(old.state_path)
+    assert os.path.exists(current.results_path)
+
+    metrics = current.get_metrics()
+    assert [b["request_counts"]["completed"] for b in metrics["batches"]] == [1]
+    assert metrics["usage"]["completion_tokens"] == 5
+
+
+def test_expired_batches_resubmit_the_missing_requests(openai_server, tmp_path):
+    signature = dspy.Signature("question -> answer")
+    openai_server.end_batch("expired", completed=1)
+
+    with pytest.warns(UserWarning, match="expired"):
+        results = runner(openai_server, tmp_path).run(dataset("a", "b", "c"), signature, MAPPING)
+
+    assert results["answer"].tolist() == ["Answer to a", "Answer to b", "Answer to c"]
+    assert [b["request_counts"]["total"] for b in openai_server.batches.values()] == [3, 2]
+
+
+@pytest.mark.parametrize("status", ["failed", "cancelled"])
+def test_failed_batches_are_submitted_again_by_the_next_run(openai_server, tmp_path, status):
+    signature = dspy.Signature("question -> answer")
+    openai_server.end_batch(status)
+
+    with pytest.warns(UserWarning, match=status):
+        failed = runner(openai_server, tmp_path)
+        results = failed.run(dataset("a", "b"), signature, MAPPING)
+    assert results.empty
+    assert not os.path.exists(failed.results_path)
+
+    results = runner(openai_server, tmp_path).run(dataset("a", "b"), signature, MAPPING)
+    assert results["answer"].tolist() == ["Answer to a", "Answer to b"]
+    assert len(openai_server.batches) == 2
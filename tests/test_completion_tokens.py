@@ -0,0 +1,82 @@
+""" Completion tokens counted by the local model, when the padding is the EOS token. """
+
+import copy
+import pytest
+
+torch = pytest.importorskip("torch")
+dotmap = pytest.importorskip("dotmap")
+local_model = pytest.importorskip("src.model.HuggingFaceLocalModel")
+
+from tests.conftest import save_tiny_model
+
+CONVERSATIONS = [
+    [{"role": "user", "content": "Grade the submission of the student."}],
+    [{"role": "user", "content": "def main():\n    print(i)"}],
+]
+
+
+@pytest.fixture(scope="module")
+def pad_is_eos_model(tmp_path_factory, tokenizer):
+    tokenizer = copy.deepcopy(tokenizer)
+    tokenizer.pad_token = tokenizer.eos_token
+    path = save_tiny_model(tmp_path_factory.mktemp("tiny-llama-pad-eos"), tokenizer)
+    return local_model.HuggingFaceLocalModel(dotmap.DotMap(name=path, dtype="fp32"))
+
+
+class EndAfter():
+    """ Logits processor generating the EOS token once `steps` tokens were generated. """
+
+    def __init__(self, prompt_length, steps, eos):
+        self.prompt_length, self.steps, self.eos = prompt_length, steps, eos
+
+    def __call__(self, input_ids, scores):
+        if input_ids.shape[1] - self.prompt_length >= self.steps:
+            scores[:, :] = -float("inf")
+            scores[:, self.eos] = 0
+        return scores
+
+
+class StopFirstRow():
+    """ Stands for the output marker criteria, stopping the first row after `steps` tokens. """
+
+    def __init__(self, prompt_length, steps):
+        self.prompt_length, self.steps = prompt_length, steps
+        self.fields = [["answer"], []]
+        self.stopped = [False, False]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if input_ids.shape[1] - self.prompt_length >= self.steps:
+            self.stopped[0] = True
+        return torch.tensor(self.stopped, device=input_ids.device)
+
+
+def greedy(lm, max_tokens, **kwargs):
+    gen_kwargs = {"temperature": 0.0, "top_p": 1.0, "max_tokens": max_tokens, **kwargs}
+    return [g[0] for g in lm.batch_generate(CONVERSATIONS, gen_kwargs)]
+
+
+def prompt_length(lm):
+    prompts = [lm.tokenizer.apply_chat_template(c, tokenize=False, add_generation_prompt=True)
+               for c in CONVERSATIONS]
+    return lm.tokenizer(prompts, padding=True, add_special_tokens=False, return_tensors="pt").input_ids.shape[1]
+
+
+def test_generated_eos_is_counted(pad_is_eos_model):
+    lm = pad_is_eos_model
+    eos = lm.tokenizer.eos_token_id
+    processor = local_model.LogitsProcessorList([EndAfter(prompt_length(lm), 3, eos)])
+
+    generations = greedy(lm, 8, logits_processor=processor)
+    assert [g["completion_tokens"] for g in generations] == [4, 4]
+    assert [g["finish_reason"] for g in generations] == ["stop", "stop"]
+
+
+def test_padding_after_a_marker_stop_is_not_counted(pad_is_eos_model, monkeypatch):
+    lm = pad_is_eos_model
+    monkeypatch.setattr(local_model.FieldMarkerStoppingCriteria, "from_batch",
+                        staticmethod(lambda tokenizer, batch, length, n: StopFirstRow(length, 3)))
+
+    # The first row is then padded with the EOS token until the second one ends
+    generations = greedy(lm, 8, suppress_tokens=[lm.tokenizer.eos_token_id])
+    assert [g["completion_tokens"] for g in generations] == [3, 8]
+    assert [g["finish_reason"] for g in generations] == ["stop", "length"]
@@ -0,0 +1,87 @@
+""" Constrained decoding of the ChatAdapter format. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+dotmap = pytest.importorskip("dotmap")
+constrained = pytest.importorskip("src.model.constrained")
+
+FIELDS = ["reasoning", "feedback"]
+SCHEMAS = [None, {"type": "object", "additionalProperties": {"type": "integer"}}]
+ANSWER = "[[ ## reasoning ## ]]\nCafé ok.\n\n[[ ## feedback ## ]]\n{\"correctness\": 1}\n\n[[ ## completed ## ]]"
+PROMPT = [{"role": "user", "content": (
+    "Grade the submission of the student.\n\n"
+    "Respond with the corresponding output fields, starting with the field "
+    "`[[ ## reasoning ## ]]`, then `[[ ## feedback ## ]]`, and then ending "
+    "with the marker for `[[ ## completed ## ]]`.")}]
+
+
+@pytest.fixture(scope="module")
+def vocabulary(tokenizer):
+    return constrained.Vocabulary(tokenizer)
+
+
+def processor(vocabulary, tokenizer, sample=True):
+    machine = constrained.ChatFormatMachine(FIELDS, SCHEMAS)
+    return constrained.ChatFormatLogitsProcessor([machine], vocabulary, {tokenizer.eos_token_id},
+                                                 prompt_length=0, sample=sample)
+
+
+def allowed(processor, tokens, vocab_size):
+    scores = torch.zeros(1, vocab_size)
+    return set(torch.nonzero(processor(torch.tensor([tokens]), scores)[0] == 0).flatten().tolist())
+
+
+def test_token_bytes_keep_split_characters(tokenizer, vocabulary):
+    ids = tokenizer("Café ✓", add_special_tokens=False).input_ids
+    assert b"".join(vocabulary.bytes[i] for i in ids) == "Café ✓".encode()
+    # Some tokens hold part of a character, and have no text of their own
+    assert any(vocabulary.texts[i] is None for i in ids)
+    assert constrained.decode_utf8("é".encode()[:1]) == ("", "é".encode()[:1])
+
+
+def test_split_characters_are_allowed_in_text(tokenizer, vocabulary):
+    ids = tokenizer(ANSWER, add_special_tokens=False).input_ids
+    fmt = processor(vocabulary, tokenizer)
+    for end in range(len(ids)):
+        assert ids[end] in allowed(fmt, ids[:end], len(vocabulary)), tokenizer.decode(ids[:end + 1])
+    assert allowed(fmt, ids, len(vocabulary)) == {tokenizer.eos_token_id}
+
+
+def test_free_text_is_not_restricted_to_the_top_tokens(tokenizer, vocabulary):
+    ids = tokenizer("[[ ## reasoning ## ]]\nThe", add_special_tokens=False).input_ids
+    fmt = processor(vocabulary, tokenizer)
+    assert len(allowed(fmt, ids, len(vocabulary))) > 32
+
+
+def test_rejected_tokens_are_rolled_back(tokenizer, vocabulary):
+    answer = tokenizer(ANSWER, add_special_tokens=False).input_ids
+    wrong = tokenizer("[[ ## reasoning ## ]]\nok\n\n[[ ## feedback ## ]]\n{\"a\"",
+                      add_special_tokens=False).input_ids
+    end = len(answer) - 1
+
+    fmt = processor(vocabulary, tokenizer)
+    # As during assisted generation: drafted tokens, then a rejection
+    allowed(fmt, wrong, len(vocabulary))
+    after_rollback = allowed(fmt, answer[:end], len(vocabulary))
+    assert after_rollback == allowed(processor(vocabulary, tokenizer), answer[:end], len(vocabulary))
+    assert fmt.tokens[0] == answer[:end]
+
+
+@pytest.mark.parametrize("draft", [False, True])
+def test_constrained_generation_follows_the_format(tiny_model_dir, draft):
+    local_model = pytest.importorskip("src.model.HuggingFaceLocalModel")
+    config = dotmap.DotMap(name=tiny_model_dir, dtype="fp32", constrained_decoding=True)
+    if draft:
+        config.draft_model = tiny_model_dir
+    lm = local_model.HuggingFaceLocalModel(config)
+
+    gen_kwargs = {"temperature": 0.0, "top_p": 1.0, "max_tokens": 48}
+    text = lm.batch_generate([PROMPT], gen_kwargs)[0][0]["text"]
+    machine = constrained.ChatFormatMachine(FIELDS, [None, None])
+    assert machine.advance(machine.initial(), text) is not None
+
+    if draft:
+        plain = local_model.HuggingFaceLocalModel(dotmap.DotMap(name=tiny_model_dir, dtype="fp32",
+                                                                constrained_decoding=True))
+        assert plain.batch_generate([PROMPT], gen_kwargs)[0][0]["text"] == text
@@ -0,0 +1,55 @@
+""" Producer/consumer pipeline of the fused stages, with stand-in stages. """
+
+import threading
+import pytest
+
+pytest.importorskip("dspy")
+fused = pytest.importorskip("src.Fused")
+
+
+class Stage():
+    """ Stands for a `Generate` stage: streams integers instead of dataframes. """
+
+    def __init__(self, chunks=0, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.config = type("Config", (), {"task": type("Task", (), {"chunk_size": 1})()})()
+        self.lm, self.adapter = None, None
+        self.received = []
+
+    def setup(self, configure=True):
+        return None, None
+
+    def iter_dataframe(self, chunk_size):
+        return iter(range(self.chunks))
+
+    def stream(self, module, generate, chunks, on_chunk=None):
+        for chunk in chunks:
+            self.received.append(chunk)
+            if self.fail_after is not None and len(self.received) > self.fail_after:
+                raise RuntimeError("Judging failed")
+            if on_chunk is not None:
+                on_chunk(chunk)
+
+    def report(self):
+        pass
+
+
+def test_consumer_failure_stops_the_producer(monkeypatch):
+    monkeypatch.setattr(fused, "PUT_TIMEOUT", 0.01)
+    producer, consumer = Stage(chunks=100), Stage(fail_after=1)
+    run = threading.Thread(target=lambda: pytest.raises(RuntimeError, fused.Fused(producer, consumer,
+                                                                                  queue_size=2).run))
+    run.start()
+    run.join(timeout=10)
+
+    assert not run.is_alive()
+    assert consumer.received == [0, 1]
+    # The producer stopped once the queue was full, long before the end of its datasets
+    assert len(producer.received) < 10
+
+
+def test_every_chunk_is_consumed():
+    producer, consumer = Stage(chunks=10), Stage()
+    fused.Fused(producer, consumer, queue_size=2).run()
+    assert consumer.received == list(range(10))
@@ -0,0 +1,137 @@
+""" Sequence packing for SFT, on CPU with a tiny model. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("datasets")
+transformers = pytest.importorskip("transformers")
+packing = pytest.importorskip("src.trl.packing")
+
+from datasets import Dataset
+
+EXAMPLES = [
+    ("Grade the submission of the student.", "[[ ## reasoning ## ]]\nThe loop never ends."),
+    ("def main():\n    print(i)", "[[ ## feedback ## ]]\n{\"correctness\": 1}"),
+    ("Grade the submission.", "[[ ## completed ## ]]"),
+    ("def main():\n    for i in range(10):\n        print(i)\n", "The loop never ends."),
+]
+
+
+def tokenize(tokenizer, prompt, completion):
+    """ Conversation ids and completion mask, as `SFT.tokenize_example`. """
+    messages = [{"role": "user", "content": prompt}]
+    prompt_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+    completion_ids = tokenizer(completion + "<|im_end|>", add_special_tokens=False).input_ids
+    return {"input_ids": prompt_ids + completion_ids,
+            "completion_mask": [0] * len(prompt_ids) + [1] * len(completion_ids)}
+
+
+@pytest.fixture(scope="module")
+def conversations(tokenizer):
+    return Dataset.from_list([tokenize(tokenizer, *e) for e in EXAMPLES])
+
+
+def packed(conversations, max_length):
+    lengths = [len(ids) for ids in conversations["input_ids"]]
+    bins = packing.first_fit_decreasing(lengths, max_length)
+    return bins, packing.pack_dataset(conversations, bins, max_length)
+
+
+def test_bins_fit_and_positions_restart(conversations):
+    lengths = [len(ids) for ids in conversations["input_ids"]]
+    max_length = max(lengths) + min(lengths)
+    bins, dataset = packed(conversations, max_length)
+
+    assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+    assert len(bins) < len(lengths)
+    for indices, row in zip(bins, dataset):
+        assert len(row["input_ids"]) <= max_length
+        assert row["input_ids"] == [t for i in indices for t in conversations[i]["input_ids"]]
+        assert row["position_ids"] == [p for i in indices for p in range(lengths[i])]
+
+
+def test_mask_keeps_conversations_apart():
+    position_ids = torch.tensor([[0, 1, 2, 0, 1, 0]])
+    mask = packing.block_causal_mask(position_ids, torch.tensor([5]))[0, 0] == 0
+
+    assert mask.shape == (6, 6)
+    assert mask[2, :3].all() and not mask[2, 3:].any()
+    # The second conversation does not see the first one, nor the future
+    assert mask[4, 3:5].all() and not mask[4, :3].any() and not mask[3, 4]
+    # Padding only attends to itself
+    assert mask[5].tolist() == [False] * 5 + [True]
+    assert not mask[:5, 5].any()
+
+
+def conversation_losses(logits, labels, starts, ends):
+    """ Mean completion loss of every conversation of a row, from its own logits. """
+    losses = []
+    for start, end in zip(starts, ends):
+        targets = labels[start + 1: end]
+        loss = torch.nn.functional.cross_entropy(logits[start: end - 1], targets, ignore_index=-100)
+        losses.append(loss.item())
+    return losses
+
+
+@torch.no_grad()
+def test_packed_loss_matches_unpacked(tiny_model_dir, tokenizer, conversations):
+    model = transformers.AutoModelForCausalLM.from_pretrained(tiny_model_dir, attn_implementation="eager")
+    model.eval()
+    lengths = [len(ids) for ids in conversations["input_ids"]]
+    bins, dataset = packed(conversations, max(lengths) + min(lengths))
+
+    # Unpacked: every conversation alone, loss on its completion only
+    expected = {}
+    for i, row in enumerate(conversations):
+        ids = torch.tensor([row["input_ids"]])
+        labels = torch.tensor([[t if m else -100 for t, m in zip(row["input_ids"], row["completion_mask"])]])
+        expected[i] = conversation_losses(model(ids).logits[0], labels[0], [0], [len(row["input_ids"])])[0]
+
+    collator = packing.PackedCollator(tokenizer.pad_token_id)
+    batch = collator(list(dataset))
+    logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                   position_ids=batch["position_ids"]).logits
+
+    for r, indices in enumerate(bins):
+        ends = torch.cumsum(torch.tensor([lengths[i] for i in indices]), 0).tolist()
+        starts = [0] + ends[:-1]
+        losses = conversation_losses(logits[r], batch["labels"][r], starts, ends)
+        assert losses == pytest.approx([expected[i] for i in indices], abs=1e-4)
+
+    # Padding and prompts are never in the labels
+    assert (batch["labels"] != -100).sum() == sum(sum(m) for m in conversations["completion_mask"])
+
+
+def test_long_masked_packs_are_refused():
+    packing.check_max_length(packing.MAX_MASKED_LENGTH, padding_free=False)
+    packing.check_max_length(16384, padding_free=True)
+    with pytest.raises(ValueError, match="flash attention"):
+        packing.check_max_length(16384, padding_free=False)
+
+
+def test_real_tokens_are_counted_when_padding_is_the_end_of_sequence(tiny_model_dir, tokenizer,
+                                                                      conversations, tmp_path):
+    callbacks = pytest.importorskip("src.trl.callbacks")
+    model = transformers.AutoModelForCausalLM.from_pretrained(tiny_model_dir, attn_implementation="eager")
+    model.train()
+    lengths = [len(ids) for ids in conversations["input_ids"]]
+    _, dataset = packed(conversations, max(lengths) + min(lengths))
+
+    # Every conversation ends with the end of sequence token, also used as padding
+    callback = callbacks.ThroughputCallback(str(tmp_path), pad_token_id=tokenizer.eos_token_id)
+    callback.tokens, callback.padding = 0, 0
+    hook = model.register_forward_pre_hook(callback.count_tokens, with_kwargs=True)
+    batch = packing.PackedCollator(tokenizer.eos_token_id)(list(dataset))
+    model(**batch)
+    hook.remove()
+
+    assert callback.tokens == sum(lengths)
+    assert callback.padding == batch["input_ids"].numel() - sum(lengths)
+    # Only model inputs in the batches
+    assert set(batch) == {"input_ids", "labels", "position_ids", "attention_mask"}
+
+
+def test_packed_tokens_stop_at_the_padding():
+    callbacks = pytest.importorskip("src.trl.callbacks")
+    position_ids = torch.tensor([[0, 1, 2, 0, 1, 0, 0], [0, 1, 2, 3, 4, 5, 6], [0, 1, 0, 1, 0, 0, 0]])
+    assert callbacks.packed_tokens(position_ids) == 5 + 7 + 4
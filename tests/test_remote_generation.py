@@ -0,0 +1,64 @@
+""" Generation with remote providers, without sending any request. """
+
+import pytest
+
+dspy = pytest.importorskip("dspy")
+dotmap = pytest.importorskip("dotmap")
+pytest.importorskip("anthropic")
+generate = pytest.importorskip("src.Generate")
+judging = pytest.importorskip("src.judging.Judging")
+
+CLAUDE = "claude-sonnet-4-20250514"
+
+
+def experiment_config(tmp_path, **model):
+    return dotmap.DotMap(name="judging_remote", save_dir=str(tmp_path), seed=42,
+                         model={"source": "anthropic", "name": CLAUDE, **model}, task={})
+
+
+@pytest.fixture(autouse=True)
+def anthropic_key(monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "fake")
+
+
+def test_fast_judge_falls_back_to_the_remote_reasoning_judge(tmp_path, monkeypatch):
+    config = experiment_config(tmp_path)
+    config.task.fast.reference_sample = 0
+    experiment = judging.Judging(config, test_run=False)
+    # Stop the full judging run once its LM is loaded
+    monkeypatch.setattr(generate.Generate, "run", lambda self: self.load_model())
+    monkeypatch.setattr(generate.Generate, "load_local_instance",
+                        lambda self: pytest.fail("Loaded a local model for a remote judge"))
+
+    with pytest.warns(UserWarning, match="log-probabilities"):
+        lm = experiment.run()
+    assert isinstance(lm, dspy.LM)
+    assert lm.model == f"anthropic/{CLAUDE}"
+
+
+def test_anthropic_prompts_carry_cache_breakpoints(tmp_path, monkeypatch):
+    litellm = pytest.importorskip("litellm")
+    requests = []
+
+    def completion(**request):
+        requests.append(request)
+        message = litellm.Message(role="assistant", content="[[ ## answer ## ]]\nok\n\n[[ ## completed ## ]]")
+        return litellm.ModelResponse(model=CLAUDE, choices=[litellm.Choices(index=0, message=message, 
+                                                                            finish_reason="stop")],
+                                     usage=litellm.Usage(prompt_tokens=10, completion_tokens=5, total_tokens=15))
+
+    monkeypatch.setattr(dspy.clients.lm.litellm, "completion", completion)
+    experiment = generate.Generate(experiment_config(tmp_path, prefix_caching=True), test_run=False, 
+                                   module_cls=None)
+    lm = experiment.load_model(configure=False)
+
+    signature = dspy.Signature("code, problem_description -> answer")
+    with dspy.context(lm=lm, adapter=experiment.adapter):
+        pred = dspy.Predict(signature)(code="print(i)", problem_description="Print the numbers.")
+
+    assert pred.answer == "ok"
+    system, user = requests[0]["messages"]
+    assert system["content"][0]["cache_control"] == {"type": "ephemeral"}
+    # The problem goes first, in the cached block, and the submission after it
+    assert "Print the numbers." in user["content"][0]["text"] and "cache_control" in user["content"][0]
+    assert "print(i)" in user["content"][1]["text"] and "cache_control" not in user["content"][1]
@@ -0,0 +1,103 @@
+""" Retry policy and circuit breaker against a local stand-in server injecting failures. """
+
+import uuid
+import pytest
+
+openai = pytest.importorskip("openai")
+retry = pytest.importorskip("src.model.retry")
+
+
+class FakeClock():
+    """ Replaces the `time` module of the retry policy, so that waiting is instant. """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry, "time", clock)
+    return clock
+
+
+def caller(**config):
+    # A new provider name, so that every test has its own circuit breaker
+    return retry.RetryingCaller(f"fake-{uuid.uuid4()}", {"base_delay": 0.5, **config})
+
+
+def complete(server):
+    client = openai.OpenAI(base_url=server.base_url, max_retries=0)
+    return lambda: client.chat.completions.create(
+        model="gpt-fake", messages=[{"role": "user", "content": "Grade the submission."}])
+
+
+def test_waits_for_the_retry_after_delay(openai_server, clock):
+    openai_server.fail(429, headers={"retry-after": "7"})
+    openai_server.fail(503, headers={"retry-after-ms": "1500"})
+    rc = caller()
+
+    result = rc.call(complete(openai_server))
+    assert result.choices[0].message.content.startswith("[[ ## answer ## ]]")
+    assert clock.sleeps == [7.0, 1.5]
+    assert rc.get_metrics()["retries"] == 2
+    assert rc.get_metrics()["failures_by_status"] == {"429": 1, "503": 1}
+
+
+def test_gives_up_after_the_retries(openai_server, clock):
+    openai_server.fail(500, times=3)
+    rc = caller(max_retries=2, failure_threshold=10)
+
+    with pytest.raises(retry.GenerationError, match="after 3 attempts"):
+        rc.call(complete(openai_server))
+    assert openai_server.completions == 3
+    assert rc.get_metrics()["giveups"] == 1
+
+
+def test_zero_retries_is_respected(openai_server, clock):
+    openai_server.fail(500)
+    with pytest.raises(retry.GenerationError, match="after 1 attempts"):
+        caller(max_retries=0).call(complete(openai_server))
+    assert openai_server.completions == 1
+
+
+def test_request_errors_are_not_retried_and_keep_the_circuit_closed(openai_server, clock):
+    openai_server.fail(400, times=3)
+    rc = caller(failure_threshold=2)
+
+    for _ in range(3):
+        with pytest.raises(retry.GenerationError, match="after 1 attempts"):
+            rc.call(complete(openai_server))
+    assert rc.breaker.opened_at is None
+    assert rc.breaker.failures == 0
+
+
+def test_circuit_opens_then_closes_after_a_successful_trial(openai_server, clock):
+    rc = caller(max_retries=1, failure_threshold=2, reset_timeout=30.0)
+
+    # Two failures in a row open the circuit
+    openai_server.fail(503, times=2)
+    with pytest.raises(retry.GenerationError):
+        rc.call(complete(openai_server))
+    assert rc.breaker.opened_at is not None
+
+    # Half open: the trial request fails, so the circuit opens again, then
+    # the next trial succeeds and closes it
+    openai_server.fail(503)
+    clock.sleeps.clear()
+    rc.call(complete(openai_server))
+
+    assert rc.breaker.opened_at is None and rc.breaker.failures == 0
+    assert openai_server.completions == 4
+    # Waited for the reset timeout twice, the second time minus the retry delay
+    wait, delay, remaining = clock.sleeps
+    assert wait == 30.0 and delay + remaining == pytest.approx(30.0)
+    assert rc.get_metrics()["circuit_wait"] == pytest.approx(wait + remaining)
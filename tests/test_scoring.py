@@ -0,0 +1,36 @@
+""" Log-likelihood scoring of candidate continuations. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+dotmap = pytest.importorskip("dotmap")
+local_model = pytest.importorskip("src.model.HuggingFaceLocalModel")
+
+MESSAGES = [{"role": "user", "content": "Grade the submission of the student."}]
+CONTINUATIONS = ['"correctness": 0,', '"correctness": 1,', '"style": 1,']
+
+
+def full_sequence_scores(lm, prompt, continuations):
+    """ Reference: every candidate tokenized with the prompt and run on its own. """
+    ids = [lm.tokenizer(prompt + c, add_special_tokens=False).input_ids for c in continuations]
+    shared = local_model.shared_prefix_length(ids)
+    scores = []
+    for tokens in ids:
+        logprobs = torch.log_softmax(lm.model(torch.tensor([tokens])).logits[0].float(), dim=-1)
+        scores.append(sum(logprobs[j - 1, tokens[j]].item() for j in range(shared, len(tokens))))
+    return scores
+
+
+@torch.no_grad()
+def test_candidates_are_tokenized_with_the_prefix(tiny_model_dir):
+    lm = local_model.HuggingFaceLocalModel(dotmap.DotMap(name=tiny_model_dir, dtype="fp32"))
+    prompt = lm.tokenizer.apply_chat_template(MESSAGES, tokenize=False, add_generation_prompt=True) + "{"
+
+    scores = lm.score_continuations(MESSAGES, "{", CONTINUATIONS)
+    assert scores == pytest.approx(full_sequence_scores(lm, prompt, CONTINUATIONS), abs=1e-4)
+    assert lm.get_metrics()["scoring"]["calls"] == 1
+
+
+def test_shared_prefix_length():
+    assert local_model.shared_prefix_length([[1, 2, 3], [1, 2, 4], [1, 2]]) == 2
+    assert local_model.shared_prefix_length([[5], [6]]) == 0
@@ -0,0 +1,44 @@
+""" Stopping on the ChatAdapter output markers. """
+
+import pytest
+
+torch = pytest.importorskip("torch")
+stopping = pytest.importorskip("src.model.stopping")
+
+FIELDS = ["reasoning", "feedback"]
+ANSWER = ("[[ ## reasoning ## ]]\nThe loop never ends.\n\n"
+          "[[ ## feedback ## ]]\n{\"correctness\": 1}\n\n"
+          "[[ ## completed ## ]]\nThe loop never ends.")
+
+
+def run(tokenizer, text, tokens_per_step):
+    """ Feed the tokens of `text` a few at a time, as assisted generation does. """
+    prompt = tokenizer("Grade the submission.", add_special_tokens=False).input_ids
+    ids = tokenizer(text, add_special_tokens=False).input_ids
+    criteria = stopping.FieldMarkerStoppingCriteria(tokenizer, [FIELDS], len(prompt))
+
+    for end in range(tokens_per_step, len(ids) + tokens_per_step, tokens_per_step):
+        input_ids = torch.tensor([prompt + ids[:end]])
+        if criteria(input_ids, None)[0]:
+            return tokenizer.decode(ids[:end])
+    return None
+
+
+@pytest.mark.parametrize("tokens_per_step", [1, 3, 8])
+def test_stops_when_completed_marker_is_followed_by_more_tokens(tokenizer, tokens_per_step):
+    generated = run(tokenizer, ANSWER, tokens_per_step)
+    assert generated is not None
+    assert "[[ ## completed ## ]]" in generated
+    assert stopping.trim_output(generated, FIELDS).endswith("[[ ## completed ## ]]")
+
+
+def test_stops_on_a_new_section_after_all_fields(tokenizer):
+    text = ANSWER.replace("completed", "reasoning")
+    generated = run(tokenizer, text, tokens_per_step=5)
+    assert generated is not None
+    assert generated.count("[[ ## reasoning ## ]]") == 2
+
+
+def test_does_not_stop_before_the_fields_are_written(tokenizer):
+    text = "[[ ## reasoning ## ]]\nThe loop never ends.\n\n[[ ## feedback ## ]]\n{\"correctness\": 1}"
+    assert run(tokenizer, text, tokens_per_step=4) is None